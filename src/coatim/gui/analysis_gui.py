@@ -1,8 +1,10 @@
 # gui/analysis_gui.py
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QDoubleSpinBox
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QDoubleSpinBox, QCheckBox
 import pyqtgraph as pg
 from PyQt5.QtCore import pyqtSignal, Qt
 
+from logic.analysis_logic import ScanBuffer
+
 class AnalysisGui(QWidget):
     """
     Thin GUI that delegates fit logic to an external AnalysisLogic instance.
@@ -36,6 +38,10 @@ class AnalysisGui(QWidget):
         ctrl.addWidget(QLabel("FWHM:")); ctrl.addWidget(self.width)
         ctrl.addWidget(QLabel("Center:")); ctrl.addWidget(self.center)
 
+        # Automatic initial guess: previous fit of the scan, or estimate from the data
+        self.auto_p0 = QCheckBox("Auto p0"); self.auto_p0.setChecked(True)
+        ctrl.addWidget(self.auto_p0)
+
         self.fit_button = QPushButton("Perform fit")
         self.clear_button = QPushButton("Clear")
         ctrl.addWidget(self.fit_button)
@@ -47,8 +53,8 @@ class AnalysisGui(QWidget):
 
         self.setLayout(layout)
 
-        # internal storage
-        self.data = []
+        # internal storage, used without logic
+        self.scan = ScanBuffer()
         self.frequency_step = 1.0  # default
         self.current_step = 0
 
@@ -59,9 +65,13 @@ class AnalysisGui(QWidget):
         self.fit_button.clicked.connect(self.on_fit_clicked)
         self.clear_button.clicked.connect(self.on_clear_clicked)
 
-        # plot items
-        self.data_plot = None
-        self.fit_plot = None
+        # plot items, created once and updated with setData
+        self.data_plot = self.plot_widget.plot([], [], pen='b', symbol='o')
+        self.fit_plot = self.plot_widget.plot([], [], pen='r')
+        # beyond this many points, skip the symbols and let pyqtgraph decimate the line
+        self.max_symbols = 2000
+        self.data_plot.setDownsampling(auto=True, method='peak')
+        self.data_plot.setClipToView(True)
 
     def set_logic(self, logic):
         self.logic = logic
@@ -73,8 +83,8 @@ class AnalysisGui(QWidget):
 
     def add_datapoint(self, atom_count):
         if self.logic is None:
-            # still keep internal list so plotting works
-            self.data.append(float(atom_count))
+            # still keep internal storage so plotting works
+            self.scan.append(y=float(atom_count))
             self.current_step += 1
         else:
             self.logic.add_datapoint(atom_count)
@@ -87,26 +97,33 @@ class AnalysisGui(QWidget):
         return (pg.np.arange(n) * self.frequency_step) - (n * self.frequency_step / 2.0)
 
     def _update_plot(self):
-        x = self._x_array()
         if self.logic is None:
-            y = pg.np.array(self.data)
+            x, y = self._x_array(), self.scan['y']
         else:
-            y = pg.np.array(self.logic.data[:self.current_step])
-
-        self.plot_widget.clear()
-        if len(x) > 0:
-            self.plot_widget.plot(x, y, pen='b', symbol='o')
+            x, y = self.logic.x_array(), self.logic.data
+        # views of the scan buffers: setData does not need new lists
+        if len(x) > self.max_symbols:
+            self.data_plot.setSymbol(None)
+        self.data_plot.setData(x, y)
 
     def on_fit_clicked(self):
         p0 = (self.offset.value(), self.amp.value(), self.width.value(), self.center.value())
+        if self.auto_p0.isChecked():
+            p0 = None
         if self.logic is None:
             return
         try:
-            x, y, fit_data, popt, pcov = self.logic.perform_lorentz_fit(p0)
+            result = self.logic.perform_lorentz_fit(p0)
+            if result is None:
+                self.width_label.setText("Not enough points to fit yet")
+                return
+            x, y, fit_data, popt, pcov = result
+            # show the fitted parameters as the next manual initial guess
+            for box, value in zip((self.offset, self.amp, self.width, self.center), popt):
+                box.setValue(value)
             # replot
-            self.plot_widget.clear()
-            self.plot_widget.plot(x, y, pen='b', symbol='o')
-            self.plot_widget.plot(x, fit_data, pen='r')
+            self.data_plot.setData(x, y)
+            self.fit_plot.setData(x, fit_data)
             self.width_label.setText(f"FWHM after fit: {popt[2]:.3f}")
         except Exception as e:
             self.width_label.setText(f"Fit error: {e}")
@@ -114,7 +131,9 @@ class AnalysisGui(QWidget):
     def on_clear_clicked(self):
         if self.logic:
             self.logic.reset(self.frequency_step)
-        self.data = []
+        self.scan.clear()
         self.current_step = 0
-        self.plot_widget.clear()
+        self.data_plot.setData([], [])
+        self.data_plot.setSymbol('o')
+        self.fit_plot.setData([], [])
         self.width_label.setText("FWHM after fit: N/A")
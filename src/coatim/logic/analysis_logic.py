@@ -1,68 +1,409 @@
 # logic/analysis_logic.py
+import time
 import numpy as np
-from scipy.optimize import curve_fit
-
-# Try to import your existing DataAnalysis class (keeps compatibility)
-try:
-    from Classes.Analysis import DataAnalysis
-except Exception:
-    # Minimal fallback DataAnalysis if the real one isn't present
-    class DataAnalysis:
-        def __init__(self, x, y):
-            self.x = x
-            self.y = y
-
-        @staticmethod
-        def fit_lorentz(x, offset, amp, fwhm, center):
-            # Lorentzian parameterisation where fwhm is width
-            gamma = fwhm / 2.0
-            return offset + amp * (gamma**2 / ((x - center)**2 + gamma**2))
+
+
+def lorentzian(x, offset, amp, fwhm, center):
+    """Lorentzian of full width at half maximum fwhm, peak amp above offset."""
+    gamma = fwhm / 2.0
+    return offset + amp * (gamma**2 / ((x - center)**2 + gamma**2))
+
+
+def _lorentz_model(x, params):
+    """
+    Values (B, N) and Jacobian (B, N, 4) of B Lorentzians. x is (N,) or (B, N),
+    params is (B, 4) with columns (offset, amp, fwhm, center).
+    """
+    offset, amp, fwhm, center = (params[:, i:i + 1] for i in range(4))
+    u = 2.0 * (x - center) / fwhm
+    shape = 1.0 / (1.0 + u * u)
+    peak = amp * shape
+    slope = 2.0 * peak * shape * u  # -d(peak)/du
+    jac = np.empty(peak.shape + (4,))
+    jac[..., 0] = 1.0
+    jac[..., 1] = shape
+    jac[..., 2] = slope * u / fwhm
+    jac[..., 3] = slope * 2.0 / fwhm
+    return offset + peak, jac
+
+
+def estimate_lorentz_p0(x, y):
+    """
+    Initial guess (offset, amp, fwhm, center) of a Lorentzian peak or dip:
+    offset from the median of the outer points, peak at the largest
+    deviation from it, FWHM from the span of the points above half of the peak.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if len(y) == 0:
+        return np.array([0.0, 0.0, 1.0, 0.0])
+    edge = max(len(y) // 5, 1)
+    offset = np.median(np.concatenate((y[:edge], y[-edge:])))
+    signal = y - offset
+    peak = np.argmax(np.abs(signal))
+    amp = signal[peak]
+    step = np.abs(np.diff(x)).min() if len(x) > 1 else 1.0
+    # Walk from the peak to the half-maximum points on both sides
+    above = signal / amp > 0.5 if amp != 0 else np.zeros(len(y), dtype=bool)
+    lo = peak
+    while lo > 0 and above[lo - 1]:
+        lo -= 1
+    hi = peak
+    while hi < len(y) - 1 and above[hi + 1]:
+        hi += 1
+    fwhm = max(abs(x[hi] - x[lo]) + step, step)
+    return np.array([offset, amp, fwhm, x[peak]])
+
+
+def moment_lorentz_p0(x, y):
+    """
+    Initial guess (offset, amp, fwhm, center) of a Lorentzian from the moments
+    of the points: offset from the median, center and width from the mean and
+    the spread of the deviation from it. Unlike estimate_lorentz_p0 it does not
+    need the peak to be resolved, e.g. on the first points of a scan.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if len(y) == 0:
+        return np.array([0.0, 0.0, 1.0, 0.0])
+    offset = np.median(y)
+    signal = y - offset
+    weights = np.abs(signal)
+    if weights.sum() == 0:
+        return np.array([offset, 0.0, max(np.ptp(x), 1.0), x.mean()])
+    center = np.average(x, weights=weights)
+    spread = np.sqrt(np.average((x - center) ** 2, weights=weights))
+    step = np.abs(np.diff(x)).min() if len(x) > 1 else 1.0
+    amp = signal[np.argmax(weights)]
+    return np.array([offset, amp, max(2.0 * spread, step), center])
+
+
+def fit_lorentz_batch(x, y, p0=None, max_iter=100, xtol=1e-8, ftol=1e-10):
+    """
+    Fit B scans with Lorentzians at once, in one vectorized Levenberg-Marquardt
+    loop with the analytic Jacobian: every iteration solves the 4x4 normal
+    equations of all the scans together, and the scans that converged stop
+    being evaluated.
+
+    x: (N,) shared axis or (B, N) axes. y: (B, N) scans, NaN points are ignored.
+    p0: (B, 4) or (4,) initial (offset, amp, fwhm, center), None to estimate
+    them from every scan.
+
+    Returns (popt (B, 4), pcov (B, 4, 4), success (B,)). pcov is scaled by the
+    reduced chi-square, as curve_fit does.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n_scans = y.shape[0]
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    weights = np.isfinite(y).astype(float)
+    y = np.where(weights > 0, y, 0.0)
+    if p0 is None:
+        params = np.array([estimate_lorentz_p0(x[i], np.where(weights[i] > 0, y[i], np.nan))
+                           for i in range(n_scans)])
+    else:
+        params = np.array(np.broadcast_to(np.asarray(p0, dtype=float), (n_scans, 4)))
+
+    def evaluate(p, idx):
+        model, jac = _lorentz_model(x[idx], p)
+        w = weights[idx]
+        residuals = (model - y[idx]) * w
+        return residuals, jac * w[..., None], 0.5 * np.einsum('bn,bn->b', residuals, residuals)
+
+    everything = np.arange(n_scans)
+    residuals, jac, cost = evaluate(params, everything)
+    lam = np.full(n_scans, 1e-3)
+    active = np.isfinite(cost)
+    success = np.zeros(n_scans, dtype=bool)
+    eye = np.eye(4)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        j = jac[idx]
+        jtj = np.einsum('bni,bnj->bij', j, j)
+        grad = np.einsum('bni,bn->bi', j, residuals[idx])
+        # Marquardt scaling: damping proportional to the diagonal of J^T J
+        diag = np.maximum(np.einsum('bii->bi', jtj), 1e-30)
+        damped = jtj + lam[idx, None, None] * diag[:, :, None] * eye
+        try:
+            step = -np.linalg.solve(damped, grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('bij,bj->bi', np.linalg.pinv(damped), grad)
+        trial = params[idx] + step
+        trial_residuals, trial_jac, trial_cost = evaluate(trial, idx)
+        better = np.isfinite(trial_cost) & (trial_cost <= cost[idx])
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(params[idx]) + xtol), axis=1)
+        small_gain = cost[idx] - trial_cost <= ftol * cost[idx]
+        accepted = idx[better]
+        params[accepted] = trial[better]
+        residuals[accepted] = trial_residuals[better]
+        jac[accepted] = trial_jac[better]
+        cost[accepted] = trial_cost[better]
+        lam[idx] = np.where(better, lam[idx] / 3.0, lam[idx] * 2.0)
+        done = small_step | (better & small_gain)
+        # The damping keeps growing without any accepted step: give up, the fit failed
+        stuck = ~better & (lam[idx] > 1e10)
+        success[idx[done]] = True
+        active[idx[done | stuck]] = False
+
+    jtj = np.einsum('bni,bnj->bij', jac, jac)
+    dof = np.maximum(weights.sum(axis=1) - 4, 1)
+    try:
+        pcov = np.linalg.inv(jtj)
+    except np.linalg.LinAlgError:
+        pcov = np.linalg.pinv(jtj)
+    pcov *= (2.0 * cost / dof)[:, None, None]
+    params[:, 2] = np.abs(params[:, 2])
+    success &= np.isfinite(params).all(axis=1) & _resolved_peaks(x, weights, params)
+    return params, pcov, success
+
+
+def _resolved_peaks(x, weights, params):
+    """
+    Whether every fitted Lorentzian is a peak resolved by its scan: centered
+    within the measured points and neither much wider than the scan nor
+    narrower than its point spacing. Out of these bounds the fit is degenerate,
+    e.g. a nearly flat far wing of a huge peak or a spike on a single point.
+    """
+    measured = weights > 0
+    lo = np.where(measured, x, np.inf).min(axis=1)
+    hi = np.where(measured, x, -np.inf).max(axis=1)
+    span = hi - lo
+    spacing = span / np.maximum(measured.sum(axis=1) - 1, 1)
+    fwhm, center = params[:, 2], params[:, 3]
+    return (center >= lo) & (center <= hi) & (fwhm <= 10.0 * span) & (fwhm >= 0.25 * spacing)
+
+
+def _lorentz_cost(x, y, params):
+    """Half the sum of squared residuals of a Lorentzian, NaN points ignored."""
+    residuals = lorentzian(np.asarray(x, dtype=float), *params) - np.asarray(y, dtype=float)
+    return 0.5 * np.nansum(residuals ** 2)
+
+
+# Columns of a scan: name -> (shape of a point, dtype, fill value of missing entries)
+SCAN_COLUMNS = {
+    'x': ((), np.float64, np.nan),          # scan coordinate, e.g. frequency [kHz]
+    'y': ((), np.float64, np.nan),          # measurement, e.g. number of atoms
+    'timestamp': ((), np.float64, np.nan),  # time.time() of the point
+    'roi': ((4,), np.int64, -1),            # [x1, x2, y1, y2] of the measurement
+    'fit': ((4,), np.float64, np.nan),      # fit (offset, amp, fwhm, center) after the point
+}
+
+
+class ScanBuffer:
+    """
+    Column storage of a scan in preallocated numpy arrays. Appending a point
+    writes one row in place; when a column is full, the capacity is doubled,
+    so extending a scan costs O(1) amortised whatever its length. Columns are
+    returned as zero-copy views of the filled rows: they are only valid until
+    the next append that grows the buffer.
+    """
+    def __init__(self, capacity=1024, columns=None):
+        self._spec = dict(SCAN_COLUMNS if columns is None else columns)
+        self._length = 0
+        self._columns = {}
+        self._allocate(max(int(capacity), 1))
+
+    def _allocate(self, capacity):
+        columns = {}
+        for name, (shape, dtype, fill) in self._spec.items():
+            column = np.full((capacity,) + tuple(shape), fill, dtype=dtype)
+            if name in self._columns:
+                column[:self._length] = self._columns[name][:self._length]
+            columns[name] = column
+        self._columns = columns
+        self._capacity = capacity
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def column_names(self):
+        return tuple(self._spec)
+
+    def reserve(self, capacity):
+        """Grow the buffer to hold at least capacity points."""
+        if capacity > self._capacity:
+            self._allocate(int(capacity))
+
+    def clear(self):
+        """Forget all the points, keeping the allocated memory."""
+        for name, (shape, dtype, fill) in self._spec.items():
+            self._columns[name][:self._length] = fill
+        self._length = 0
+
+    def append(self, **values):
+        """Add a point; missing columns keep their fill value. Returns its index."""
+        if self._length == self._capacity:
+            self._allocate(2 * self._capacity)
+        index = self._length
+        for name, value in values.items():
+            if value is not None:
+                self._columns[name][index] = value
+        self._length += 1
+        return index
+
+    def set(self, name, index, value):
+        """Overwrite the value of a column at an existing point."""
+        if not -self._length <= index < self._length:
+            raise IndexError(f"Point {index} out of a scan of {self._length} points")
+        self._columns[name][index] = value
+
+    def column(self, name):
+        """Zero-copy view of a column over the filled points."""
+        return self._columns[name][:self._length]
+
+    __getitem__ = column
+
 
 class AnalysisLogic:
     """
-    Logic for frequency scan plotting and fitting. Stores data points and
-    performs fits using DataAnalysis.fit_lorentz (or fallback).
+    Logic for frequency scan plotting and fitting. Stores data points in a
+    ScanBuffer and performs Lorentzian fits with an analytic Jacobian
+    (fit_lorentz_batch). Refits during a scan start from the previous fit result.
     """
     def __init__(self):
-        self.data = []
+        self.scan = ScanBuffer()
         self.frequency_step = None
         self.current_step = 0
         self.num_steps = None
+        self.last_popt = None
+        self._last_fit_steps = 0
+
+    @property
+    def data(self):
+        """Measurements of the scan (zero-copy view)."""
+        return self.scan['y']
 
     def reset(self, frequency_step=None, num_steps=None):
-        self.data = []
+        self.scan.clear()
+        if num_steps:
+            self.scan.reserve(num_steps)
         self.current_step = 0
         self.frequency_step = frequency_step
         self.num_steps = num_steps
+        self.last_popt = None
+        self._last_fit_steps = 0
 
-    def add_datapoint(self, atom_count):
-        """Append a single measurement (number of atoms)."""
-        self.data.append(float(atom_count))
+    def add_datapoint(self, atom_count, roi=None, timestamp=None):
+        """
+        Append a single measurement (number of atoms), with the ROI it was
+        measured in and its time (now by default).
+        """
+        step = self.frequency_step if self.frequency_step is not None else 1.0
+        # With a known length the scan is centred on 0 once and for all,
+        # otherwise x_array re-centres it on the points acquired so far
+        start = -self.num_steps * step / 2.0 if self.num_steps else 0.0
+        self.scan.append(x=start + self.current_step * step, y=float(atom_count),
+                         timestamp=time.time() if timestamp is None else timestamp, roi=roi)
         self.current_step += 1
 
-    def x_array(self):
+    def x_array(self, n=None):
         if self.frequency_step is None:
             raise RuntimeError("frequency_step not set")
-        # center the x axis on 0 using current_step (length of data)
-        n = self.current_step
+        n = self.current_step if n is None else n
+        if n == self.current_step and self.num_steps:
+            return self.scan['x']
+        # center the x axis on 0 using the number of points
         x = np.arange(n) * self.frequency_step - (n * self.frequency_step / 2.0)
         return x
 
-    def perform_lorentz_fit(self, p0):
+    def perform_lorentz_fit(self, p0=None):
         """
-        Perform a Lorentzian fit; p0 should be iterable (offset, amp, fwhm, center).
-        Returns (x_data, y_data, fit_data, popt) or raises exception on fit failure.
+        Perform a Lorentzian fit; p0 is an iterable (offset, amp, fwhm, center),
+        or None to start from the previous fit of the scan, or from an estimate
+        of the data for the first fit. The fit is started again from the
+        estimate when it ends degenerate or worse than the estimate. The fit
+        parameters are stored with the last point of the scan, and only a
+        successful fit is used as the start of the next one.
+        Returns (x_data, y_data, fit_data, popt, pcov), or None while the scan
+        has fewer points than fit parameters. A partial scan that cannot be
+        fitted yet returns the moment estimate of the points with a NaN pcov;
+        a complete scan raises an exception on fit failure.
         """
-        if self.current_step <= 1:
-            raise RuntimeError("Not enough data points to fit")
-
+        if self.current_step < 4 or np.count_nonzero(np.isfinite(self.data)) < 4:
+            return None
         x_data = self.x_array()
-        y_data = np.array(self.data[:self.current_step])
-
-        analysis = DataAnalysis(x_data, y_data)
+        y_data = self.data
+        partial = not self.num_steps or self.current_step < self.num_steps
 
-        # curve_fit expecting function signature f(x, *params)
-        popt, pcov = curve_fit(analysis.fit_lorentz, x_data, y_data, p0=p0)
+        if p0 is None and self.last_popt is not None:
+            p0 = self.last_popt
+            if not self.num_steps:
+                # The x axis is re-centred as the scan grows: move the previous center with it
+                shift = (self.current_step - self._last_fit_steps) * self.frequency_step / 2.0
+                p0 = p0 - np.array([0.0, 0.0, 0.0, shift])
+        popt, pcov, success = fit_lorentz_batch(x_data, y_data[None], p0)
+        if p0 is not None:
+            # A warm start can end in a degenerate solution, or in a worse minimum than the
+            # estimate of the data: start again from the estimate then
+            cold_p0 = estimate_lorentz_p0(x_data, y_data)
+            if not success[0] or (_lorentz_cost(x_data, y_data, popt[0])
+                                  > _lorentz_cost(x_data, y_data, cold_p0)):
+                cold = fit_lorentz_batch(x_data, y_data[None], cold_p0)
+                if cold[2][0] or not success[0]:
+                    popt, pcov, success = cold
+        if not success[0] and partial:
+            seed = moment_lorentz_p0(x_data, y_data)
+            popt, pcov, success = fit_lorentz_batch(x_data, y_data[None], seed)
+            if not success[0]:
+                # The peak is not resolved yet: show the moments until more points come
+                self.last_popt = None
+                return x_data, y_data, lorentzian(x_data, *seed), seed, np.full((4, 4), np.nan)
+        if not success[0]:
+            self.last_popt = None
+            raise RuntimeError("Lorentzian fit did not converge")
+        popt, pcov = popt[0], pcov[0]
+        self.last_popt = popt.copy()
+        self._last_fit_steps = self.current_step
+        self.scan.set('fit', self.current_step - 1, popt)
 
-        fit_data = analysis.fit_lorentz(x_data, *popt)
+        fit_data = lorentzian(x_data, *popt)
         return x_data, y_data, fit_data, popt, pcov
+
+    def perform_lorentz_fit_batch(self, y_data, p0=None):
+        """
+        Fit many scans of the current frequency axis at once, e.g. the atom
+        number of several ROIs or cameras. y_data is (B, N) with N scan points,
+        p0 (B, 4) or (4,), None to estimate it for every scan.
+        Returns (x_data, fit_data (B, N), popt (B, 4), pcov (B, 4, 4), success (B,)).
+        """
+        y_data = np.atleast_2d(np.asarray(y_data, dtype=float))
+        x_data = self.x_array(y_data.shape[1])
+        popt, pcov, success = fit_lorentz_batch(x_data, y_data, p0)
+        fit_data = lorentzian(x_data, *(popt.T[:, :, None]))
+        return x_data, fit_data, popt, pcov, success
+
+
+def check_live_scan_fit(noise=10.0, seed=0):
+    """
+    Regression check of the warm-started fits of a live scan: refit a noisy
+    Lorentzian (offset 100, amp 500, fwhm 10, center 3) of 101 points after
+    every point, as the analysis window does. The warm start used to get stuck
+    on a degenerate near-flat solution (fwhm ~1e10) and report it as the fit of
+    the complete scan. Raises AssertionError on a regression.
+    Returns the fit parameters of the complete scan.
+    """
+    rng = np.random.default_rng(seed)
+    logic = AnalysisLogic()
+    logic.reset(1.0, 101)
+    x = np.arange(101) - 50.5
+    y = lorentzian(x, 100.0, 500.0, 10.0, 3.0) + rng.normal(0.0, noise, len(x))
+    for value in y:
+        logic.add_datapoint(value)
+        result = logic.perform_lorentz_fit()
+        if logic.last_popt is not None:
+            assert abs(logic.last_popt[3]) <= 51 and logic.last_popt[2] <= 1010, \
+                f"Degenerate fit kept as warm start: {logic.last_popt}"
+    popt = result[3]
+    assert abs(popt[2] - 10.0) < 1.0 and abs(popt[3] - 3.0) < 0.5, \
+        f"Wrong fit of the complete scan: {popt}"
+    return popt
@@ -7,10 +7,17 @@ from Classes.Capture import CameraWorker, VimbaLoadingWorker
 from Classes.Analysis import AnalyseOD
 from Classes.Display import ImageView
 from Classes.AnalysisWindow import GraphicWindowFreqScan
+from qudi.logic.integral_image import IntegralImage
+from qudi.logic.cloud_fitting import CloudFitter, PROFILE_MODELS, condensate_fraction, evaluate_model, model_parameters
+from qudi.logic.profile_fitting import ProfileFitter, ProfileSums
+from qudi.storage.run_archive import RunArchive
+from qudi.util.paths import get_default_data_dir
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import numpy as np
+import os
+import time
 import logging
 import json # for opening/saving user parameters
 
@@ -47,6 +54,8 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         self.refresh_interface_settings()
         self._saveSettings()
+        self.profile_fitter.close()
+        self._closeRecordingArchive()
     
     
     ############################################################################
@@ -74,6 +83,20 @@ class MainWindow(QMainWindow):
 
         self.ui.DisplaySettings.addWidget(self.ui.checkBox_normalize)
         
+        # Scrubbing through the shots of an archived run
+        self.run_archive = None  # RunArchive being browsed
+        self.browsing_run = False  # True while the displayed shot comes from run_archive
+        self.ui.pushButton_open_run = QPushButton(self.ui.centralwidget)
+        self.ui.pushButton_open_run.setText("Open run")
+        self.ui.pushButton_open_run.clicked.connect(self._onOpenRunButton)
+        self.ui.slider_run_shot = QSlider(Qt.Horizontal, self.ui.centralwidget)
+        self.ui.slider_run_shot.setEnabled(False)
+        self.ui.slider_run_shot.valueChanged.connect(self._onRunShotChange)
+        self.ui.label_run_shot = QLabel(self.ui.centralwidget)
+        self.ui.DisplaySettings.addWidget(self.ui.pushButton_open_run)
+        self.ui.DisplaySettings.addWidget(self.ui.slider_run_shot)
+        self.ui.DisplaySettings.addWidget(self.ui.label_run_shot)
+        
         # Storing current images
         self.noImage = True
         self.images = {"bright": np.zeros_like(self.display.image),
@@ -82,6 +105,10 @@ class MainWindow(QMainWindow):
                        "Natoms": np.zeros_like(self.display.image)}
         self.selectedImageType = "OD"
         self.analysis = None
+        self.atom_index = IntegralImage()  # summed-area table of the Natoms image
+        self.cloud_fitter = CloudFitter(model="gaussian")  # warm-started from shot to shot
+        self.profile_sums = ProfileSums()  # row and column sums of the Natoms image
+        self.profile_fitter = ProfileFitter(model="gaussian")  # 1D fits, x and y in parallel
         
         # Number of atoms label
         self.ui.NumberOfAtomsLabel.setMinimumSize(QSize(250, 0))
@@ -115,6 +142,8 @@ class MainWindow(QMainWindow):
             self.images["OD"] = self.analysis.calculate_OD(normalization_ROI=self.getNormalization())
             # self.images["Natoms"] = self.analysis.calculate_atom_density(self.curr_pixel_size)
             self.images["Natoms"] = self.analysis.calculate_atom_density(self.interface_settings[self.camera_index - 1]["PixelSize"])
+            self.atom_index.update(self.images["Natoms"])
+            self.profile_sums.update(self.images["Natoms"])
             self.display.setImage(self.images[self.selectedImageType])
             self.retrieveAtomNumber()
             
@@ -163,13 +192,14 @@ class MainWindow(QMainWindow):
             return None
     
     def retrieveAtomNumber(self):
-        """Calculates the total number of atoms in the ROI."""
+        """Calculates the total number of atoms in the ROI from the summed-area table of the Natoms
+        image, in constant time whatever the ROI size."""
         if not self.noImage:  # Checking whether an image has been made already
-            self.number_of_atoms = self.analysis.calculate_atom_number(self.display.roi_getcoords())
+            self.number_of_atoms = self.atom_index.sum(self.display.roi_getcoords())
             self.ui.NumberOfAtomsLabel.setFont(QFont('Times', 20)) 
             self.ui.NumberOfAtomsLabel.setText(self.analysis.format_atom_number(self.number_of_atoms))
         
-        if self.scan_type is not None:
+        if self.scan_type is not None and not self.browsing_run:  # archived shots are no scan points
             if self.scan_type == "frequency scan":
                 # Assurez-vous que la fenêtre d'analyse est déjà ouverte
                 if self.analysis_freq_window:
@@ -177,24 +207,100 @@ class MainWindow(QMainWindow):
 
                 
         
-    def refreshImage(self, bright_image, dark_image) -> None:
+    def refreshImage(self, bright_image, dark_image, pixel_size=None) -> None:
         """
         Calculates the OD and Natoms images, and stores them along bright and dark in self.images.
+        The pixel size defaults to the one of the current camera.
         """
         logging.info("UI : Refreshing image")
+        if pixel_size is None:
+            pixel_size = self.interface_settings[self.camera_index - 1]["PixelSize"]
         self.noImage = False
         self.images["bright"] = bright_image
         self.images["dark"] = dark_image
         self.analysis = AnalyseOD(bright=bright_image, dark = dark_image)
         # Computing the OD and atom number density
         self.images["OD"] = self.analysis.calculate_OD(normalization_ROI=self.getNormalization())
-        self.images["Natoms"] = self.analysis.calculate_atom_density(self.interface_settings[self.camera_index - 1]["PixelSize"])
+        self.images["Natoms"] = self.analysis.calculate_atom_density(pixel_size)
+        self.atom_index.update(self.images["Natoms"])
+        self.profile_sums.update(self.images["Natoms"])
         self.display.setImage(self.images[self.selectedImageType])
         
         # Signalling that image was just changed
         self.newImage_signal.emit()
         self.retrieveAtomNumber()
     
+    #### Run archive
+    
+    def _onOpenRunButton(self):
+        """Opens a run archive and displays its first shot."""
+        path = QFileDialog.getExistingDirectory(self, "Open run", self._runsDirectory())
+        if not path:
+            return
+        try:
+            archive = RunArchive(path)
+        except (OSError, ValueError, KeyError) as err:
+            logging.error(f"UI : Unable to open run {path} : {err}")
+            return
+        if len(archive) == 0 or archive.shot_shape[0] < 2:
+            logging.error(f"UI : Run {path} holds no bright and dark shot")
+            return
+        self.run_archive = archive
+        self.ui.slider_run_shot.setRange(0, len(archive) - 1)
+        self.ui.slider_run_shot.setEnabled(True)
+        if self.ui.slider_run_shot.value() == 0:
+            self._onRunShotChange(0)
+        else:
+            self.ui.slider_run_shot.setValue(0)
+    
+    def _onRunShotChange(self, position):
+        """Displays the shot at a position of the run archive. Only this shot is read from the
+        disk, so that scrubbing stays instantaneous whatever the length of the run.
+
+        Args:
+            position (int): Position of the shot in the archive.
+        """
+        if self.run_archive is None:
+            return
+        shot = self.run_archive[position]
+        record = self.run_archive.index[position]
+        camera = self.run_archive.camera_name(position)
+        self.ui.label_run_shot.setText(f"Shot {record['shot']} ({position + 1}/{len(self.run_archive)})")
+        self.browsing_run = True
+        # Shots are archived with the camera index as camera name
+        pixel_size = self.interface_settings[int(camera) - 1]["PixelSize"] if camera.isdigit() else None
+        self.refreshImage(np.asarray(shot[0]), np.asarray(shot[1]), pixel_size=pixel_size)
+    
+    def _runsDirectory(self):
+        """Directory of the run archives, in the qudi data directory."""
+        return os.path.join(get_default_data_dir(), "AbsorptionGUI", "runs")
+    
+    def _archiveShot(self, image_data):
+        """Appends the images of a shot to the archive of the current acquisition, created at the
+        first shot in the runs directory."""
+        shot = np.asarray(image_data)
+        scanning = self.scan_type == "frequency scan"
+        if self.recording_archive is None:
+            path = os.path.join(self._runsDirectory(), time.strftime("%Y%m%d-%H%M-%S"))
+            self.recording_archive = RunArchive(path, 'w', shot.shape, shot.dtype,
+                                                parameter_name="detuning (kHz)" if scanning else "")
+            logging.info(f"UI : Archiving shots to {path}")
+            # Every archive starts at the first point of the scan
+            self._scan_point = 0
+        # The scanned parameter is the detuning of the frequency scan point, centred as in the
+        # analysis window
+        parameter = np.nan
+        if scanning:
+            parameter = (self._scan_point - self._scan_num_steps / 2) * self._scan_frequency_step
+            self._scan_point += 1
+        self.recording_archive.append(shot, parameter=parameter, camera=str(self.camera_index),
+                                      shot_number=self._number_frame)
+    
+    def _closeRecordingArchive(self):
+        archive, self.recording_archive = self.recording_archive, None
+        if archive is not None:
+            archive.close()
+    
     ############################################################################
     ####                                                                    ####
     ####                  CAMERA & INTERFACE SETTINGS                       ####
@@ -286,6 +392,17 @@ class MainWindow(QMainWindow):
         self.multipleAcquisitions = False 
         self._number_frame = 0
         
+        # Archiving the shots of the acquisition
+        self.recording_archive = None
+        self._pending_worker = None  # capture worker started once the previous one has ended
+        self._scan_point = 0
+        self._scan_frequency_step = 0.  # in kHz
+        self._scan_num_steps = 0
+        self.ui.checkBox_archive = QCheckBox(self.ui.centralwidget)
+        self.ui.checkBox_archive.setChecked(False)
+        self.ui.checkBox_archive.setText("Archive shots")
+        self.ui.DisplaySettings.addWidget(self.ui.checkBox_archive)
+        
         # Changing max number of freq steps
         self.ui.spinBox_N_at_freq_scan.setMaximum(int(1e6))
         
@@ -411,6 +528,9 @@ class MainWindow(QMainWindow):
         image_data = self.camera.startAcquisition(N_IMAGES=N_IMAGES)
         if image_data is not None:
             self._number_frame += 1
+            if self.ui.checkBox_archive.isChecked():
+                self._archiveShot(image_data)
+            self.browsing_run = False
             self.refreshImage(image_data[0], image_data[1])
         return None
      
@@ -427,16 +547,37 @@ class MainWindow(QMainWindow):
         self.ui.CameraSettings.setEnabled(False)
         
         # Creating the capture thread
-        self.worker_thread = CameraWorker(self)
-        self.worker_thread.start()
+        worker = CameraWorker(self)
+        if self.worker_thread.isRunning():
+            # The previous worker is still in its blocking camera call and closes its archive when
+            # it ends: start the new one after it, without blocking the interface
+            self._pending_worker = worker
+            self.worker_thread.finished.connect(self._startPendingWorker)
+            if self.worker_thread.isFinished():
+                self._startPendingWorker()
+        else:
+            self.worker_thread = worker
+            self.worker_thread.start()
+    
+    def _startPendingWorker(self):
+        """Starts the capture worker waiting for the previous one, unless it was stopped meanwhile."""
+        worker, self._pending_worker = self._pending_worker, None
+        if worker is not None:
+            self.worker_thread = worker
+            self.worker_thread.start()
         
     def stop_acquisition(self) -> None:
+        self._pending_worker = None
         self.worker_thread.requestInterruption()
         self.camera.stopAcquisition.set()
         self.worker_thread.wait(1000)
         self.worker_thread.quit()
         self.ui.pushButton_stop_acq.setEnabled(False)
         self.ui.pushButton_start_acq.setEnabled(True)
+        # The worker may still be archiving its last shot: close the archive once it has ended
+        self.worker_thread.finished.connect(self._closeRecordingArchive, Qt.DirectConnection)
+        if not self.worker_thread.isRunning():
+            self._closeRecordingArchive()
         
         # Enabling settings again
         self.ui.comboBox_camchoice.setEnabled(True)
@@ -466,6 +607,23 @@ class MainWindow(QMainWindow):
         
         self.ui.AnalysisWidget = pg.GraphicsLayoutWidget()
         
+        # Model of the fitted cloud, next to the fit type
+        self.ui.fitModelComboBox = QComboBox(self.ui.fitTypeComboBox.parentWidget())
+        for model in PROFILE_MODELS:
+            self.ui.fitModelComboBox.addItem(model.replace("_", "-").capitalize(), model)
+        self.ui.fitModelComboBox.setCurrentIndex(
+            self.ui.fitModelComboBox.findData(self.profile_fitter.model))
+        self.ui.fitModelComboBox.setToolTip("Cloud model of the fits. Lorentzian only applies to the 1D fits.")
+        layout = self.ui.fitTypeComboBox.parentWidget().layout()
+        index = layout.indexOf(self.ui.fitTypeComboBox)
+        if isinstance(layout, QBoxLayout) and index >= 0:
+            layout.insertWidget(index + 1, self.ui.fitModelComboBox)
+        elif isinstance(layout, QGridLayout) and index >= 0:
+            row, column, _, _ = layout.getItemPosition(index)
+            layout.addWidget(self.ui.fitModelComboBox, row, column + 1)
+        else:
+            layout.addWidget(self.ui.fitModelComboBox)
+        
         self.changeFitType()
         
         self.fitPanel_connectbuttons()
@@ -475,6 +633,8 @@ class MainWindow(QMainWindow):
     def fitPanel_connectbuttons(self):
         """ Connects buttons to functions for fit panel. """
         self.ui.fitTypeComboBox.currentIndexChanged.connect(self.changeFitType)
+        self.ui.fitModelComboBox.currentIndexChanged.connect(
+            lambda: self.setFitModel(self.ui.fitModelComboBox.currentData()))
         self.display.roi.sigRegionChanged.connect(self.refreshFitPanel)
         self.newImage_signal.connect(self.refreshFitPanel)
     
@@ -493,44 +653,75 @@ class MainWindow(QMainWindow):
         """
         self.fit_type = self.getFitType()
         self.ui.AnalysisWidget.clear()
-        if self.fit_type == "1Dx" or self.fit_type == "1Dy":  # A single plot for x or y
-            pass
-            """self.fit_main_plot = self.ui.AnalysisWidget.addPlot(row = 1, col = 1)
-            roicoords = self.display.roi_getcoords()
-            self.fit_xvals = np.arange(roicoords[0], roicoords[1])
-            self.fit_yvals = np.sum(self.fit_data, axis = 1)
-            self.fit_main_plot.plot(self.fit_xvals, self.fit_yvals)"""
-        
-        if self.fit_type == "1Dxy":  # We need to have 2 plots, one for x and one for y
-            pass # TBC...
-        
-        elif self.fit_type == "2D":  # If it is a 2D fit, we need to show the image
-            pass
-            """self.fit_data_img = pg.ImageItem(self.fit_data)
-            self.fit_main_plot = self.ui.AnalysisWidget.addPlot(row = 1, col = 1)
-            self.fit_main_plot.addItem(self.fit_data_img)"""
+        self.profile_fitter.reset()
+        self.refreshFitPanel()
     
     def refreshFitPanel(self):
-        """ Updates data for fit panel """
-        self.fit_data = self.display.roi_getSlicedImg()
+        """ Updates data for fit panel. In the 1D fit types, the integrated profiles of the ROI are
+        read from the cached row and column sums and fitted on every new image or ROI move. """
         roicoords = self.display.roi_getcoords()
-        self.fit_xvals = np.arange(roicoords[0], roicoords[1])
-        self.fit_yvals = np.sum(self.fit_data, axis = 1)
-
+        x1, x2, y1, y2 = self.profile_sums.clip(roicoords)
+        self.fit_xvals = np.arange(x1, x2)
+        self.fit_yvals = self.profile_sums.profile_x(roicoords)
+        if self.noImage or self.fit_type == "2D":
+            return
+        self.fit_results = self.profile_fitter.fit(self.profile_sums, roicoords, self.fit_type)
+        self.ui.textBrowser_fit.setText(self.formatProfileFits(self.fit_results))
+
+    def formatProfileFits(self, fits):
+        """Formats the 1D fits for the fit text browser: center, width and atom number per axis."""
+        pixel_size = float(self.ui.spinBox_pixelsize.value())
+        lines = []
+        for axis, fit in fits.items():
+            if not fit.success:
+                lines.append(f"{axis} profile: fit failed")
+                continue
+            lines.append(f"{axis} profile:\n"
+                         f"center = {fit.center:.2f} [pxls]\n"
+                         f"width = {fit.width:.2f} [pxls] = {pixel_size * fit.width:.2f} [µm]\n"
+                         f"N = {fit.atom_number:.3e}")
+        return "\n\n".join(lines)
+
+    def setFitModel(self, model):
+        """Changes the cloud model of the fits.
 
+        Args:
+            model (str): "gaussian", "thomas_fermi" or "bimodal", or "lorentzian" for the 1D fits.
+        """
+        self.profile_fitter.model = model
+        if model != "lorentzian":
+            self.cloud_fitter.model = model
+        self.refreshFitPanel()
+
+    def formatFitParameters(self, parameters, dimensions):
+        """Formats fitted parameters for the fit text browser, widths also in µm."""
+        pixel_size = float(self.ui.spinBox_pixelsize.value())
+        lines = []
+        for name, value in zip(model_parameters(self.cloud_fitter.model, dimensions), parameters):
+            if name.startswith(("sigma", "radius")):
+                lines.append(f"{name} = {value:.2f} [pxls] = {pixel_size * value:.2f} [µm]")
+            else:
+                lines.append(f"{name} = {value:.2f}")
+        if self.cloud_fitter.model == "bimodal":
+            fraction = condensate_fraction("bimodal", parameters, dimensions)
+            lines.append(f"condensate fraction = {fraction:.3f}")
+        return "\n".join(lines)
 
     def fit_image(self):
         self.fit_view.clear()
         
-        if self.fit_type == "2D":
-            self.fit_data, self.parameters = self.analysis.fit_cloud_profile_gaussian2D(self.display.roi_getcoords())
-            self.ui.textBrowser_fit.clear()
-            self.ui.textBrowser_fit.setText(
-                f"A = {self.parameters[0]:.2f} \n"
-                f"x_0 = {self.parameters[1]:.2f}  | y_0 = {self.parameters[2]:.2f} \n"
-                f"sigma_x = {self.parameters[3]:.2f}    | sigma_y = {self.parameters[4]:.2f} [pxls] \n"
-                f"sigma_x = {float(self.ui.spinBox_pixelsize.value()) * self.parameters[3]:.2f}    | sigma_y = {float(self.ui.spinBox_pixelsize.value()) * self.parameters[4]:.2f} [µm]"
-            )
+        if self.fit_type != "2D":
+            self.refreshFitPanel()
+            return
+
+        x1, x2, y1, y2 = self.display.roi_getcoords()
+        self.fit_results = self.cloud_fitter.fit(self.images["OD"][x1:x2, y1:y2], self.fit_type,
+                                                 origin=(x1, y1))
+        self.ui.textBrowser_fit.clear()
+        self.parameters = self.fit_results["2D"].parameters
+        x, y = np.mgrid[x1:x2, y1:y2]
+        self.fit_data = evaluate_model(self.cloud_fitter.model, self.parameters, x, y)
+        self.ui.textBrowser_fit.setText(self.formatFitParameters(self.parameters, 2))
 
         # Appliquer la colormap personnalisée
         cmap = np.zeros((256, 3))  # Créer une colormap personnalisée (black, red, green, blue, white)
@@ -579,9 +770,12 @@ class MainWindow(QMainWindow):
         Méthode qui effectue le scan de fréquence et ouvre une fenêtre avec les résultats.
         """
         self.scan_type = "frequency scan"
+        self._scan_point = 0
         # Exemple : génération de données fictives
         frequency_steps = self.ui.doubleSpinBox_freq_scan.value()  # par exemple, 3.5 kHz entre chaque étape
         num_steps = self.ui.spinBox_N_at_freq_scan.value()  # par exemple, 31 étapes
+        self._scan_frequency_step = frequency_steps
+        self._scan_num_steps = num_steps
           # Simuler des données
 
         # Titre du graphique
@@ -21,18 +21,22 @@ class AbsorptionGui(GuiBase):
         connect:
             absorption_logic:
             camera_logic:
+            batch_logic:
     """
 
     _camera_logic = Connector(name='camera_logic', interface='GuppyLogic')
     _absorption_logic = Connector(name='absorption_logic', interface='AbsorptionLogic')
+    _batch_logic = Connector(name='batch_logic', interface='BatchProcessingLogic', optional=True)
 
     sigStartStopVideoToggled = QtCore.Signal(bool)
     sigCaptureFrameTriggered = QtCore.Signal()
+    sigProcessShot = QtCore.Signal(object, object, object, object)  # atoms, bright, dark, norm. ROI
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._mw = None
         self._settings_dialog = None
+        self._images = dict()
 
     def on_activate(self):
         """ Initializes all needed UI files and establishes the connectors.
@@ -57,6 +61,43 @@ class AbsorptionGui(GuiBase):
         # self._update_frame(logic.last_frame)
         self._keep_former_settings()
 
+        # connect the averaging panel to the logic
+        averaging_panel = self._mw.averaging_panel
+        averaging_panel.setChecked(logic.averaging_enabled)
+        averaging_panel.mode_combobox.setCurrentIndex(
+            averaging_panel.mode_combobox.findData(logic.averaging_mode)
+        )
+        averaging_panel.window_spinbox.setValue(logic.averaging_window)
+        averaging_panel.alpha_doublespinbox.setValue(logic.averaging_alpha)
+        averaging_panel.toggled.connect(self._update_averaging)
+        averaging_panel.mode_combobox.currentIndexChanged.connect(self._update_averaging)
+        averaging_panel.window_spinbox.editingFinished.connect(self._update_averaging)
+        averaging_panel.alpha_doublespinbox.editingFinished.connect(self._update_averaging)
+        averaging_panel.reset_pushbutton.clicked.connect(logic.reset_averaging)
+        logic.sigAveragesUpdated.connect(self._update_averages, QtCore.Qt.QueuedConnection)
+
+        # process every shot of the camera and display the selected image
+        self._images = dict()
+        self.sigProcessShot.connect(logic.process_shot, QtCore.Qt.QueuedConnection)
+        self._camera_logic().sigShotChanged.connect(self._process_shot, QtCore.Qt.QueuedConnection)
+        logic.sigImagesUpdated.connect(self._update_images, QtCore.Qt.QueuedConnection)
+        self._mw.image_panel.toolbar.image_source_selector.currentIndexChanged.connect(
+            self._show_selected_image
+        )
+
+        # connect the batch processing panel to its logic
+        batch_logic = self._batch_logic()
+        batch_panel = self._mw.batch_processing_panel
+        batch_panel.setEnabled(batch_logic is not None)
+        if batch_logic is not None:
+            batch_panel.set_running(batch_logic.module_state() == 'locked')
+            batch_panel.start_pushbutton.clicked.connect(self._start_batch_clicked)
+            batch_panel.cancel_pushbutton.clicked.connect(batch_logic.cancel_batch)
+            batch_logic.sigResultReady.connect(batch_panel.add_result, QtCore.Qt.QueuedConnection)
+            batch_logic.sigProgressChanged.connect(batch_panel.set_progress,
+                                                   QtCore.Qt.QueuedConnection)
+            batch_logic.sigBatchFinished.connect(self._batch_finished, QtCore.Qt.QueuedConnection)
+
         # # connect main window actions
         # self._mw.action_start_video.triggered[bool].connect(self._start_video_clicked)
         # self._mw.action_capture_frame.triggered.connect(self._capture_frame_clicked)
@@ -77,6 +118,27 @@ class AbsorptionGui(GuiBase):
         # disconnect all signals
         self.sigCaptureFrameTriggered.disconnect()
         self.sigStartStopVideoToggled.disconnect()
+        self._mw.image_panel.toolbar.image_source_selector.currentIndexChanged.disconnect(
+            self._show_selected_image
+        )
+        logic.sigImagesUpdated.disconnect(self._update_images)
+        self._camera_logic().sigShotChanged.disconnect(self._process_shot)
+        self.sigProcessShot.disconnect()
+        logic.sigAveragesUpdated.disconnect(self._update_averages)
+        averaging_panel = self._mw.averaging_panel
+        averaging_panel.toggled.disconnect(self._update_averaging)
+        averaging_panel.mode_combobox.currentIndexChanged.disconnect(self._update_averaging)
+        averaging_panel.window_spinbox.editingFinished.disconnect(self._update_averaging)
+        averaging_panel.alpha_doublespinbox.editingFinished.disconnect(self._update_averaging)
+        averaging_panel.reset_pushbutton.clicked.disconnect(logic.reset_averaging)
+        batch_logic = self._batch_logic()
+        if batch_logic is not None:
+            batch_panel = self._mw.batch_processing_panel
+            batch_logic.sigBatchFinished.disconnect(self._batch_finished)
+            batch_logic.sigProgressChanged.disconnect(batch_panel.set_progress)
+            batch_logic.sigResultReady.disconnect(batch_panel.add_result)
+            batch_panel.cancel_pushbutton.clicked.disconnect(batch_logic.cancel_batch)
+            batch_panel.start_pushbutton.clicked.disconnect(self._start_batch_clicked)
         # logic.sigAcquisitionFinished.disconnect(self._acquisition_finished)
         # logic.sigFrameChanged.disconnect(self._update_frame)
         # self._mw.action_save_frame.triggered.disconnect()
@@ -104,6 +166,56 @@ class AbsorptionGui(GuiBase):
         # self._settings_dialog.exposure_spinbox.setValue(logic.get_exposure())
         # self._settings_dialog.gain_spinbox.setValue(logic.get_gain())
 
+    def _update_averaging(self):
+        """ Send the averaging settings of the panel to the logic. """
+        averaging_panel = self._mw.averaging_panel
+        self._absorption_logic().configure_averaging(
+            enabled=averaging_panel.isChecked(),
+            mode=averaging_panel.mode,
+            window=averaging_panel.window_spinbox.value(),
+            alpha=averaging_panel.alpha_doublespinbox.value()
+        )
+
+    def _process_shot(self, frames, timestamps):
+        """ Send the atoms, bright and dark frames of a camera shot to the logic. """
+        imageview = self._mw.image_panel.imageview
+        normalization_roi = imageview.normalization_getcoords() \
+            if imageview.isNormalizationEnabled else None
+        self.sigProcessShot.emit(frames[0], frames[1], frames[2], normalization_roi)
+
+    def _update_images(self, images):
+        self._images.update(images)
+        self._show_selected_image()
+
+    def _update_averages(self, averages):
+        self._mw.averaging_panel.set_shot_count(averages['shots'])
+        self._images['OD_mean'] = averages['OD']
+        self._images['OD_noise'] = averages['OD_noise']
+        self._show_selected_image()
+
+    def _show_selected_image(self):
+        """ Display the image chosen in the image source selector, once it has been computed. """
+        image = self._images.get(self._mw.image_panel.toolbar.image_source_selector.currentData())
+        if image is not None:
+            self._mw.image_panel.imageview.setImage(image)
+
+    def _start_batch_clicked(self):
+        """ Reprocess the selected directory with the ROI and normalization zone of the display. """
+        batch_panel = self._mw.batch_processing_panel
+        imageview = self._mw.image_panel.imageview
+        normalization_roi = imageview.normalization_getcoords() \
+            if imageview.isNormalizationEnabled else None
+        started = self._batch_logic().start_batch(batch_panel.directory_lineedit.text(),
+                                                  roi=imageview.roi_getcoords(),
+                                                  normalization_roi=normalization_roi,
+                                                  fit=batch_panel.fit_checkbox.isChecked())
+        batch_panel.set_running(started)
+
+    def _batch_finished(self, file_path):
+        self._mw.batch_processing_panel.set_running(False)
+        if file_path:
+            self.log.info(f'Batch processing results saved in "{file_path}".')
+
     def _capture_frame_clicked(self):
         # self._mw.action_start_video.setDisabled(True)
         # self._mw.action_capture_frame.setDisabled(True)
@@ -148,8 +260,7 @@ class AbsorptionGui(GuiBase):
         # if data is not None:
         #     file_path, _, _ = ds.save_data(data, metadata=parameters, nametag=tag,
         #                                timestamp=timestamp, column_headers='Image (columns is X, rows is Y)')
-        #     figure = logic.draw_2d_image(data, cbar_range=None)
-        #     ds.save_thumbnail(figure, file_path=file_path.rsplit('.', 1)[0])
+        #     logic.save_thumbnail(data, file_path.rsplit('.', 1)[0])
         # else:
         #     self.log.error('No Data acquired. Nothing to save.')
         # return
@@ -21,12 +21,10 @@ If not, see <https://www.gnu.org/licenses/>.
 
 import os
 from PySide2 import QtCore, QtWidgets, QtGui
-import datetime
 
 from qudi.core.module import GuiBase
 from qudi.core.connector import Connector
 from qudi.util.widgets.plotting.image_widget import ImageWidget
-from qudi.util.datastorage import TextDataStorage
 from qudi.util.paths import get_artwork_dir
 from qudi.gui.absorption.camera_settings_dialog import CameraSettingsDialog
 
@@ -66,8 +64,16 @@ class CameraMainWindow(QtWidgets.QMainWindow):
         self.action_capture_frame = QtWidgets.QAction('Capture Frame')
         self.action_capture_frame.setCheckable(True)
         toolbar.addAction(self.action_capture_frame)
+        self.action_record = QtWidgets.QAction('Record')
+        self.action_record.setCheckable(True)
+        self.action_record.setVisible(False)
+        toolbar.addAction(self.action_record)
         self.addToolBar(QtCore.Qt.TopToolBarArea, toolbar)
 
+        # Create status bar showing the recording status
+        self.recording_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.recording_label)
+
         # Create central widget
         self.image_widget = ImageWidget()
         # FIXME: The camera hardware is currently transposing the image leading to this dirty hack
@@ -84,10 +90,13 @@ class CameraGui(GuiBase):
         module.Class: 'camera.cameragui.CameraGui'
         connect:
             camera_logic: camera_logic
+            recording_logic: recording_logic  # optional
 
     """
 
     _camera_logic = Connector(name='camera_logic', interface='GuppyLogic')
+    _recording_logic = Connector(name='recording_logic', interface='RecordingLogic',
+                                 optional=True)
 
     sigStartStopVideoToggled = QtCore.Signal(bool)
     sigCaptureFrameTriggered = QtCore.Signal()
@@ -131,6 +140,16 @@ class CameraGui(GuiBase):
         # connect GUI signals to logic slots
         self.sigStartStopVideoToggled.connect(logic.toggle_video)
         self.sigCaptureFrameTriggered.connect(logic.capture_frame)
+        recording_logic = self._recording_logic()
+        if recording_logic is not None:
+            self._mw.action_record.setVisible(True)
+            self._mw.action_record.setChecked(recording_logic.recording)
+            self._mw.action_record.triggered[bool].connect(self._record_clicked)
+            recording_logic.sigRecordingChanged.connect(self._recording_changed,
+                                                        QtCore.Qt.QueuedConnection)
+            recording_logic.sigStatusChanged.connect(self._update_recording_status,
+                                                     QtCore.Qt.QueuedConnection)
+            self._update_recording_status(recording_logic.status)
         self.show()
 
     def on_deactivate(self):
@@ -138,6 +157,11 @@ class CameraGui(GuiBase):
         """
         logic = self._camera_logic()
         # disconnect all signals
+        recording_logic = self._recording_logic()
+        if recording_logic is not None:
+            recording_logic.sigStatusChanged.disconnect(self._update_recording_status)
+            recording_logic.sigRecordingChanged.disconnect(self._recording_changed)
+            self._mw.action_record.triggered.disconnect()
         self.sigCaptureFrameTriggered.disconnect()
         self.sigStartStopVideoToggled.disconnect()
         logic.sigAcquisitionFinished.disconnect(self._acquisition_finished)
@@ -189,6 +213,30 @@ class CameraGui(GuiBase):
             self._mw.action_start_video.setText('Start Video')
         self.sigStartStopVideoToggled.emit(checked)
 
+    def _record_clicked(self, checked):
+        recording_logic = self._recording_logic()
+        if checked:
+            if not recording_logic.start_recording():
+                self._mw.action_record.setChecked(False)
+        else:
+            recording_logic.stop_recording()
+
+    def _recording_changed(self, recording, file_path):
+        self._mw.action_record.setChecked(recording)
+        self._mw.action_record.setText('Stop Recording' if recording else 'Record')
+        if not recording and file_path:
+            self.log.info(f'Recording saved to "{file_path}".')
+
+    def _update_recording_status(self, status):
+        if not status['recording'] and status['written'] == 0:
+            self._mw.recording_label.setText('')
+            return
+        self._mw.recording_label.setText(
+            f"Recorded {status['written']} (dropped {status['dropped']}) | "
+            f"queue {status['queue_depth']}/{status['queue_size']} | "
+            f"{status['throughput']:.1f} MB/s | lag {1e3 * status['lag']:.0f} ms"
+        )
+
     def _update_frame(self, frame_data):
         """
         """
@@ -196,20 +244,14 @@ class CameraGui(GuiBase):
 
     def _save_frame(self):
         logic = self._camera_logic()
-        ds = TextDataStorage(root_dir=self.module_default_data_dir)
-        timestamp = datetime.datetime.now()
-        tag = logic.create_tag(timestamp)
-
-        parameters = {}
-        parameters['gain'] = logic.get_gain()
-        parameters['exposure'] = logic.get_exposure()
-
         data = logic.last_frame
-        if data is not None:
-            file_path, _, _ = ds.save_data(data, metadata=parameters, nametag=tag,
-                                       timestamp=timestamp, column_headers='Image (columns is X, rows is Y)')
-            figure = logic.draw_2d_image(data, cbar_range=None)
-            ds.save_thumbnail(figure, file_path=file_path.rsplit('.', 1)[0])
-        else:
+        if data is None:
             self.log.error('No Data acquired. Nothing to save.')
-        return
+            return
+        # Frames are appended in binary to the file of the current run
+        file_path, index = logic.save_frame(data)
+        if file_path is None:
+            return
+        # The thumbnail is drawn in the background, saving does not wait for it
+        logic.save_thumbnail(data, f'{file_path.rsplit(".", 1)[0]}_{index:06d}')
+        self.log.info(f'Frame {index} saved to "{file_path}".')
@@ -16,4 +16,54 @@ class AveragingPanel(QtWidgets.QGroupBox):
         super().__init__( *args, **kwargs)
         self.setTitle("Averaging")
         self.setCheckable(True)
-        self.setChecked(False)
\ No newline at end of file
+        self.setChecked(False)
+        
+        layout = QtWidgets.QGridLayout()
+        
+        mode_label = QtWidgets.QLabel("Mode")
+        self.mode_combobox = QtWidgets.QComboBox()
+        self.mode_combobox.addItem("Cumulative", "cumulative")
+        self.mode_combobox.addItem("Sliding window", "window")
+        self.mode_combobox.addItem("Exponential", "exponential")
+        layout.addWidget(mode_label, 0, 0)
+        layout.addWidget(self.mode_combobox, 0, 1)
+        
+        window_label = QtWidgets.QLabel("Window [shots]")
+        self.window_spinbox = QtWidgets.QSpinBox()
+        self.window_spinbox.setMinimum(1)
+        self.window_spinbox.setMaximum(1000)
+        self.window_spinbox.setValue(10)
+        layout.addWidget(window_label, 1, 0)
+        layout.addWidget(self.window_spinbox, 1, 1)
+        
+        alpha_label = QtWidgets.QLabel("Weight of new shot")
+        self.alpha_doublespinbox = QtWidgets.QDoubleSpinBox()
+        self.alpha_doublespinbox.setDecimals(3)
+        self.alpha_doublespinbox.setMinimum(0.001)
+        self.alpha_doublespinbox.setMaximum(1)
+        self.alpha_doublespinbox.setSingleStep(0.05)
+        self.alpha_doublespinbox.setValue(0.1)
+        layout.addWidget(alpha_label, 2, 0)
+        layout.addWidget(self.alpha_doublespinbox, 2, 1)
+        
+        self.shot_count_label = QtWidgets.QLabel("Shots averaged: 0")
+        layout.addWidget(self.shot_count_label, 3, 0)
+        self.reset_pushbutton = QtWidgets.QPushButton("Reset")
+        layout.addWidget(self.reset_pushbutton, 3, 1)
+        
+        self.setLayout(layout)
+        
+        self.mode_combobox.currentIndexChanged.connect(self._update_enabled_settings)
+        self._update_enabled_settings()
+    
+    @property
+    def mode(self):
+        return self.mode_combobox.currentData()
+    
+    def set_shot_count(self, count):
+        self.shot_count_label.setText(f"Shots averaged: {count}")
+    
+    def _update_enabled_settings(self):
+        # Only the settings of the selected mode can be edited
+        self.window_spinbox.setEnabled(self.mode == "window")
+        self.alpha_doublespinbox.setEnabled(self.mode == "exponential")
@@ -17,4 +17,69 @@ class BatchProcessingPanel(QtWidgets.QGroupBox):
         self.setTitle("Batch Processing")
         self.setCheckable(True)
         self.setChecked(False)
-        
\ No newline at end of file
+        
+        
+        layout = QtWidgets.QGridLayout()
+        
+        directory_label = QtWidgets.QLabel("Shots directory")
+        self.directory_lineedit = QtWidgets.QLineEdit()
+        self.browse_pushbutton = QtWidgets.QPushButton("Browse...")
+        layout.addWidget(directory_label, 0, 0)
+        layout.addWidget(self.directory_lineedit, 0, 1)
+        layout.addWidget(self.browse_pushbutton, 0, 2)
+        
+        self.fit_checkbox = QtWidgets.QCheckBox("Fit 2D Gaussian")
+        self.fit_checkbox.setChecked(True)
+        layout.addWidget(self.fit_checkbox, 1, 0)
+        self.start_pushbutton = QtWidgets.QPushButton("Start")
+        self.cancel_pushbutton = QtWidgets.QPushButton("Cancel")
+        self.cancel_pushbutton.setEnabled(False)
+        layout.addWidget(self.start_pushbutton, 1, 1)
+        layout.addWidget(self.cancel_pushbutton, 1, 2)
+        
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.throughput_label = QtWidgets.QLabel("0.0 shots/s")
+        layout.addWidget(self.progress_bar, 2, 0, 1, 2)
+        layout.addWidget(self.throughput_label, 2, 2)
+        
+        self.results_table = QtWidgets.QTableWidget(0, 5)
+        self.results_table.setHorizontalHeaderLabels(
+            ["File", "Atom number", "Center (x, y)", "Sigma (x, y)", "Fit"]
+        )
+        self.results_table.horizontalHeader().setStretchLastSection(True)
+        self.results_table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.results_table, 3, 0, 1, 3)
+        
+        self.setLayout(layout)
+        
+        self.browse_pushbutton.clicked.connect(self._browse_directory)
+    
+    def _browse_directory(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, "Shots directory",
+                                                               self.directory_lineedit.text())
+        if directory:
+            self.directory_lineedit.setText(directory)
+    
+    def set_running(self, running):
+        self.start_pushbutton.setEnabled(not running)
+        self.cancel_pushbutton.setEnabled(running)
+        self.browse_pushbutton.setEnabled(not running)
+        if running:
+            self.results_table.setRowCount(0)
+            self.progress_bar.setValue(0)
+    
+    def set_progress(self, done, total, throughput):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.throughput_label.setText(f"{throughput:.1f} shots/s")
+    
+    def add_result(self, name, result):
+        row = self.results_table.rowCount()
+        self.results_table.insertRow(row)
+        cells = (name,
+                 f"{result['atom_number']:.3e}",
+                 f"({result['center_x']:.1f}, {result['center_y']:.1f})",
+                 f"({result['sigma_x']:.1f}, {result['sigma_y']:.1f})",
+                 "ok" if result['fit_success'] else "-")
+        for column, text in enumerate(cells):
+            self.results_table.setItem(row, column, QtWidgets.QTableWidgetItem(text))
@@ -49,9 +49,14 @@ class ToolBar(QtWidgets.QWidget):
 class ImageSourceComboBox(QtWidgets.QComboBox):
     def __init__(self):
         super().__init__()
-        image_sources = ["Optical Density", "Number of Atoms", "Bright Image", "Dark Image"]
-        for image_source in image_sources:
-            self.addItem(image_source)
+        image_sources = [("Optical Density", "OD"),
+                         ("Number of Atoms", "Natoms"),
+                         ("Bright Image", "bright"),
+                         ("Dark Image", "dark"),
+                         ("Averaged Optical Density", "OD_mean"),
+                         ("Optical Density Noise", "OD_noise")]
+        for image_source, key in image_sources:
+            self.addItem(image_source, key)
 
 class Crosshair(pg.TargetItem):
     isMoving = QtCore.Signal(bool)
@@ -193,12 +198,21 @@ class ImageView(pg.GraphicsLayoutWidget):
     def roi_getcoords(self) -> tuple:
         """ Returns the coordinates of the ROI as a list
         [x1, x2, y1, y2] coordinates of the two points defining the ROI rectangle"""
-        selected = self.roi_getSlicedImg()
-        x1, y1 = self.roi.pos()     # Position (in px) of bottom left of ROI
-        size = np.shape(selected)   # Size (in px) of ROI
-        dx, dy = size[0], size[1]
-        return [int(x1), int(x1 + dx), int(y1), int(y1 + dy)]
+        # Last row and column excluded, as in roi_getSlicedImg
+        return self._region_coords(self.roi, excluded_edge=1)
     
+    def _region_coords(self, roi, excluded_edge=0) -> list:
+        """ Returns the [x1, x2, y1, y2] pixel coordinates covered by an unrotated ROI, clipped to
+        the image. Computed from the ROI position and size only, without extracting the pixels.
+        """
+        x1, y1 = roi.pos()     # Position (in px) of bottom left of the ROI
+        dx, dy = roi.size()
+        x1, y1 = max(int(x1), 0), max(int(y1), 0)
+        rows, columns = self.image.shape[:2]
+        x2 = min(max(x1 + int(round(dx)) - excluded_edge, x1), rows)
+        y2 = min(max(y1 + int(round(dy)) - excluded_edge, y1), columns)
+        return [x1, x2, y1, y2]
+
     def roi_setcoords(self, coords: list):
         """Sets the coordinates of the ROI to the coords list inputted.
 
@@ -264,11 +278,7 @@ class ImageView(pg.GraphicsLayoutWidget):
     def normalization_getcoords(self) -> tuple:
         """ Returns the coordinates of the normalization zone as a list
         [x1, x2, y1, y2] coordinates of the two points defining the ROI rectangle"""
-        selected = self.norm.getArrayRegion(self.image, self.imageItem) # retrieving selected pixel values
-        x1, y1 = self.norm.pos()     # Position (in px) of bottom left of norm zone
-        size = np.shape(selected)   # Size (in px) of norm zone
-        dx, dy = size[0], size[1]
-        return [int(x1), int(x1 + dx), int(y1), int(y1 + dy)]
+        return self._region_coords(self.norm)
 
     def normalization_setcoords(self, coords: list):
         """Sets the coordinates of the normalization region to the coords list inputted.
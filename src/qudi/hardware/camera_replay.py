@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['CameraReplay']
+
+import os
+import time
+import threading
+import numpy as np
+from PySide2 import QtCore
+from qudi.interface.camera_interface import CameraInterface
+from qudi.core.configoption import ConfigOption
+from qudi.hardware.frame_ring_buffer import FrameRingBuffer
+from qudi.storage.frame_storage import load_frames
+from qudi.storage.run_archive import RunArchive
+
+
+class CameraReplay(CameraInterface):
+    """ Camera module replaying previously recorded frames from disk, e.g. to profile the logic and
+    the GUI under realistic data and rates on a machine without Vimba.
+
+    A recording is a .npy file holding a (frames, rows, columns) stack, a run file written by
+    FrameStorage (.h5 or .npz), a RunArchive directory (or its frames.dat), or a directory of such
+    files replayed in alphabetical order. The frames of the shots of a run file or an archive are
+    replayed one after the other. .npy files and archives are memory-mapped, so only the replayed
+    frames are read from disk. Hardware timestamps in ns can be stored next to a .npy stack as
+    <name>_timestamps.npy, run files and archives carry their own; they set the replay timing,
+    scaled by playback_speed. Without timestamps frames are replayed at frame_rate. A
+    playback_speed of 0 replays as fast as possible.
+
+    A recording that is not looped ends like a stopped acquisition: the camera is ready again and
+    sigNewFrame is emitted once more, so that the logic collects the last frames and stops.
+
+    Example config for copy-paste:
+
+    camera_replay:
+        module.Class: 'camera_replay.CameraReplay'
+        options:
+            recording: 'C:/Data/2024/run_042'
+            playback_speed: 1
+            frame_rate: 10
+            loop: True
+    """
+
+    sigNewFrame = QtCore.Signal()
+
+    _recording = ConfigOption('recording', missing='error')
+    _playback_speed = ConfigOption('playback_speed', 1.)
+    _frame_rate = ConfigOption('frame_rate', 10.)
+    _loop = ConfigOption('loop', True)
+    _frame_buffer_size = ConfigOption('frame_buffer_size', 16)
+    _exposure = ConfigOption('exposure', .1)
+    _gain = ConfigOption('gain', 1.)
+
+    _live = False
+    _acquiring = False
+
+    def on_activate(self):
+        """ Initialisation performed during activation of the module.
+        """
+        self._stacks = list()
+        self._timestamps = list()
+        if os.path.isdir(self._recording) and not self._is_archive(self._recording):
+            paths = sorted(os.path.join(self._recording, name)
+                           for name in os.listdir(self._recording)
+                           if self._is_recording(os.path.join(self._recording, name)))
+        else:
+            paths = [self._recording]
+        for path in paths:
+            stack, timestamps = self._load(path)
+            if len(stack) == 0:
+                continue
+            self._stacks.append(stack)
+            self._timestamps.append(timestamps)
+        if not self._stacks:
+            raise ValueError(f'No recorded frames found in "{self._recording}"')
+        shape = self._stacks[0].shape[1:]
+        if any(stack.shape[1:] != shape for stack in self._stacks):
+            raise ValueError('All the recorded frames must have the same shape.')
+
+        # Flat index of every replayed frame: (stack index, frame index)
+        self._index = [(i, j) for i, stack in enumerate(self._stacks) for j in range(len(stack))]
+        self._position = 0
+        self._frame = np.zeros(shape, dtype=self._stacks[0].dtype)
+        self._burst = None
+        self._burst_timestamps = None
+        self._frame_buffer = FrameRingBuffer(self._frame_buffer_size, shape,
+                                             dtype=self._stacks[0].dtype)
+        self._stream_thread = None
+        self._stop_stream = threading.Event()
+
+    def on_deactivate(self):
+        """ Deinitialisation performed during deactivation of the module.
+        """
+        self.stop_acquisition()
+        self._stacks = list()
+        self._timestamps = list()
+
+    @staticmethod
+    def _is_archive(path):
+        return os.path.isfile(os.path.join(path, 'archive.json'))
+
+    @classmethod
+    def _is_recording(cls, path):
+        if os.path.isdir(path):
+            return cls._is_archive(path)
+        if path.endswith('_timestamps.npy'):
+            return False
+        return path.endswith(('.npy', '.h5', '.hdf5', '.npz'))
+
+    @classmethod
+    def _load(cls, path):
+        """ Load the frames of a recording file or archive
+
+        @param str path: .npy stack, FrameStorage run file, RunArchive directory or frames.dat
+
+        @return tuple: (stack of shape (frames, rows, columns),
+                        timestamps in ns of the frames or None)
+        """
+        if os.path.basename(path) == 'frames.dat':
+            path = os.path.dirname(path)
+        if os.path.isdir(path):
+            archive = RunArchive(path, mode='r')
+            # Views of the memory map: the archive is read as the frames are replayed
+            entries = archive[:]
+            timestamps = np.array(archive.index['timestamp'])
+        elif path.endswith(('.h5', '.hdf5', '.npz')):
+            entries, metadata, _ = load_frames(path)
+            timestamps = metadata['timestamp']
+        else:
+            stack = np.load(path, mmap_mode='r')
+            if stack.ndim == 2:
+                stack = stack[np.newaxis]
+            timestamps_path = path[:-len('.npy')] + '_timestamps.npy'
+            if os.path.isfile(timestamps_path):
+                return stack, np.load(timestamps_path)
+            return stack, None
+        if entries.ndim < 3:
+            raise ValueError(f'No recorded frames found in "{path}"')
+        # Shots of several frames (atoms, bright, dark) are replayed frame by frame
+        frames_per_entry = int(np.prod(entries.shape[1:-2], dtype=np.int64))
+        stack = entries.reshape(-1, *entries.shape[-2:])
+        if len(timestamps) == 0 or np.isnan(timestamps).any():
+            return stack, None
+        # Entry timestamps are time.time() in s
+        timestamps = np.repeat(np.round(timestamps * 1e9).astype(np.int64), frames_per_entry)
+        return stack, timestamps
+
+    @property
+    def frame_count(self):
+        """ Number of recorded frames """
+        return len(self._index)
+
+    def _next_frame(self, out):
+        """ Copy the next recorded frame into out and move on
+
+        @return tuple: (timestamp in ns, delay in s to the next frame at the original timing), or
+                       None at the end of a recording that is not looped
+        """
+        if self._position >= len(self._index):
+            if not self._loop:
+                return None
+            self._position = 0
+        stack_index, frame_index = self._index[self._position]
+        self._position += 1
+        np.copyto(out, self._stacks[stack_index][frame_index])
+        timestamps = self._timestamps[stack_index]
+        if timestamps is None:
+            return time.time_ns(), 1 / self._frame_rate if self._frame_rate > 0 else 0
+        timestamp = int(timestamps[frame_index])
+        if frame_index + 1 < len(timestamps):
+            delay = (int(timestamps[frame_index + 1]) - timestamp) * 1e-9
+        else:
+            delay = 1 / self._frame_rate if self._frame_rate > 0 else 0
+        return timestamp, delay
+
+    def get_name(self):
+        """ Retrieve an identifier of the camera that the GUI can print
+
+        @return string: name for the camera
+        """
+        return f'Replay of {os.path.basename(os.path.normpath(self._recording))}'
+
+    def get_size(self):
+        """ Retrieve size of the image in pixel
+
+        @return tuple: Size (width, height)
+        """
+        return self._frame.shape[1], self._frame.shape[0]
+
+    def support_live_acquisition(self):
+        """ Return whether or not the camera can take care of live acquisition
+
+        @return bool: True if supported, False if not
+        """
+        return False
+
+    def start_live_acquisition(self):
+        """ Start a continuous acquisition
+
+        @return bool: Success ?
+        """
+        return False
+
+    def start_single_acquisition(self):
+        """ Replay the next recorded frame
+
+        @return bool: Success ?
+        """
+        if self._acquiring:
+            return False
+        if self._next_frame(self._frame) is None:
+            return False
+        self.sigNewFrame.emit()
+        return True
+
+    def start_burst_acquisition(self, frame_count=3):
+        """ Replay the next frame_count recorded frames as one burst
+
+        @param int frame_count: number of frames in the burst
+
+        @return bool: Success ?
+        """
+        if self._acquiring:
+            return False
+        shape = (frame_count, *self._frame.shape)
+        if self._burst is None or self._burst.shape != shape:
+            self._burst = np.zeros(shape, dtype=self._frame.dtype)
+            self._burst_timestamps = np.zeros(frame_count, dtype=np.int64)
+        for i in range(frame_count):
+            replayed = self._next_frame(self._burst[i])
+            if replayed is None:
+                return False
+            self._burst_timestamps[i] = replayed[0]
+        return True
+
+    def get_acquired_burst(self):
+        """ Return the frames of the last burst acquisition
+
+        @return tuple: (numpy array of shape (frame_count, rows, columns),
+                        numpy array of the frame_count hardware timestamps)
+        """
+        if self._burst is None:
+            return None, None
+        return self._burst.copy(), self._burst_timestamps.copy()
+
+    def start_trigged_acquisition(self):
+        """ Stream the recorded frames on a separate thread until stop_acquisition is called or the
+        end of a recording that is not looped is reached.
+
+        @return bool: Success ?
+        """
+        if self._acquiring:
+            return False
+        self._acquiring = True
+        self._frame_buffer.reset()
+        self._stop_stream.clear()
+        self._stream_thread = threading.Thread(target=self._stream_loop,
+                                               name='camera-replay-stream',
+                                               daemon=True)
+        self._stream_thread.start()
+        return True
+
+    def _stream_loop(self):
+        next_time = time.perf_counter()
+        while not self._stop_stream.is_set():
+            slot = self._frame_buffer.acquire_slot()
+            if slot is None:
+                # The consumer is too slow and the buffer drops new frames: skip this one
+                replayed = self._next_frame(self._frame)
+            else:
+                replayed = self._next_frame(slot)
+                if replayed is not None:
+                    self._frame_buffer.commit(replayed[0])
+                    self.sigNewFrame.emit()
+            if replayed is None:
+                break
+            if self._playback_speed > 0:
+                next_time += replayed[1] / self._playback_speed
+                self._stop_stream.wait(max(next_time - time.perf_counter(), 0))
+        self._acquiring = False
+        if not self._stop_stream.is_set():
+            # End of the recording: wake the logic up so that it sees the camera ready and stops
+            self.sigNewFrame.emit()
+
+    def get_buffered_frame(self, newest=False, copy=True, out=None):
+        """ Non-blocking access to the streamed frames.
+
+        @param bool newest: return the newest frame instead of the next unread frame
+        @param bool copy: return a copy of the frame, False for a view of the buffer slot that is
+                          only valid until the slot is overwritten
+        @param numpy.ndarray out: array to copy the frame into instead of a new array
+
+        @return tuple: (frame, sequence number, timestamp, receive time) or None if there is no
+                       unread frame
+        """
+        if newest:
+            if self._frame_buffer.unread_count == 0:
+                return None
+            return self._frame_buffer.get_newest(copy, out)
+        return self._frame_buffer.get_next(copy, out)
+
+    def get_dropped_frame_count(self):
+        """ Number of frames lost because the frame buffer was full
+
+        @return int: dropped frames since the last acquisition start
+        """
+        return self._frame_buffer.dropped_count
+
+    def stop_acquisition(self):
+        """ Stop/abort live or single acquisition
+
+        @return bool: Success ?
+        """
+        self._stop_stream.set()
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+            self._stream_thread = None
+        self._acquiring = False
+        return True
+
+    def get_acquired_data(self):
+        """ Return an array of last acquired image.
+
+        @return numpy array: image data in format [[row],[row]...]
+
+        Each pixel might be a float, integer or sub pixels
+        """
+        if self._stream_thread is not None:
+            newest = self._frame_buffer.get_newest()
+            if newest is not None:
+                return newest[0]
+        return self._frame.copy()
+
+    def set_exposure(self, exposure):
+        """ Set the exposure time in seconds. Has no effect on the replayed frames.
+
+        @param float time: desired new exposure time
+
+        @return float: setted new exposure time
+        """
+        self._exposure = exposure
+        return self._exposure
+
+    def get_exposure(self):
+        """ Get the exposure time in seconds
+
+        @return float exposure time
+        """
+        return self._exposure
+
+    def set_gain(self, gain):
+        """ Set the gain. Has no effect on the replayed frames.
+
+        @param float gain: desired new gain
+
+        @return float: new exposure gain
+        """
+        self._gain = gain
+        return self._gain
+
+    def get_gain(self):
+        """ Get the gain
+
+        @return float: exposure gain
+        """
+        return self._gain
+
+    def get_ready_state(self):
+        """ Is the camera ready for an acquisition ?
+
+        @return bool: ready ?
+        """
+        return not self._acquiring
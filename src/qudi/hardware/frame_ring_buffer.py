@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a fixed-capacity ring buffer of preallocated camera frames.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['FrameRingBuffer']
+
+import time
+import numpy as np
+from qudi.util.mutex import Mutex
+
+
+class FrameRingBuffer:
+    """ Fixed-capacity ring buffer of preallocated frames shared between a camera streaming
+    handler (producer) and the logic (consumer).
+
+    Every written frame gets a monotonically increasing sequence number and the host time
+    (time.perf_counter) at which it was committed. Frames are copied into the preallocated slots,
+    so that no array is allocated per frame. Readers can avoid the allocation too, with views
+    (copy=False) or by copying into their own array (out=). When the buffer is full of unread
+    frames, the overwrite policy decides whether the oldest unread frame is overwritten
+    (overwrite=True) or the new frame is dropped (overwrite=False). In both cases the lost frame is
+    counted in dropped_count.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8, overwrite=True):
+        """
+        @param int capacity: number of frames the buffer can hold
+        @param tuple shape: shape of a single frame (rows, columns)
+        @param dtype: numpy dtype of the frames
+        @param bool overwrite: overwrite the oldest unread frame when full instead of dropping the
+                               new one
+        """
+        if capacity < 1:
+            raise ValueError('Frame ring buffer capacity must be at least 1')
+        self._lock = Mutex()
+        self.overwrite = bool(overwrite)
+        self._frames = np.zeros((capacity, *shape), dtype=dtype)
+        self._sequence = np.full(capacity, -1, dtype=np.int64)
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        self._receive_times = np.zeros(capacity, dtype=np.float64)
+        # Frames returned by get_newest ahead of the read position
+        self._read_flags = np.zeros(capacity, dtype=bool)
+        self._write_seq = 0
+        self._read_seq = 0
+        self._pending_slot = None
+        self._dropped = 0
+
+    @property
+    def capacity(self):
+        return self._frames.shape[0]
+
+    @property
+    def frame_shape(self):
+        return self._frames.shape[1:]
+
+    @property
+    def dtype(self):
+        return self._frames.dtype
+
+    @property
+    def dropped_count(self):
+        """ Number of frames lost since the last reset because the consumer was too slow """
+        with self._lock:
+            return self._dropped
+
+    @property
+    def unread_count(self):
+        with self._lock:
+            return self._unread_count()
+
+    def _unread_count(self):
+        unread = self._write_seq - self._read_seq
+        if unread <= 0:
+            return 0
+        slots = np.arange(self._read_seq, self._write_seq) % self.capacity
+        return unread - int(np.count_nonzero(self._read_flags[slots]))
+
+    @property
+    def last_sequence(self):
+        """ Sequence number of the newest committed frame, -1 if the buffer is empty """
+        with self._lock:
+            return self._write_seq - 1
+
+    def reset(self):
+        """ Forget all frames and reset the sequence numbers and the dropped frame counter """
+        with self._lock:
+            self._sequence[:] = -1
+            self._timestamps[:] = 0
+            self._receive_times[:] = 0
+            self._read_flags[:] = False
+            self._write_seq = 0
+            self._read_seq = 0
+            self._pending_slot = None
+            self._dropped = 0
+
+    def acquire_slot(self):
+        """ Reserve the next slot for writing and return it as a writable view.
+
+        The producer fills the returned array in place (e.g. with np.copyto) and then calls commit.
+        The slot is not visible to readers until it is committed.
+
+        @return numpy.ndarray: view on the slot to fill, None if the buffer is full and the policy
+                               is to drop new frames
+        """
+        with self._lock:
+            self._skip_read()
+            if self._write_seq - self._read_seq >= self.capacity:
+                if not self.overwrite:
+                    self._dropped += 1
+                    return None
+                # The oldest unread frame is about to be overwritten
+                self._read_seq += 1
+                self._dropped += 1
+            slot = self._write_seq % self.capacity
+            self._sequence[slot] = -1
+            self._read_flags[slot] = False
+            self._pending_slot = slot
+            return self._frames[slot]
+
+    def commit(self, timestamp=0):
+        """ Publish the slot previously reserved with acquire_slot.
+
+        @param int timestamp: hardware timestamp of the frame
+
+        @return int: sequence number given to the frame
+        """
+        with self._lock:
+            if self._pending_slot is None:
+                raise RuntimeError('No frame ring buffer slot was acquired before commit.')
+            seq = self._write_seq
+            self._sequence[self._pending_slot] = seq
+            self._timestamps[self._pending_slot] = timestamp
+            self._receive_times[self._pending_slot] = time.perf_counter()
+            self._pending_slot = None
+            self._write_seq += 1
+            return seq
+
+    def write(self, frame, timestamp=0):
+        """ Copy a frame into the buffer.
+
+        @param numpy.ndarray frame: frame data, must be broadcastable to the frame shape
+        @param int timestamp: hardware timestamp of the frame
+
+        @return int: sequence number given to the frame, -1 if the frame was dropped
+        """
+        slot = self.acquire_slot()
+        if slot is None:
+            return -1
+        np.copyto(slot, frame, casting='unsafe')
+        return self.commit(timestamp)
+
+    def get_newest(self, copy=True, out=None):
+        """ Return the newest committed frame and mark it as read. The older unread frames stay
+        unread for get_next. Non-blocking.
+
+        @param bool copy: return a copy of the frame instead of a view on the buffer slot. A view
+                          is only valid until the slot gets overwritten by the producer.
+        @param numpy.ndarray out: array of the frame shape to copy the frame into, returned instead
+                                  of a new array
+
+        @return tuple: (frame, sequence number, timestamp, receive time) or None if no frame was
+                       acquired yet
+        """
+        with self._lock:
+            seq = self._write_seq - 1
+            if seq < 0:
+                return None
+            if seq >= self._read_seq:
+                self._read_flags[seq % self.capacity] = True
+                self._skip_read()
+            return self._get_slot(seq, copy, out)
+
+    def get_next(self, copy=True, out=None):
+        """ Return the oldest unread frame and mark it as read. Non-blocking.
+
+        @param bool copy: return a copy of the frame instead of a view on the buffer slot
+        @param numpy.ndarray out: array of the frame shape to copy the frame into, returned instead
+                                  of a new array
+
+        @return tuple: (frame, sequence number, timestamp, receive time) or None if there is no
+                       unread frame
+        """
+        with self._lock:
+            self._skip_read()
+            if self._read_seq >= self._write_seq:
+                return None
+            seq = self._read_seq
+            self._read_seq += 1
+            return self._get_slot(seq, copy, out)
+
+    def _skip_read(self):
+        """ Move the read position past the frames already returned by get_newest """
+        while self._read_seq < self._write_seq:
+            slot = self._read_seq % self.capacity
+            if not self._read_flags[slot]:
+                break
+            self._read_flags[slot] = False
+            self._read_seq += 1
+
+    def _get_slot(self, seq, copy, out=None):
+        slot = seq % self.capacity
+        frame = self._frames[slot]
+        if out is not None:
+            np.copyto(out, frame)
+            frame = out
+        elif copy:
+            frame = frame.copy()
+        return (frame,
+                seq,
+                int(self._timestamps[slot]),
+                float(self._receive_times[slot]))
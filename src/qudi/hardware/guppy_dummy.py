@@ -1,45 +1,224 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['GuppyDummy']
+__all__ = ['GuppyDummy', 'AbsorptionShotSimulator']
 
 import time
+import threading
 import numpy as np
+from PySide2 import QtCore
 from qudi.interface.camera_interface import CameraInterface
 from qudi.core.statusvariable import StatusVar
 from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import Mutex
+from qudi.hardware.frame_ring_buffer import FrameRingBuffer
+
+
+class AbsorptionShotSimulator:
+    """ Fast generator of synthetic absorption imaging frames (atoms, bright and dark).
+
+    Everything expensive is precomputed once: the probe beam with a set of fringe phases, a set of
+    cloud transmissions for different atom numbers, their square roots, and banks of random
+    numbers. A frame then only costs a few in-place float32 operations on preallocated buffers: the
+    signal is picked from the templates, and shot noise and background are read at a random offset
+    into the banks.
+    """
+
+    FRAME_KINDS = ('atoms', 'bright', 'dark')
+
+    def __init__(self, resolution=(656, 494), cloud_profile='gaussian', cloud_peak_od=1.5,
+                 cloud_size=(40., 30.), cloud_center=None, bright_counts=150., beam_waist=300.,
+                 dark_counts=5., read_noise=1.5, fringe_amplitude=0.05, fringe_period=25.,
+                 fringe_templates=8, atom_number_jitter=0.1, jitter_templates=8,
+                 noise_bank_frames=4, seed=None):
+        """
+        @param tuple resolution: frame size (width, height)
+        @param str cloud_profile: 'gaussian' or 'thomas-fermi'
+        @param float cloud_peak_od: optical density at the center of the cloud
+        @param tuple cloud_size: Gaussian widths or Thomas-Fermi radii (x, y) in pixels
+        @param tuple cloud_center: cloud center (x, y) in pixels, None for the frame center
+        @param float bright_counts: probe beam counts at the beam center
+        @param float beam_waist: probe beam waist in pixels
+        @param float dark_counts: mean background counts
+        @param float read_noise: read noise standard deviation in counts
+        @param float fringe_amplitude: relative amplitude of the interference fringes
+        @param float fringe_period: fringe period in pixels
+        @param int fringe_templates: number of precomputed fringe phases
+        @param float atom_number_jitter: relative shot to shot atom number fluctuation
+        @param int jitter_templates: number of precomputed cloud transmissions
+        @param int noise_bank_frames: size of the random number bank, in frames
+        @param int seed: seed of the random number generator
+        """
+        width, height = resolution
+        self.shape = (height, width)
+        self._rng = np.random.default_rng(seed)
+
+        y, x = np.ogrid[:height, :width]
+        x = x.astype(np.float32)
+        y = y.astype(np.float32)
+        cx, cy = (width / 2, height / 2) if cloud_center is None else cloud_center
+
+        r2 = ((x - cx) ** 2 + (y - cy) ** 2) / np.float32(beam_waist) ** 2
+        beam = bright_counts * np.exp(-2 * r2)
+
+        # Probe beam with fringes, and its square root for the photon shot noise
+        phases = np.linspace(0, 2 * np.pi, fringe_templates, endpoint=False)
+        k = np.float32(2 * np.pi / fringe_period)
+        self._bright = np.empty((fringe_templates, height, width), dtype=np.float32)
+        for i, phase in enumerate(phases):
+            self._bright[i] = beam * (1 + fringe_amplitude * np.cos(k * (x + 0.5 * y) + phase))
+        self._sqrt_bright = np.sqrt(self._bright)
+
+        u2 = ((x - cx) / cloud_size[0]) ** 2 + ((y - cy) / cloud_size[1]) ** 2
+        if cloud_profile == 'gaussian':
+            od = np.exp(-u2 / 2)
+        elif cloud_profile == 'thomas-fermi':
+            od = np.maximum(1 - u2, 0) ** 1.5
+        else:
+            raise ValueError(f'Unknown cloud profile "{cloud_profile}"')
+        od = (cloud_peak_od * od).astype(np.float32)
+        scales = np.linspace(1 - atom_number_jitter, 1 + atom_number_jitter, jitter_templates)
+        self._transmissions = np.exp(-scales[:, None, None] * od).astype(np.float32)
+        self._sqrt_transmissions = np.sqrt(self._transmissions)
+
+        # Random banks: standard normal numbers for the shot noise, and background with read noise
+        size = height * width
+        self._noise_bank = self._rng.standard_normal(noise_bank_frames * size, dtype=np.float32)
+        self._background_bank = self._rng.standard_normal(noise_bank_frames * size,
+                                                          dtype=np.float32)
+        self._background_bank *= np.float32(read_noise)
+        self._background_bank += np.float32(dark_counts)
+        self._bank_offsets = noise_bank_frames * size - size
+        self._signal = np.empty(self.shape, dtype=np.float32)
+        self._scratch = np.empty(self.shape, dtype=np.float32)
+
+    def _bank_view(self, bank):
+        """ Frame-sized view on a random bank at a random offset """
+        offset = self._rng.integers(self._bank_offsets + 1)
+        return bank[offset:offset + self._signal.size].reshape(self.shape)
+
+    def random_fringe(self):
+        """ Random fringe phase template, to share between the frames of a shot """
+        return self._rng.integers(len(self._bright))
+
+    def generate_frame(self, kind, out, gain=1., fringe=None):
+        """ Fill out with a synthetic frame.
+
+        @param str kind: 'atoms', 'bright' or 'dark'
+        @param numpy.ndarray out: float32 destination of shape (rows, columns)
+        @param float gain: gain applied to the light signal
+        @param int fringe: fringe phase template from random_fringe, a random one if None. The
+                           atoms and bright frames of a shot share it, like the probe beam of a
+                           real shot, so that dividing by the bright frame cancels the fringes
+        """
+        background = self._bank_view(self._background_bank)
+        if kind == 'dark':
+            np.copyto(out, background)
+            return out
+        if fringe is None:
+            fringe = self.random_fringe()
+        signal, sqrt_signal = self._bright[fringe], self._sqrt_bright[fringe]
+        if kind == 'atoms':
+            cloud = self._rng.integers(len(self._transmissions))
+            signal = np.multiply(signal, self._transmissions[cloud], out=self._signal)
+            sqrt_signal = np.multiply(sqrt_signal, self._sqrt_transmissions[cloud],
+                                      out=self._scratch)
+        # Photon shot noise, sqrt(signal) * N(0, 1)
+        noise = np.multiply(sqrt_signal, self._bank_view(self._noise_bank), out=self._scratch)
+        if gain != 1:
+            signal = np.multiply(signal, np.float32(gain), out=self._signal)
+            np.multiply(noise, np.float32(np.sqrt(gain)), out=noise)
+        np.add(background, signal, out=out)
+        np.add(out, noise, out=out)
+        return out
+
+    def generate_shot(self, out, gain=1.):
+        """ Fill a (frame_count, rows, columns) stack with atoms, bright and dark frames, in this
+        order and repeated if frame_count is larger than 3. The frames of a shot share their fringe
+        phase.
+        """
+        fringe = self.random_fringe()
+        for i in range(out.shape[0]):
+            self.generate_frame(self.FRAME_KINDS[i % 3], out[i], gain, fringe)
+        return out
 
 
 class GuppyDummy(CameraInterface):
-    """ Dummy module for AlliedVision GuppyPro camera
+    """ Dummy module for AlliedVision GuppyPro camera, simulating absorption imaging shots.
+
+    Single acquisitions return frames with atoms, bursts return atoms, bright and dark frames
+    and the triggered acquisition streams this sequence at frame_rate (as fast as possible if 0).
 
     Example config for copy-paste:
-o
+
     camera_dummy:
-        module.Class: 'camera.camera_dummy.CameraDummy'
+        module.Class: 'guppy_dummy.GuppyDummy'
         options:
             support_live: True
             camera_name: 'Dummy camera'
-            # FIXME: resolution config option causes no image
-            # resolution: (1280, 720)
+            resolution: (656, 494)
             exposure: 0.1
             gain: 1.0
+            simulate_exposure: False
+            frame_rate: 10
+            cloud_profile: 'gaussian'   # or 'thomas-fermi'
+            cloud_peak_od: 1.5
+            cloud_size: (40, 30)
+            bright_counts: 150
+            dark_counts: 5
+            fringe_amplitude: 0.05
     """
 
+    sigNewFrame = QtCore.Signal()
 
     _support_live = ConfigOption('support_live', True)
     _camera_name = ConfigOption('camera_name', 'Dummy camera')
-    _resolution = ConfigOption('resolution', (1280, 720))  # High-definition !
+    _resolution = ConfigOption('resolution', (656, 494))  # GuppyPro F031B
 
     _live = False
     _acquiring = False
     _exposure = ConfigOption('exposure', .1)
     _gain = ConfigOption('gain', 1.)
 
+    # Sleep for the exposure time on every acquisition like a real camera
+    _simulate_exposure = ConfigOption('simulate_exposure', False)
+    _frame_rate = ConfigOption('frame_rate', 10.)
+    _frame_buffer_size = ConfigOption('frame_buffer_size', 16)
+
+    # Simulated shot
+    _cloud_profile = ConfigOption('cloud_profile', 'gaussian')
+    _cloud_peak_od = ConfigOption('cloud_peak_od', 1.5)
+    _cloud_size = ConfigOption('cloud_size', (40., 30.))
+    _cloud_center = ConfigOption('cloud_center', None)
+    _bright_counts = ConfigOption('bright_counts', 150.)
+    _beam_waist = ConfigOption('beam_waist', 300.)
+    _dark_counts = ConfigOption('dark_counts', 5.)
+    _read_noise = ConfigOption('read_noise', 1.5)
+    _fringe_amplitude = ConfigOption('fringe_amplitude', 0.05)
+    _fringe_period = ConfigOption('fringe_period', 25.)
+    _atom_number_jitter = ConfigOption('atom_number_jitter', 0.1)
+
     def on_activate(self):
         """ Initialisation performed during activation of the module.
         """
-        pass
+        self._simulator = AbsorptionShotSimulator(resolution=self._resolution,
+                                                  cloud_profile=self._cloud_profile,
+                                                  cloud_peak_od=self._cloud_peak_od,
+                                                  cloud_size=self._cloud_size,
+                                                  cloud_center=self._cloud_center,
+                                                  bright_counts=self._bright_counts,
+                                                  beam_waist=self._beam_waist,
+                                                  dark_counts=self._dark_counts,
+                                                  read_noise=self._read_noise,
+                                                  fringe_amplitude=self._fringe_amplitude,
+                                                  fringe_period=self._fringe_period,
+                                                  atom_number_jitter=self._atom_number_jitter)
+        self._frame = np.zeros(self._simulator.shape, dtype=np.float32)
+        self._burst = None
+        self._burst_timestamps = None
+        self._frame_buffer = FrameRingBuffer(self._frame_buffer_size, self._simulator.shape,
+                                             dtype=np.float32)
+        self._stream_thread = None
+        self._stop_stream = threading.Event()
 
     def on_deactivate(self):
         """ Deinitialisation performed during deactivation of the module.
@@ -85,17 +264,108 @@ o
             return False
         else:
             self._acquiring = True
-            time.sleep(float(self._exposure+10/1000))
+            if self._simulate_exposure:
+                time.sleep(float(self._exposure+10/1000))
+            self._simulator.generate_frame('atoms', self._frame, self._gain)
             self._acquiring = False
+            self.sigNewFrame.emit()
             return True
 
+    def start_burst_acquisition(self, frame_count=3):
+        """ Start a burst of frame_count frames: atoms, bright and dark
+
+        @param int frame_count: number of frames in the burst
+
+        @return bool: Success ?
+        """
+        if self._live:
+            return False
+        self._acquiring = True
+        if self._simulate_exposure:
+            time.sleep(frame_count * float(self._exposure+10/1000))
+        shape = (frame_count, *self._simulator.shape)
+        if self._burst is None or self._burst.shape != shape:
+            self._burst = np.zeros(shape, dtype=np.float32)
+        self._simulator.generate_shot(self._burst, self._gain)
+        self._burst_timestamps = time.time_ns() + np.arange(frame_count, dtype=np.int64)
+        self._acquiring = False
+        return True
+
+    def get_acquired_burst(self):
+        """ Return the frames of the last burst acquisition
+
+        @return tuple: (numpy array of shape (frame_count, rows, columns),
+                        numpy array of the frame_count hardware timestamps)
+        """
+        if self._burst is None:
+            return None, None
+        return self._burst.copy(), self._burst_timestamps
+
+    def start_trigged_acquisition(self):
+        """ Stream atoms, bright and dark frames at frame_rate on a separate thread until
+        stop_acquisition is called.
+
+        @return bool: Success ?
+        """
+        if self._live or self._acquiring:
+            return False
+        self._acquiring = True
+        self._frame_buffer.reset()
+        self._stop_stream.clear()
+        self._stream_thread = threading.Thread(target=self._stream_loop,
+                                               name='guppy-dummy-stream',
+                                               daemon=True)
+        self._stream_thread.start()
+        return True
+
+    def _stream_loop(self):
+        period = 1 / self._frame_rate if self._frame_rate > 0 else 0
+        index = 0
+        next_time = time.perf_counter()
+        while not self._stop_stream.is_set():
+            if index % 3 == 0:
+                # One fringe phase per atoms, bright and dark sequence
+                fringe = self._simulator.random_fringe()
+            slot = self._frame_buffer.acquire_slot()
+            if slot is not None:
+                kind = AbsorptionShotSimulator.FRAME_KINDS[index % 3]
+                self._simulator.generate_frame(kind, slot, self._gain, fringe)
+                self._frame_buffer.commit(time.time_ns())
+                self.sigNewFrame.emit()
+            index += 1
+            if period:
+                next_time += period
+                self._stop_stream.wait(max(next_time - time.perf_counter(), 0))
+
+    def get_buffered_frame(self, newest=False, copy=True, out=None):
+        """ Non-blocking access to the streamed frames.
+
+        @param bool newest: return the newest frame instead of the next unread frame
+        @param bool copy: return a copy of the frame, False for a view of the buffer slot that is
+                          only valid until the slot is overwritten
+        @param numpy.ndarray out: array to copy the frame into instead of a new array
+
+        @return tuple: (frame, sequence number, timestamp, receive time) or None if there is no
+                       unread frame
+        """
+        if newest:
+            if self._frame_buffer.unread_count == 0:
+                return None
+            return self._frame_buffer.get_newest(copy, out)
+        return self._frame_buffer.get_next(copy, out)
+
     def stop_acquisition(self):
         """ Stop/abort live or single acquisition
 
         @return bool: Success ?
         """
+        self._stop_stream.set()
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+            self._stream_thread = None
         self._live = False
         self._acquiring = False
+        return True
 
     def get_acquired_data(self):
         """ Return an array of last acquired image.
@@ -104,8 +374,10 @@ o
 
         Each pixel might be a float, integer or sub pixels
         """
-        data = np.random.random(self._resolution)*self._exposure*self._gain
-        return data.transpose()
+        newest = self._frame_buffer.get_newest()
+        if newest is not None and self._acquiring:
+            return newest[0]
+        return self._frame.copy()
 
     def set_exposure(self, exposure):
         """ Set the exposure time in seconds
@@ -147,3 +419,19 @@ o
         @return bool: ready ?
         """
         return not (self._live or self._acquiring)
+
+
+def benchmark_simulation(resolution=(656, 494), shots=1000):
+    """ Measure the synthetic frame rate of the absorption shot simulator.
+
+    @param tuple resolution: frame size (width, height)
+    @param int shots: number of atoms/bright/dark triplets to generate
+
+    @return float: generated frames per second
+    """
+    simulator = AbsorptionShotSimulator(resolution=resolution)
+    stack = np.empty((3, *simulator.shape), dtype=np.float32)
+    start = time.perf_counter()
+    for _ in range(shots):
+        simulator.generate_shot(stack)
+    return 3 * shots / (time.perf_counter() - start)
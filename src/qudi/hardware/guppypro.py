@@ -3,12 +3,15 @@
 __all__ = ['GuppyPro']
 
 import time
+import threading
+from contextlib import ExitStack
 import numpy as np
 from qudi.interface.camera_interface import CameraInterface
 from qudi.core.connector import Connector
 from qudi.core.statusvariable import StatusVar
 from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import Mutex
+from qudi.hardware.frame_ring_buffer import FrameRingBuffer
 import logging
 from vimba import *
 from PySide2 import QtCore
@@ -17,6 +20,31 @@ logging.basicConfig(filename='logfile.log', filemode='w', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+class _AcquisitionWait:
+    """ Completion of a blocking acquisition, which stop_acquisition can abort """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.complete = False
+        self.aborted = False
+
+    def set_complete(self):
+        self.complete = True
+        self._event.set()
+
+    def abort(self):
+        self.aborted = True
+        self._event.set()
+
+    def wait(self, timeout):
+        """ Wait for the completion, the abort or the timeout, whichever comes first
+
+        @return bool: completed and not aborted ?
+        """
+        self._event.wait(timeout)
+        return self.complete and not self.aborted
+
+
 class GuppyPro(CameraInterface):
     """ 
     Allied Vision GuppyPro
@@ -37,36 +65,68 @@ class GuppyPro(CameraInterface):
     _exposure = ConfigOption('exposure', .1)
     _gain = ConfigOption('gain', 1.)
     _minimum_exposure_time = ConfigOption('minimum_exposure_time', 72e-6)   #72 µs for GuppyPro F031B
+    _pixel_format = ConfigOption('pixel_format', 'Mono8')                   # 'Mono8' or 'Mono16'
 
     _buffer_count = ConfigOption('buffer-count', 5)
+    # Frames kept between the streaming handler and the logic, and what to do when it is full
+    _frame_buffer_size = ConfigOption('frame_buffer_size', 16)
+    _frame_buffer_overwrite = ConfigOption('frame_buffer_overwrite', True)
+    # Maximum waiting time (in s) for all the frames of a burst
+    _burst_timeout = ConfigOption('burst_timeout', 100.)
     
     _live = False
     _acquiring = False
     
     sigNewFrame = QtCore.Signal()
+
+    _pixel_format_to_dtype = {'Mono8': np.uint8, 'Mono16': np.uint16}
         
     def on_activate(self):
         """ Initialisation performed during activation of the module.
+
+        The Vimba API and the camera are opened once here and kept open for the whole active
+        lifetime of the module, so that acquisitions do not pay the API startup and camera opening
+        costs on every frame.
         """
         self._camera_id = self._detection_to_id[self._camera_detection_number]
         self._request_acquisition_stop = False
-        
-        with Vimba.get_instance() as self.vimba:
-            try:
-                self.camera = self.vimba.get_camera_by_id(self._camera_id)
-                logger.info(f"Detection{self._camera_detection_number} \
-                    opened successfully !")
-                return True
-
-            except VimbaCameraError:
-                logger.error(f"Detection {self._camera_detection_number} was not found. \
-                             Please check that the camera is plugged in.")
-                raise VimbaCameraError('Failed to access Camera \'{}\'. Abort.'.format(self._camera_detection_number))
-        
+        self._cam = None
+        self._burst = None
+        self._burst_timestamps = None
+        self._acquisition_wait = None
+        self._frame_buffer = FrameRingBuffer(self._frame_buffer_size,
+                                             (self._resolution[1], self._resolution[0]),
+                                             dtype=self._pixel_format_to_dtype[self._pixel_format],
+                                             overwrite=self._frame_buffer_overwrite)
+
+        self._exit_stack = ExitStack()
+        try:
+            self._vimba = self._exit_stack.enter_context(Vimba.get_instance())
+            self._cam = self._exit_stack.enter_context(self._vimba.get_camera_by_id(self._camera_id))
+        except VimbaCameraError:
+            self._exit_stack.close()
+            logger.error(f"Detection {self._camera_detection_number} was not found. \
+                         Please check that the camera is plugged in.")
+            raise VimbaCameraError('Failed to access Camera \'{}\'. Abort.'.format(self._camera_detection_number))
+        # Let the camera deliver frames in the buffer format so that no conversion is needed
+        self._vimba_pixel_format = PixelFormat[self._pixel_format]
+        self._cam.set_pixel_format(self._vimba_pixel_format)
+        # Feature handles are looked up once and writes are staged until the next acquisition
+        self._feature_handles = dict()
+        self._pending_features = dict()
+        self.set_exposure(self._exposure)
+        self.set_gain(self._gain)
+        self.apply_settings()
+        logger.info(f"Detection{self._camera_detection_number} opened successfully !")
+
     def on_deactivate(self):
         """ Deinitialisation performed during deactivation of the module.
         """
         self.stop_acquisition()
+        # Closes the camera first, then shuts the Vimba API down
+        self._exit_stack.close()
+        self._cam = None
+        self._vimba = None
 
     def get_name(self):
         """ Retrieve an identifier of the camera that the GUI can print
@@ -99,69 +159,199 @@ class GuppyPro(CameraInterface):
             self._acquiring = False
 
     def start_single_acquisition(self):
-        """ Takes a single trigged image """
-        if self._live:
+        """ Takes a single trigged image. Blocks until the frame is captured, the timeout or
+        stop_acquisition.
+
+        @return bool: Success ?
+        """
+        if self._live or self._acquiring:
             # self.frame = np.zeros(self._resolution)
             return False
-        else:
-            self._acquiring = True
-            logger.info(f"Detection{self._camera_detection_number}: Starting acquisition")
-            
-            with Vimba.get_instance() as vimba:
-                logger.info(f"Opening Vimba camera API")
-                camera = vimba.get_camera_by_id(self._camera_id)
-                with camera as cam:
-                    logger.info(f"Detection{self._camera_detection_number}: Starting single frame acquisition")
-                    raw_frame = cam.get_frame(timeout_ms=100000)
-                    logger.info("A frame was just captured!")
-                    self.frame = self._convert_frame_to_img(raw_frame)
-            logger.info(f"Frame type: {type(self.frame)}")
-            self._acquiring = False
-            logger.info(f"Detection{self._camera_detection_number}: Ending acquisition")
+        wait = _AcquisitionWait()
+
+        def handler(cam: Camera, frame: Frame):
+            """ Stores the first complete frame """
+            if wait.complete:
+                return
+            if frame.get_status() == FrameStatus.Complete:
+                self._store_frame(frame)
+                wait.set_complete()
+                return
+            cam.queue_frame(frame)
+
+        logger.info(f"Detection{self._camera_detection_number}: Starting single frame acquisition")
+        self.apply_settings()
+        success = self._stream_until_complete(handler, wait, self._buffer_count)
+        if success:
+            logger.info("A frame was just captured!")
             self.sigNewFrame.emit()
-            return True
+        elif not wait.aborted:
+            logger.error(f"Detection{self._camera_detection_number}: Single frame timed out")
+        logger.info(f"Detection{self._camera_detection_number}: Ending acquisition")
+        return success
+
+    def _stream_until_complete(self, handler, wait, buffer_count):
+        """ Stream into handler until it completes wait, stop_acquisition aborts it or the burst
+        timeout. Only the stream started here is stopped: after an abort, stop_acquisition has
+        already stopped it and a new acquisition may be running.
+
+        @return bool: completed and not aborted ?
+        """
+        cam = self._cam
+        self._acquiring = True
+        self._acquisition_wait = wait
+        try:
+            cam.start_streaming(handler, buffer_count=buffer_count)
+            success = wait.wait(self._burst_timeout)
+            if not wait.aborted:
+                cam.stop_streaming()
+        finally:
+            if not wait.aborted:
+                self._acquisition_wait = None
+                self._acquiring = False
+        return success
     
-    def _convert_frame_to_img(self, frame):
-        logger.info("Converting frame format")
-        return np.array(frame.as_opencv_image().transpose()[0, :, :])
+    def start_burst_acquisition(self, frame_count=3):
+        """ Arm the trigger once and acquire frame_count hardware triggered frames into a single
+        preallocated stack. Blocks until the burst is complete or timed out.
+
+        @param int frame_count: number of frames in the burst (3 for atoms, bright and dark)
+
+        @return bool: Success ?
+        """
+        if self._live or self._acquiring:
+            logger.error(f"Detection{self._camera_detection_number}: Acquisition already running")
+            return False
+        shape = (frame_count, *self._frame_buffer.frame_shape)
+        if self._burst is None or self._burst.shape != shape:
+            self._burst = np.zeros(shape, dtype=self._frame_buffer.dtype)
+            self._burst_timestamps = np.zeros(frame_count, dtype=np.int64)
+        received = [0]
+        wait = _AcquisitionWait()
+
+        def handler(cam: Camera, frame: Frame):
+            """ Fills the burst stack, one frame per trigger """
+            if wait.complete or wait.aborted:
+                return
+            index = received[0]
+            if index < frame_count and frame.get_status() == FrameStatus.Complete:
+                self._convert_frame_to_img(frame, out=self._burst[index])
+                self._burst_timestamps[index] = frame.get_timestamp()
+                received[0] += 1
+                if received[0] == frame_count:
+                    wait.set_complete()
+                    return
+            cam.queue_frame(frame)
+
+        cam = self._cam
+        logger.info(f"Detection{self._camera_detection_number}: Starting burst of {frame_count} frames")
+        self.apply_settings()
+        cam.TriggerSource.set("InputLines")
+        cam.TriggerMode.set("On")
+        success = self._stream_until_complete(handler, wait, max(self._buffer_count, frame_count))
+        if wait.aborted:
+            logger.info(f"Detection{self._camera_detection_number}: Burst aborted after "
+                        f"{received[0]}/{frame_count} frames")
+        elif not success:
+            logger.error(f"Detection{self._camera_detection_number}: Burst timed out after "
+                         f"{received[0]}/{frame_count} frames")
+        return success
+
+    def get_acquired_burst(self):
+        """ Return the frames of the last burst acquisition
+
+        @return tuple: (numpy array of shape (frame_count, rows, columns),
+                        numpy array of the frame_count hardware timestamps)
+        """
+        if self._burst is None:
+            return None, None
+        return self._burst.copy(), self._burst_timestamps.copy()
+
+    def _store_frame(self, frame):
+        """ Copy a Vimba frame into the next slot of the frame ring buffer.
+
+        @param Frame frame: frame handed over by Vimba
+
+        @return int: sequence number of the stored frame, -1 if it was dropped
+        """
+        slot = self._frame_buffer.acquire_slot()
+        if slot is None:
+            logger.warning(f"Detection{self._camera_detection_number}: Frame buffer full, frame dropped")
+            return -1
+        self._convert_frame_to_img(frame, out=slot)
+        return self._frame_buffer.commit(frame.get_timestamp())
+
+    def _convert_frame_to_img(self, frame, out=None):
+        """ Wrap the Vimba frame buffer as a (rows, columns) numpy array without any conversion
+        pass, and optionally copy it once into a preallocated destination.
+
+        @param Frame frame: frame handed over by Vimba
+        @param numpy.ndarray out: optional destination of shape (rows, columns)
+
+        @return numpy.ndarray: out if given, else a view on the frame buffer. The view is only
+                               valid until the frame is queued again.
+        """
+        if frame.get_pixel_format() != self._vimba_pixel_format:
+            frame.convert_pixel_format(self._vimba_pixel_format)
+        image = frame.as_numpy_ndarray()[:, :, 0]
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
         
     def start_trigged_acquisition(self):
-        """
-        Starts acquisition of camera.
+        """ Starts a streaming acquisition on the hardware trigger.
+
+        Frames are handled by Vimba on its own streaming thread, so this call returns immediately
+        and streaming goes on until stop_acquisition is called. sigNewFrame is emitted for every
+        captured frame, which can then be retrieved with get_buffered_frame.
+
+        @return bool: Success ?
         """
         def handler(cam: Camera, frame: Frame):
             """ This function gets called every time a frame gets captured. """
             logging.info(f"Detection{self._camera_detection_number}: A frame was captured")
-            frame.convert_pixel_format(PixelFormat.Mono8)
-            self.frame = frame.as_opencv_image()
-            # Resetting the queue frame seems to be the best practice
-            cam.queue_frame(frame)
-            # self.stopAcquisition.set()
-            
-            
-        with Vimba.get_instance() as vimba:
-            logger.info(f"Opening Vimba camera API")
-            camera = vimba.get_camera_by_id(self._camera_id)
-            logger.info(f"Detection{self._camera_detection_number}: Camera is opened")
-            with camera as cam:
-                logging.info(f"Detection{self._camera_detection_number}: Starting acquisition")
-                self._acquiring = True
-                cam.TriggerSource.set("InputLines")
-                cam.TriggerMode.set("On")
-                cam.start_streaming(handler, buffer_count=self._buffer_count)
-                
-                time.sleep(10)
-                
-                logging.info(f"Detection{self._camera_detection_number}: Stopping acquisition")
-                cam.stop_streaming()
-                self._request_acquisition_stop = False
-                    
+            if frame.get_status() == FrameStatus.Complete:
+                self._store_frame(frame)
+            # Resetting the queue frame seems to be the best practice, unless we are stopping
+            if not self._request_acquisition_stop:
+                cam.queue_frame(frame)
+            self.sigNewFrame.emit()
+
+        if self._acquiring:
+            logger.error(f"Detection{self._camera_detection_number}: Acquisition already running")
+            return False
+        cam = self._cam
+        logging.info(f"Detection{self._camera_detection_number}: Starting acquisition")
+        self._acquiring = True
+        self._request_acquisition_stop = False
+        self._frame_buffer.reset()
+        self.apply_settings()
+        cam.TriggerSource.set("InputLines")
+        cam.TriggerMode.set("On")
+        cam.start_streaming(handler, buffer_count=self._buffer_count)
+        return True
+
     def stop_acquisition(self):
         """ Stop/abort live or single acquisition
 
         @return bool: Success ?
         """
         self._request_acquisition_stop = True
+        # Wakes up a blocking single frame or burst acquisition
+        wait = self._acquisition_wait
+        self._acquisition_wait = None
+        if wait is not None:
+            wait.abort()
+        if self._cam is not None and self._cam.is_streaming():
+            logging.info(f"Detection{self._camera_detection_number}: Stopping acquisition")
+            self._cam.stop_streaming()
+        self._acquiring = False
+        self._live = False
+        if self._cam is not None and self._pending_features:
+            # Settings changed during the acquisition were deferred until now
+            self.apply_settings()
+        return True
 
     def get_acquired_data(self):
         """ Return an array of last acquired image.
@@ -170,42 +360,117 @@ class GuppyPro(CameraInterface):
 
         Each pixel might be a float, integer or sub pixels
         """
-        data = self.frame
-        return data.transpose()
+        newest = self._frame_buffer.get_newest()
+        if newest is None:
+            return np.zeros((self._resolution[1], self._resolution[0]), dtype=self._frame_buffer.dtype)
+        return newest[0]
+
+    def get_buffered_frame(self, newest=False, copy=True, out=None):
+        """ Non-blocking access to the frame ring buffer.
+
+        @param bool newest: return the newest frame instead of the next unread frame, the older
+                            unread frames stay available
+        @param bool copy: return a copy of the frame, False for a view of the buffer slot that is
+                          only valid until the slot is overwritten
+        @param numpy.ndarray out: array to copy the frame into instead of a new array
+
+        @return tuple: (frame, sequence number, hardware timestamp, host receive time) or None if
+                       there is no unread frame
+        """
+        if newest:
+            if self._frame_buffer.unread_count == 0:
+                return None
+            return self._frame_buffer.get_newest(copy, out)
+        return self._frame_buffer.get_next(copy, out)
+
+    def get_dropped_frame_count(self):
+        """ Number of frames lost because the frame buffer was full
+
+        @return int: dropped frames since the last acquisition start
+        """
+        return self._frame_buffer.dropped_count
+
+    def _get_feature(self, name):
+        """ Return the cached handle of a camera feature, looking it up on first use
+
+        @param str name: Vimba feature name, e.g. 'ExposureTime'
+
+        @return Feature: the feature handle of the opened camera
+        """
+        feature = self._feature_handles.get(name)
+        if feature is None:
+            feature = self._cam.get_feature_by_name(name)
+            self._feature_handles[name] = feature
+        return feature
+
+    def apply_settings(self):
+        """ Write all the staged feature values to the camera in one pass and read back the values
+        that the sensor actually applied. Called before every acquisition, so that several changes
+        between two shots only cost one write per feature.
+
+        @return dict: applied value of every written feature
+        """
+        applied = dict()
+        while self._pending_features:
+            name, value = self._pending_features.popitem()
+            feature = self._get_feature(name)
+            try:
+                feature.set(value)
+            except VimbaFeatureError:
+                logger.error(f"Detection{self._camera_detection_number}: Unable to set {name} to {value}")
+            applied[name] = feature.get()
+        if 'ExposureTime' in applied:
+            self._exposure = applied['ExposureTime'] * 1e-6
+        if 'Gain' in applied:
+            self._gain = applied['Gain']
+        return applied
+
+    def _stage_feature(self, name, value):
+        """ Stage a feature value for the next apply_settings """
+        self._pending_features[name] = value
+        if self._acquiring or self._live:
+            logger.info(f"Detection{self._camera_detection_number}: {name} change deferred until "
+                        f"the end of the acquisition")
 
     def set_exposure(self, exposure):
-        """ Set the exposure time in seconds
+        """ Set the exposure time in seconds. The value is written to the camera before the next
+        acquisition, or by calling apply_settings.
 
         @param float time: desired new exposure time
 
         @return float: setted new exposure time
         """
-        self._exposure = exposure
-        return self._exposure
+        exposure = max(exposure, self._minimum_exposure_time)
+        # Vimba expects the exposure time in µs
+        self._stage_feature('ExposureTime', exposure * 1e6)
+        return exposure
 
     def get_exposure(self):
         """ Get the exposure time in seconds
 
         @return float exposure time
         """
+        if 'ExposureTime' in self._pending_features:
+            return self._pending_features['ExposureTime'] * 1e-6
         return self._exposure
 
     def set_gain(self, gain):
-        """ Set the gain
+        """ Set the gain. The value is written to the camera before the next acquisition, or by
+        calling apply_settings.
 
         @param float gain: desired new gain
 
         @return float: new exposure gain
         """
-        self._gain = gain
-        return self._gain
+        self._stage_feature('Gain', gain)
+        return gain
 
     def get_gain(self):
         """ Get the gain
 
         @return float: exposure gain
         """
-        return self._gain
+        return self._pending_features.get('Gain', self._gain)
 
     def get_ready_state(self):
         """ Is the camera ready for an acquisition ?
@@ -213,3 +478,117 @@ class GuppyPro(CameraInterface):
         @return bool: ready ?
         """
         return not (self._live or self._acquiring)
+
+
+def benchmark_single_acquisition(camera_detection_number=2, shots=20):
+    """ Compare the per-shot latency of a single frame acquisition when Vimba and the camera are
+    reopened for every frame against a persistent, already opened camera handle.
+
+    The camera must be free-running (TriggerMode Off) for the numbers to be meaningful.
+
+    @param int camera_detection_number: detection number of the camera to use
+    @param int shots: number of frames acquired with each method
+
+    @return dict: mean per-shot latency in seconds for the 'reopen' and 'persistent' paths
+    """
+    camera_id = GuppyPro._detection_to_id[camera_detection_number]
+
+    start = time.perf_counter()
+    for _ in range(shots):
+        with Vimba.get_instance() as vimba:
+            with vimba.get_camera_by_id(camera_id) as cam:
+                cam.get_frame(timeout_ms=100000)
+    reopen = (time.perf_counter() - start) / shots
+
+    with Vimba.get_instance() as vimba:
+        with vimba.get_camera_by_id(camera_id) as cam:
+            start = time.perf_counter()
+            for _ in range(shots):
+                cam.get_frame(timeout_ms=100000)
+            persistent = (time.perf_counter() - start) / shots
+
+    logger.info(f"Per-shot latency: reopen {reopen * 1e3:.2f} ms, persistent {persistent * 1e3:.2f} ms")
+    return {'reopen': reopen, 'persistent': persistent}
+
+
+def benchmark_frame_conversion(resolution=(656, 494), frames=1000):
+    """ Micro-benchmark of the frame conversion for Mono8 and Mono16 frames.
+
+    Raw frame buffers are simulated in memory, so no camera is needed. The former path
+    (as_opencv_image, transpose, channel slice, np.array copy and transpose in get_acquired_data)
+    is compared against the zero-copy view copied once into a preallocated destination.
+
+    @param tuple resolution: frame size (width, height)
+    @param int frames: number of conversions per measurement
+
+    @return dict: mean time per frame in seconds, keyed by pixel format and path
+    """
+    width, height = resolution
+    results = dict()
+    for name, dtype in GuppyPro._pixel_format_to_dtype.items():
+        raw = bytearray(width * height * np.dtype(dtype).itemsize)
+        destination = np.empty((height, width), dtype=dtype)
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            image = np.frombuffer(raw, dtype=dtype).reshape(height, width, 1)
+            image = np.array(image.transpose()[0, :, :]).transpose()
+        results[(name, 'former')] = (time.perf_counter() - start) / frames
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            image = np.frombuffer(raw, dtype=dtype).reshape(height, width, 1)
+            np.copyto(destination, image[:, :, 0])
+        results[(name, 'preallocated')] = (time.perf_counter() - start) / frames
+
+    for (name, path), duration in results.items():
+        logger.info(f"{name} {path} conversion: {duration * 1e6:.1f} µs per frame")
+    return results
+
+
+def benchmark_multi_camera(detection_numbers=(1, 2, 3), frames=50):
+    """ Compare the aggregate throughput of several free-running cameras streaming concurrently in
+    one shared Vimba session against the same cameras acquired one after another.
+
+    @param tuple detection_numbers: detection numbers of the cameras to use
+    @param int frames: number of frames acquired from each camera
+
+    @return dict: aggregate throughput in frames per second for the 'sequential' and 'concurrent'
+                  acquisitions
+    """
+    camera_ids = [GuppyPro._detection_to_id[number] for number in detection_numbers]
+    total = frames * len(camera_ids)
+    with Vimba.get_instance() as vimba:
+        with ExitStack() as stack:
+            cameras = [stack.enter_context(vimba.get_camera_by_id(cid)) for cid in camera_ids]
+            for cam in cameras:
+                cam.TriggerMode.set("Off")
+
+            start = time.perf_counter()
+            for cam in cameras:
+                for _ in cam.get_frame_generator(limit=frames, timeout_ms=100000):
+                    pass
+            sequential = total / (time.perf_counter() - start)
+
+            done = {cam.get_id(): threading.Event() for cam in cameras}
+            counts = {cam.get_id(): 0 for cam in cameras}
+
+            def handler(cam: Camera, frame: Frame):
+                counts[cam.get_id()] += 1
+                if counts[cam.get_id()] >= frames:
+                    done[cam.get_id()].set()
+                else:
+                    cam.queue_frame(frame)
+
+            start = time.perf_counter()
+            for cam in cameras:
+                cam.start_streaming(handler, buffer_count=5)
+            for event in done.values():
+                event.wait(100)
+            concurrent = total / (time.perf_counter() - start)
+            for cam in cameras:
+                cam.stop_streaming()
+
+    logger.info(f"Aggregate throughput: sequential {sequential:.1f} fps, "
+                f"concurrent {concurrent:.1f} fps")
+    return {'sequential': sequential, 'concurrent': concurrent}
@@ -75,6 +75,26 @@ class CameraInterface(Base):
         """
         pass
 
+    @abstractmethod
+    def start_burst_acquisition(self, frame_count):
+        """ Arm the camera once and acquire frame_count hardware triggered frames into a single
+        preallocated stack, e.g. the atoms, bright and dark frames of one imaging cycle
+
+        @param int frame_count: number of frames in the burst
+
+        @return bool: Success ?
+        """
+        pass
+
+    @abstractmethod
+    def get_acquired_burst(self):
+        """ Return the frames of the last burst acquisition
+
+        @return tuple: (numpy array of shape (frame_count, rows, columns),
+                        numpy array of the frame_count hardware timestamps)
+        """
+        pass
+
     @abstractmethod
     def get_acquired_data(self):
         """ Return an array of last acquired image.
@@ -9,6 +9,9 @@ from qudi.core.connector import Connector
 from qudi.core.statusvariable import StatusVar
 from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import Mutex
+from qudi.logic.optical_density import OpticalDensityEngine, RB87_D2_CROSS_SECTION, \
+    compute_od_stack
+from qudi.logic.shot_averaging import ShotAverager, AVERAGING_MODES
 
 
 # qudi logic measurement modules must inherit qudi.core.module.LogicBase or other logic modules.
@@ -21,15 +24,30 @@ class AbsorptionLogic(LogicBase):
         module.Class: 'absorption_logic.AbsorptionLogic'
         options:
             increment_interval: 2
+            pixel_size: 8.53  # µm in the object plane
+            saturation_level: 255
+            invalid_pixels: 'mask'  # or 'clip'
+            averaging_mode: 'cumulative'  # or 'window' or 'exponential'
+            averaging_window: 10
+            averaging_alpha: 0.1
         connect:
             camera_hardware: camera hardware module
     """
 
     # Declare signals to send events to other modules connecting to this module
     sigCounterUpdated = QtCore.Signal(int)  # update signal for the current integer counter value
+    sigImagesUpdated = QtCore.Signal(object)  # dict of the 'OD', 'Natoms', 'bright' and 'dark' images
+    sigAveragesUpdated = QtCore.Signal(object)  # dict of the averaged images, noise maps and shots
 
     # Declare static parameters that can/must be declared in the qudi configuration
     _increment_interval = ConfigOption(name='increment_interval', default=1, missing='warn')
+    _pixel_size = ConfigOption(name='pixel_size', default=8.53)  # in µm
+    _cross_section = ConfigOption(name='cross_section', default=RB87_D2_CROSS_SECTION)  # in m^2
+    _saturation_level = ConfigOption(name='saturation_level', default=None)
+    _invalid_pixels = ConfigOption(name='invalid_pixels', default='mask')
+    _averaging_mode = ConfigOption(name='averaging_mode', default='cumulative')
+    _averaging_window = ConfigOption(name='averaging_window', default=10)
+    _averaging_alpha = ConfigOption(name='averaging_alpha', default=0.1)
 
     # Declare status variables that are saved in the AppStatus upon deactivation of the module and
     # are initialized to the saved value again upon activation.
@@ -46,6 +64,9 @@ class AbsorptionLogic(LogicBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._mutex = Mutex()  # Mutex for access serialization
+        self._od_engine = None
+        self._averager = None
+        self._averaging_enabled = False
 
     def on_activate(self) -> None:
         # Check if _increment_interval is not too small (lower boundary is 1.5 * trigger_time)
@@ -88,3 +109,117 @@ class AbsorptionLogic(LogicBase):
         with self._mutex:
             self._counter_value = 0
             self.sigCounterUpdated.emit(self._counter_value)
+
+    @property
+    def pixel_size(self) -> float:
+        return self._pixel_size
+
+    @pixel_size.setter
+    def pixel_size(self, value: float) -> None:
+        with self._mutex:
+            self._pixel_size = float(value)
+
+    def process_shot(self, atoms, bright, dark, normalization_roi=None) -> dict:
+        """ Compute the optical density and the atom number per pixel of a shot and emit them.
+
+        @param numpy.ndarray atoms: frame with atoms
+        @param numpy.ndarray bright: frame without atoms
+        @param numpy.ndarray dark: frame without probe light
+        @param list normalization_roi: [x1, x2, y1, y2] normalization region, None to disable
+
+        @return dict: 'OD', 'Natoms', 'bright' and 'dark' images
+        """
+        with self._mutex:
+            if self._od_engine is None or self._od_engine.shape != atoms.shape:
+                self._od_engine = OpticalDensityEngine(atoms.shape,
+                                                       saturation_level=self._saturation_level,
+                                                       invalid_mode=self._invalid_pixels)
+            od, density = self._od_engine.process(atoms, bright, dark, self._pixel_size,
+                                                  normalization_roi, self._cross_section)
+            images = {'OD': od.copy(), 'Natoms': density.copy(), 'bright': bright, 'dark': dark}
+            averages = self._average_shot(images) if self._averaging_enabled else None
+        self.sigImagesUpdated.emit(images)
+        if averages is not None:
+            self.sigAveragesUpdated.emit(averages)
+        return images
+
+    @property
+    def averaging_enabled(self) -> bool:
+        return self._averaging_enabled
+
+    @property
+    def averaging_mode(self) -> str:
+        return self._averaging_mode
+
+    @property
+    def averaging_window(self) -> int:
+        return self._averaging_window
+
+    @property
+    def averaging_alpha(self) -> float:
+        return self._averaging_alpha
+
+    def configure_averaging(self, enabled=None, mode=None, window=None, alpha=None) -> None:
+        """ Change the averaging of the processed shots. The averages restart from zero when the
+        mode, window or weight changes.
+
+        @param bool enabled: average the processed shots
+        @param str mode: 'cumulative', 'window' or 'exponential'
+        @param int window: number of shots of the sliding window
+        @param float alpha: weight of the newest shot in exponential mode
+        """
+        if mode is not None and mode not in AVERAGING_MODES:
+            self.log.error(f'Unknown averaging mode "{mode}". Choose one of {AVERAGING_MODES}.')
+            return
+        with self._mutex:
+            if enabled is not None:
+                self._averaging_enabled = bool(enabled)
+            if mode is not None and mode != self._averaging_mode:
+                self._averaging_mode = mode
+                self._averager = None
+            if window is not None and int(window) != self._averaging_window:
+                self._averaging_window = int(window)
+                self._averager = None
+            if alpha is not None and float(alpha) != self._averaging_alpha:
+                self._averaging_alpha = float(alpha)
+                self._averager = None
+
+    def reset_averaging(self) -> None:
+        """ Restart the averages from zero """
+        with self._mutex:
+            if self._averager is not None:
+                self._averager.reset()
+
+    def _average_shot(self, images) -> dict:
+        if self._averager is None or self._averager.shape != images['OD'].shape:
+            self._averager = ShotAverager(images['OD'].shape,
+                                          mode=self._averaging_mode,
+                                          window=self._averaging_window,
+                                          alpha=self._averaging_alpha)
+        self._averager.add_shot(images)
+        averages = self._averager.get_means()
+        averages['OD_noise'] = self._averager['OD'].noise_map
+        averages['shots'] = self._averager.shot_count
+        return averages
+
+    def process_stack(self, atoms, bright, dark, normalization_roi=None, roi=None,
+                      chunk_size=8) -> tuple:
+        """ Recompute the optical density and the atom number of a recorded stack of shots, e.g.
+        after changing the normalization region or the pixel size.
+
+        @param numpy.ndarray atoms: (N, rows, columns) frames with atoms
+        @param numpy.ndarray bright: (N, rows, columns) frames without atoms
+        @param numpy.ndarray dark: (N, rows, columns) or (rows, columns) frames without probe light
+        @param list normalization_roi: [x1, x2, y1, y2] normalization region, None to disable
+        @param list roi: [x1, x2, y1, y2] region where atoms are counted, None for the whole frame
+        @param int chunk_size: number of shots processed at once by a worker thread
+
+        @return tuple: (optical density stack, atom number of every shot)
+        """
+        return compute_od_stack(atoms, bright, dark, self._pixel_size,
+                                normalization_roi=normalization_roi,
+                                roi=roi,
+                                cross_section=self._cross_section,
+                                saturation_level=self._saturation_level,
+                                invalid_mode=self._invalid_pixels,
+                                chunk_size=chunk_size)
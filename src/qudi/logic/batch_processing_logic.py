@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+A module reprocessing directories of saved absorption imaging shots on a process pool.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['BatchProcessingLogic', 'RESULT_COLUMNS', 'list_shots', 'load_shot',
+           'process_shot_file']
+
+import os
+import time
+import zipfile
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PySide2 import QtCore
+
+from qudi.core.module import LogicBase
+from qudi.core.configoption import ConfigOption
+from qudi.util.mutex import Mutex
+from qudi.util.datastorage import TextDataStorage
+from qudi.logic.optical_density import OpticalDensityEngine, RB87_D2_CROSS_SECTION
+from qudi.logic.cloud_fitting import fit_gaussian_2d
+from qudi.storage.frame_storage import frame_count, load_entry
+from qudi.storage.run_archive import RunArchive
+
+# Columns of the result table, in export order
+RESULT_COLUMNS = ('index', 'atom_number', 'od_max', 'amplitude', 'center_x', 'center_y',
+                  'sigma_x', 'sigma_y', 'theta', 'offset', 'fit_success')
+
+# Engine of the worker process, reused for all the shots of the same shape
+_worker_engine = None
+
+
+def _is_frame_storage(path):
+    """ Whether a file is a run file written by FrameStorage rather than a single shot """
+    if path.endswith(('.h5', '.hdf5')):
+        return True
+    if not path.endswith('.npz'):
+        return False
+    with zipfile.ZipFile(path, 'r') as file:
+        return 'attributes.json' in file.namelist()
+
+
+def list_shots(directory):
+    """ List the shots saved in a directory, in file order.
+
+    Every .npy stack and .npz archive of the directory is a shot. Every entry of a run file written
+    by FrameStorage (.h5 or .npz) and every shot of a RunArchive subdirectory is a shot as well.
+
+    @param str directory: directory of the saved shots
+
+    @return list: (name, path, entry) of every shot, entry is None for single shot files
+    """
+    shots = list()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(os.path.join(path, 'archive.json')):
+            with RunArchive(path, mode='r') as archive:
+                count = len(archive)
+        elif name.endswith(('.h5', '.hdf5', '.npz')) and _is_frame_storage(path):
+            count = frame_count(path)
+        elif name.endswith(('.npz', '.npy')):
+            shots.append((name, path, None))
+            continue
+        else:
+            continue
+        shots.extend((f'{name}[{entry}]', path, entry) for entry in range(count))
+    return shots
+
+
+def load_shot(path, entry=None):
+    """ Load the atoms, bright and dark frames of a saved shot.
+
+    A shot is either a .npz archive with the 'atoms', 'bright' and 'dark' arrays, a .npy stack of
+    the atoms, bright and dark frames in this order (as acquired by a burst), or an entry of such
+    frames in a run file written by FrameStorage or in a RunArchive directory.
+
+    @param str path: path of the shot file, run file or archive directory
+    @param int entry: index of the shot in a run file or archive, None for single shot files
+
+    @return tuple: atoms, bright and dark frames
+    """
+    if entry is not None:
+        if os.path.isdir(path):
+            with RunArchive(path, mode='r') as archive:
+                stack = np.array(archive[entry])
+        else:
+            stack = load_entry(path, entry)
+    elif path.endswith('.npz'):
+        with np.load(path) as archive:
+            return archive['atoms'], archive['bright'], archive['dark']
+    else:
+        stack = np.load(path)
+    if stack.ndim != 3 or stack.shape[0] < 3:
+        raise ValueError(f'"{path}" does not hold a stack of atoms, bright and dark frames')
+    return stack[0], stack[1], stack[2]
+
+
+def process_shot_file(path, settings, entry=None):
+    """ Compute the optical density of a saved shot, its atom number in the ROI and fit the cloud.
+    Runs in the worker processes of the batch processing, only scalars are sent back.
+
+    @param str path: path of the shot file, run file or archive directory
+    @param dict settings: 'pixel_size', 'cross_section', 'saturation_level', 'invalid_pixels',
+                          'roi', 'normalization_roi' and 'fit'
+    @param int entry: index of the shot in a run file or archive, None for single shot files
+
+    @return dict: value of every result column but the index
+    """
+    global _worker_engine
+    atoms, bright, dark = load_shot(path, entry)
+    if _worker_engine is None or _worker_engine.shape != atoms.shape:
+        _worker_engine = OpticalDensityEngine(atoms.shape,
+                                              saturation_level=settings['saturation_level'],
+                                              invalid_mode=settings['invalid_pixels'])
+    od, density = _worker_engine.process(atoms, bright, dark, settings['pixel_size'],
+                                         settings['normalization_roi'], settings['cross_section'])
+    roi = settings['roi']
+    x1, x2, y1, y2 = roi if roi is not None else (0, od.shape[0], 0, od.shape[1])
+    roi_od = od[x1:x2, y1:y2]
+    has_signal = np.isfinite(roi_od).any()
+    result = {'atom_number': float(np.nansum(density[x1:x2, y1:y2], dtype=np.float64)),
+              'od_max': float(np.nanmax(roi_od)) if has_signal else np.nan}
+    if settings['fit'] and has_signal:
+        fit_result = fit_gaussian_2d(roi_od, origin=(x1, y1))
+        params, success = fit_result.parameters, fit_result.success
+    else:
+        params, success = (np.nan,) * 7, False
+    amplitude, center_x, center_y, sigma_x, sigma_y, theta, offset = (float(p) for p in params)
+    result.update(amplitude=amplitude, center_x=center_x, center_y=center_y, sigma_x=sigma_x,
+                  sigma_y=sigma_y, theta=theta, offset=offset, fit_success=float(success))
+    return result
+
+
+class BatchProcessingLogic(LogicBase):
+    """ Reprocesses a directory of saved shots on a pool of processes: optical density, atom number
+    in the ROI and rotated 2D Gaussian fit of the cloud. Every file is processed by one worker
+    process and only the scalar results travel back, so that the pool keeps all the cores busy.
+    Results are emitted as soon as a file is done, with the progress and the throughput, and the
+    result table is exported when the batch is complete.
+
+    Example config for copy-paste:
+
+    batchprocessinglogic:
+        module.Class: 'batch_processing_logic.BatchProcessingLogic'
+        options:
+            max_workers: null  # number of CPUs
+            pixel_size: 8.53  # µm in the object plane
+            saturation_level: 255
+            invalid_pixels: 'mask'
+    """
+
+    # declare config options
+    _max_workers = ConfigOption(name='max_workers', default=None)
+    _pixel_size = ConfigOption(name='pixel_size', default=8.53)  # in µm
+    _cross_section = ConfigOption(name='cross_section', default=RB87_D2_CROSS_SECTION)  # in m^2
+    _saturation_level = ConfigOption(name='saturation_level', default=None)
+    _invalid_pixels = ConfigOption(name='invalid_pixels', default='mask')
+
+    # signals
+    sigResultReady = QtCore.Signal(str, object)  # file name, dict of the result columns
+    sigProgressChanged = QtCore.Signal(int, int, float)  # done, total, throughput in files/s
+    sigBatchFinished = QtCore.Signal(str)  # path of the exported table, empty if not exported
+    _sigFileDone = QtCore.Signal(object)  # future of a file, to get back to the logic thread
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._thread_lock = Mutex()
+        self._executor = None
+        self._futures = dict()
+        self._files = list()
+        self._results = dict()
+        self._settings = dict()
+        self._directory = ''
+        self._start_time = 0.
+        self._failed_count = 0
+
+    def on_activate(self):
+        """ Initialisation performed during activation of the module.
+        """
+        self._sigFileDone.connect(self.__file_done, QtCore.Qt.QueuedConnection)
+
+    def on_deactivate(self):
+        """ Perform required deactivation. """
+        self.cancel_batch()
+        self._sigFileDone.disconnect()
+
+    @property
+    def results(self):
+        """ Results of the current or last batch, by file name """
+        with self._thread_lock:
+            return dict(self._results)
+
+    @property
+    def failed_count(self):
+        """ Number of files of the current or last batch that could not be processed """
+        return self._failed_count
+
+    def start_batch(self, directory, roi=None, normalization_roi=None, fit=True):
+        """ Process all the shots of a directory: .npz and .npy shot files, entries of FrameStorage
+        run files and shots of RunArchive subdirectories.
+
+        @param str directory: directory of the saved shots
+        @param list roi: [x1, x2, y1, y2] region of the atom number and of the fit, None for the
+                         whole frame
+        @param list normalization_roi: [x1, x2, y1, y2] normalization region, None to disable
+        @param bool fit: fit a 2D Gaussian to the cloud of every shot
+
+        @return bool: Success ?
+        """
+        with self._thread_lock:
+            if self.module_state() != 'idle':
+                self.log.error('Unable to start batch processing. Batch still in progress.')
+                return False
+            try:
+                shots = list_shots(directory)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                self.log.exception(f'Unable to list the shots of "{directory}".')
+                return False
+            if not shots:
+                self.log.warning(f'No shot file found in "{directory}".')
+                return False
+            self.module_state.lock()
+            self._directory = directory
+            self._files = [name for name, _, _ in shots]
+            self._results = dict()
+            self._failed_count = 0
+            self._settings = {'pixel_size': self._pixel_size,
+                              'cross_section': self._cross_section,
+                              'saturation_level': self._saturation_level,
+                              'invalid_pixels': self._invalid_pixels,
+                              'roi': None if roi is None else [int(v) for v in roi],
+                              'normalization_roi': None if normalization_roi is None else
+                                                   [int(v) for v in normalization_roi],
+                              'fit': bool(fit)}
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+            self._start_time = time.perf_counter()
+            self._futures = dict()
+            for name, path, entry in shots:
+                future = self._executor.submit(process_shot_file, path, self._settings, entry)
+                self._futures[future] = (len(self._futures), name)
+                future.add_done_callback(self._sigFileDone.emit)
+            self.sigProgressChanged.emit(0, len(shots), 0.)
+            return True
+
+    def cancel_batch(self):
+        """ Stop the batch processing. The files being processed are finished, the others are
+        dropped and the table of the processed files is not exported.
+        """
+        with self._thread_lock:
+            if self.module_state() != 'locked':
+                return
+            executor = self._executor
+            futures = self._futures
+            self._executor = None
+            self._futures = dict()
+            self.module_state.unlock()
+        # Executor.shutdown only cancels the pending futures itself from Python 3.9 on
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        self.sigBatchFinished.emit('')
+
+    def __file_done(self, future):
+        with self._thread_lock:
+            index, name = self._futures.pop(future, (None, None))
+            if name is None or future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception:
+                self._failed_count += 1
+                self.log.exception(f'Unable to process shot "{name}".')
+                result = None
+            if result is not None:
+                result['index'] = index
+                self._results[name] = result
+            done = len(self._files) - len(self._futures)
+            throughput = done / max(time.perf_counter() - self._start_time, 1e-9)
+            finished = not self._futures
+            if finished:
+                executor = self._executor
+                self._executor = None
+                self.module_state.unlock()
+        if result is not None:
+            self.sigResultReady.emit(name, result)
+        self.sigProgressChanged.emit(done, len(self._files), throughput)
+        if finished:
+            executor.shutdown(wait=False)
+            self.sigBatchFinished.emit(self.export_results())
+
+    def export_results(self):
+        """ Save the result table of the last batch, one row per processed file in file order.
+
+        @return str: path of the saved table, empty if there is nothing to save
+        """
+        with self._thread_lock:
+            results = sorted(self._results.items(), key=lambda item: item[1]['index'])
+            settings = dict(self._settings)
+            directory = self._directory
+        if not results:
+            self.log.error('No batch result. Nothing to save.')
+            return ''
+        table = np.array([[result[column] for column in RESULT_COLUMNS]
+                          for _, result in results], dtype=np.float64)
+        metadata = {'directory': directory,
+                    'files': [name for name, _ in results],
+                    **{key: value for key, value in settings.items() if key != 'fit'}}
+        timestamp = datetime.datetime.now()
+        ds = TextDataStorage(root_dir=self.module_default_data_dir)
+        file_path, _, _ = ds.save_data(table, metadata=metadata, nametag='batch_processing',
+                                       timestamp=timestamp, column_headers=list(RESULT_COLUMNS))
+        return file_path
@@ -21,14 +21,13 @@ If not, see <https://www.gnu.org/licenses/>.
 """
 
 import datetime
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 from PySide2 import QtCore
 from qudi.core.connector import Connector
 from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import RecursiveMutex
 from qudi.core.module import LogicBase
+from qudi.logic.thumbnails import ThumbnailWriter
+from qudi.logic.frame_channel import FrameChannel
 
 
 class CameraLogic(LogicBase):
@@ -42,6 +41,9 @@ class CameraLogic(LogicBase):
             camera: camera_dummy
         options:
             minimum_exposure_time: 0.05
+            thumbnail_size: 256  # maximum number of rows and columns
+            thumbnail_colormap: 'inferno'  # 'inferno', 'viridis' or 'gray'
+            frame_channel_slots: 0  # > 0 to share the frames with local processes by handle
     """
 
     # declare connectors
@@ -50,9 +52,15 @@ class CameraLogic(LogicBase):
     _minimum_exposure_time = ConfigOption(name='minimum_exposure_time',
                                           default=0.05,
                                           missing='warn')
+    # thumbnails of the saved frames, drawn in the background
+    _thumbnail_size = ConfigOption(name='thumbnail_size', default=256)
+    _thumbnail_colormap = ConfigOption(name='thumbnail_colormap', default='inferno')
+    # frames shared in a shared memory ring with the processes of the same host, 0 to disable
+    _frame_channel_slots = ConfigOption(name='frame_channel_slots', default=0)
 
     # signals
     sigFrameChanged = QtCore.Signal(object)
+    sigFrameShared = QtCore.Signal(object)  # FrameHandle of the frame in the frame channel
     sigAcquisitionFinished = QtCore.Signal()
 
     def __init__(self, *args, **kwargs):
@@ -62,6 +70,8 @@ class CameraLogic(LogicBase):
         self._exposure = -1
         self._gain = -1
         self._last_frame = None
+        self._thumbnail_writer = None
+        self._frame_channel = None
 
     def on_activate(self):
         """ Initialisation performed during activation of the module.
@@ -74,16 +84,30 @@ class CameraLogic(LogicBase):
         self.__timer.setSingleShot(True)
         self.__timer.timeout.connect(self.__acquire_video_frame)
 
+        self._thumbnail_writer = ThumbnailWriter(self._thumbnail_size, self._thumbnail_colormap)
+        if self._frame_channel_slots > 0:
+            self._frame_channel = FrameChannel(self._frame_channel_slots)
+
     def on_deactivate(self):
         """ Perform required deactivation. """
         self.__timer.stop()
         self.__timer.timeout.disconnect()
         self.__timer = None
+        self._thumbnail_writer.close()
+        self._thumbnail_writer = None
+        if self._frame_channel is not None:
+            self._frame_channel.close()
+            self._frame_channel = None
 
     @property
     def last_frame(self):
         return self._last_frame
 
+    @property
+    def frame_channel(self):
+        """ Name of the shared memory segment of the frames, None if not shared (yet) """
+        return None if self._frame_channel is None else self._frame_channel.segment_name
+
     def set_exposure(self, time):
         """ Set exposure time of camera """
         with self._thread_lock:
@@ -125,6 +149,7 @@ class CameraLogic(LogicBase):
                 self._last_frame = camera.get_acquired_data()
                 self.module_state.unlock()
                 self.sigFrameChanged.emit(self._last_frame)
+                self._share_frame(self._last_frame)
                 self.sigAcquisitionFinished.emit()
             else:
                 self.log.error('Unable to capture single frame. Acquisition still in progress.')
@@ -168,6 +193,7 @@ class CameraLogic(LogicBase):
             camera = self._camera()
             self._last_frame = camera.get_acquired_data()
             self.sigFrameChanged.emit(self._last_frame)
+            self._share_frame(self._last_frame)
             if self.module_state() == 'locked':
                 exposure = max(self._exposure, self._minimum_exposure_time)
                 self.__timer.start(1000 * exposure)
@@ -177,16 +203,19 @@ class CameraLogic(LogicBase):
     def create_tag(self, time_stamp):
         return f"{time_stamp}_captured_frame"
 
-    def draw_2d_image(self, data, cbar_range=None):
-        # Create image plot
-        fig, ax = plt.subplots()
-        cfimage = ax.imshow(data,
-                            cmap='inferno',  # FIXME: reference the right place in qudi
-                            origin='lower',
-                            interpolation='none')
-
-        if cbar_range is None:
-            cbar_range = (np.nanmin(data), np.nanmax(data))
-        cbar = plt.colorbar(cfimage, shrink=0.8)
-        cbar.ax.tick_params(which=u'both', length=0)
-        return fig
+    def _share_frame(self, frame):
+        """ Publish a frame in the frame channel, if frames are shared """
+        if self._frame_channel is not None and frame is not None:
+            self.sigFrameShared.emit(self._frame_channel.publish(frame))
+
+    def save_thumbnail(self, frame, file_path, levels=None):
+        """ Write the PNG thumbnail of a frame in the background.
+
+        @param numpy.ndarray frame: frame to draw
+        @param str file_path: path of the thumbnail, the .png extension is added if missing
+        @param tuple levels: (low, high) values mapped to the ends of the colormap, the range of
+                             the frame by default
+
+        @return concurrent.futures.Future: resolves to the path of the thumbnail
+        """
+        return self._thumbnail_writer.submit(frame, file_path, levels)
@@ -0,0 +1,798 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the fitting of atomic cloud images.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['BIMODAL_1D_PARAMETERS', 'BIMODAL_2D_PARAMETERS', 'CLOUD_MODELS', 'CloudFitter',
+           'FIT_TYPES', 'FitResult', 'GAUSSIAN_1D_PARAMETERS', 'GAUSSIAN_2D_PARAMETERS',
+           'LORENTZIAN_1D_PARAMETERS', 'PROFILE_MODELS', 'THOMAS_FERMI_1D_PARAMETERS',
+           'THOMAS_FERMI_2D_PARAMETERS', 'benchmark_gaussian_2d_fit', 'bimodal_1d', 'bimodal_2d',
+           'bin_image', 'condensate_fraction', 'estimate_gaussian_2d', 'estimate_profile',
+           'evaluate_model', 'fit_gaussian_2d', 'fit_image', 'fit_profile', 'gaussian_1d',
+           'gaussian_2d', 'lorentzian_1d', 'model_parameters', 'profile_integral',
+           'thomas_fermi_1d', 'thomas_fermi_2d']
+
+import time
+from collections import namedtuple
+import numpy as np
+
+# Fitted parameters of every model, in order. Angles in rad, lengths in pixels.
+GAUSSIAN_2D_PARAMETERS = ('amplitude', 'center_x', 'center_y', 'sigma_x', 'sigma_y', 'theta',
+                          'offset')
+THOMAS_FERMI_2D_PARAMETERS = ('amplitude', 'center_x', 'center_y', 'radius_x', 'radius_y',
+                              'offset')
+BIMODAL_2D_PARAMETERS = ('thermal_amplitude', 'center_x', 'center_y', 'sigma_x', 'sigma_y',
+                         'condensate_amplitude', 'radius_x', 'radius_y', 'offset')
+GAUSSIAN_1D_PARAMETERS = ('amplitude', 'center', 'sigma', 'offset')
+LORENTZIAN_1D_PARAMETERS = ('amplitude', 'center', 'gamma', 'offset')  # gamma: half width
+THOMAS_FERMI_1D_PARAMETERS = ('amplitude', 'center', 'radius', 'offset')
+BIMODAL_1D_PARAMETERS = ('thermal_amplitude', 'center', 'sigma', 'condensate_amplitude', 'radius',
+                         'offset')
+
+CLOUD_MODELS = ('gaussian', 'thomas_fermi', 'bimodal')
+# Models of the integrated profiles: the cloud models, and the Lorentzian for profiles broadened
+# e.g. by the probe detuning
+PROFILE_MODELS = ('gaussian', 'lorentzian', 'thomas_fermi', 'bimodal')
+# Fit types of the absorption GUI: integrated profile along x, along y, both, or the 2D image
+FIT_TYPES = ('1Dx', '1Dy', '1Dxy', '2D')
+
+FitResult = namedtuple('FitResult', ['parameters', 'success', 'cost', 'nfev'])
+FitResult.__doc__ = """ Result of a cloud fit: parameters array in the order of the model parameter
+names, convergence flag, final sum of squared residuals / 2 and number of model evaluations """
+
+
+def model_parameters(model, dimensions=2):
+    """ Names of the fitted parameters of a model.
+
+    @param str model: 'gaussian', 'thomas_fermi' or 'bimodal', or 'lorentzian' for profiles
+    @param int dimensions: 1 for integrated profiles, 2 for images
+
+    @return tuple: parameter names, in order
+    """
+    return _get_model(model, dimensions).parameters
+
+
+def evaluate_model(model, parameters, *coordinates):
+    """ Evaluate a fitted model, e.g. to display the fit.
+
+    @param str model: 'gaussian', 'thomas_fermi' or 'bimodal'
+    @param numpy.ndarray parameters: fitted parameters
+    @param coordinates: x for integrated profiles, x and y for images
+
+    @return numpy.ndarray: model values
+    """
+    return _FUNCTIONS[(model, len(coordinates))](*coordinates, *parameters)
+
+
+def gaussian_2d(x, y, amplitude, center_x, center_y, sigma_x, sigma_y, theta=0., offset=0.):
+    """ Rotated 2D Gaussian with offset. The axes of the Gaussian are rotated by theta with respect
+    to x (first image axis) and y (second image axis).
+    """
+    cos, sin = np.cos(theta), np.sin(theta)
+    dx, dy = x - center_x, y - center_y
+    xr = dx * cos + dy * sin
+    yr = dy * cos - dx * sin
+    return offset + amplitude * np.exp(-0.5 * ((xr / sigma_x) ** 2 + (yr / sigma_y) ** 2))
+
+
+def thomas_fermi_2d(x, y, amplitude, center_x, center_y, radius_x, radius_y, offset=0.):
+    """ Column density of a Thomas-Fermi condensate, amplitude * max(1 - r^2, 0)^(3/2), with
+    offset. """
+    parabola = 1 - ((x - center_x) / radius_x) ** 2 - ((y - center_y) / radius_y) ** 2
+    return offset + amplitude * np.maximum(parabola, 0) ** 1.5
+
+
+def bimodal_2d(x, y, thermal_amplitude, center_x, center_y, sigma_x, sigma_y,
+               condensate_amplitude, radius_x, radius_y, offset=0.):
+    """ Thermal Gaussian plus Thomas-Fermi condensate with the same center, with offset """
+    return (gaussian_2d(x, y, thermal_amplitude, center_x, center_y, sigma_x, sigma_y)
+            + thomas_fermi_2d(x, y, condensate_amplitude, center_x, center_y, radius_x, radius_y)
+            + offset)
+
+
+def gaussian_1d(x, amplitude, center, sigma, offset=0.):
+    """ 1D Gaussian with offset """
+    return offset + amplitude * np.exp(-0.5 * ((x - center) / sigma) ** 2)
+
+
+def lorentzian_1d(x, amplitude, center, gamma, offset=0.):
+    """ 1D Lorentzian of half width at half maximum gamma, with offset """
+    return offset + amplitude / (1 + ((x - center) / gamma) ** 2)
+
+
+def thomas_fermi_1d(x, amplitude, center, radius, offset=0.):
+    """ Integrated profile of a Thomas-Fermi condensate, amplitude * max(1 - x^2, 0)^2, with
+    offset """
+    return offset + amplitude * np.maximum(1 - ((x - center) / radius) ** 2, 0) ** 2
+
+
+def bimodal_1d(x, thermal_amplitude, center, sigma, condensate_amplitude, radius, offset=0.):
+    """ Integrated profile of a thermal Gaussian plus Thomas-Fermi condensate, with offset """
+    return (gaussian_1d(x, thermal_amplitude, center, sigma)
+            + thomas_fermi_1d(x, condensate_amplitude, center, radius) + offset)
+
+
+class _Gaussian2DProblem:
+    """ Residuals and analytic Jacobian of the rotated 2D Gaussian on the valid pixels of an image.
+    The exponential computed by the residuals is reused by the Jacobian of the same parameters.
+    """
+
+    def __init__(self, x, y, data):
+        self.x, self.y, self.data = x, y, data
+        self._params = None
+        self._cache = None
+
+    def _evaluate(self, params):
+        if self._params is None or not np.array_equal(params, self._params):
+            amplitude, center_x, center_y, sigma_x, sigma_y, theta, offset = params
+            cos, sin = np.cos(theta), np.sin(theta)
+            dx, dy = self.x - center_x, self.y - center_y
+            xr = dx * cos + dy * sin
+            yr = dy * cos - dx * sin
+            exp = np.exp(-0.5 * ((xr / sigma_x) ** 2 + (yr / sigma_y) ** 2))
+            self._params = params.copy()
+            self._cache = xr, yr, exp
+        return self._cache
+
+    def residuals(self, params):
+        _, _, exp = self._evaluate(params)
+        return params[6] + params[0] * exp - self.data
+
+    def jacobian(self, params):
+        """ Transposed Jacobian, of shape (parameters, pixels) """
+        amplitude, _, _, sigma_x, sigma_y, theta, _ = params
+        xr, yr, exp = self._evaluate(params)
+        cos, sin = np.cos(theta), np.sin(theta)
+        a_exp = amplitude * exp
+        xs = xr / sigma_x ** 2
+        ys = yr / sigma_y ** 2
+        jac = np.empty((7, exp.size))
+        jac[0] = exp
+        jac[1] = a_exp * (xs * cos - ys * sin)
+        jac[2] = a_exp * (xs * sin + ys * cos)
+        jac[3] = a_exp * xr * xs / sigma_x
+        jac[4] = a_exp * yr * ys / sigma_y
+        jac[5] = a_exp * xr * yr * (1 / sigma_y ** 2 - 1 / sigma_x ** 2)
+        jac[6] = 1.
+        return jac
+
+
+def _gaussian_terms(jac, rows, coordinates, centers, widths, amplitude):
+    """ Axis-aligned Gaussian of the given coordinates and its derivatives, written into the rows
+    (amplitude, center, width of every axis) of the transposed Jacobian """
+    exponent = 0.
+    scaled = list()
+    for coordinate, center, width in zip(coordinates, centers, widths):
+        u = (coordinate - center) / width
+        scaled.append(u)
+        exponent = exponent - 0.5 * u ** 2
+    exp = np.exp(exponent)
+    a_exp = amplitude * exp
+    jac[rows[0]] = exp
+    for i, (u, width) in enumerate(zip(scaled, widths)):
+        jac[rows[1 + i]] += a_exp * u / width
+        jac[rows[1 + len(widths) + i]] = a_exp * u ** 2 / width
+    return a_exp
+
+
+def _thomas_fermi_terms(jac, rows, coordinates, centers, radii, amplitude, power):
+    """ Thomas-Fermi profile amplitude * max(1 - r^2, 0)^power and its derivatives, written into
+    the rows (amplitude, center, radius of every axis) of the transposed Jacobian """
+    parabola = 1.
+    scaled = list()
+    for coordinate, center, radius in zip(coordinates, centers, radii):
+        v = (coordinate - center) / radius
+        scaled.append(v)
+        parabola = parabola - v ** 2
+    np.maximum(parabola, 0, out=parabola)
+    lower = parabola ** (power - 1)
+    jac[rows[0]] = lower * parabola
+    slope = 2 * power * amplitude * lower
+    for i, (v, radius) in enumerate(zip(scaled, radii)):
+        jac[rows[1 + i]] += slope * v / radius
+        jac[rows[1 + len(radii) + i]] = slope * v ** 2 / radius
+    return amplitude * jac[rows[0]]
+
+
+class _ModelProblem:
+    """ Residuals and analytic Jacobian of a cloud model on the valid pixels of an image or profile.
+    The model value and the Jacobian are computed together and reused for the same parameters.
+    """
+
+    def __init__(self, model, coordinates, data):
+        self.model = model
+        self.coordinates = coordinates
+        self.data = data
+        self._params = None
+        self._value = None
+        self._jac = np.empty((len(model.parameters), data.size))
+
+    def _evaluate(self, params):
+        if self._params is None or not np.array_equal(params, self._params):
+            self._value = self.model.evaluate(self._jac, self.coordinates, params)
+            self._params = params.copy()
+        return self._value
+
+    def residuals(self, params):
+        return self._evaluate(params) - self.data
+
+    def jacobian(self, params):
+        self._evaluate(params)
+        return self._jac
+
+
+class _CloudModel:
+    """ Description of a fit model: parameter names, which parameters are centers, widths and
+    amplitudes, how to evaluate the model with its Jacobian and the integrals of its thermal and
+    condensed parts. """
+
+    def __init__(self, parameters, dimensions, evaluate=None, problem=None):
+        self.parameters = parameters
+        self.dimensions = dimensions
+        self.evaluate = evaluate
+        self._problem = problem
+
+    def make_problem(self, coordinates, data):
+        if self._problem is not None:
+            return self._problem(*coordinates, data)
+        return _ModelProblem(self, coordinates, data)
+
+
+def _evaluate_thomas_fermi_2d(jac, coordinates, params):
+    amplitude, center_x, center_y, radius_x, radius_y, offset = params
+    jac[1:3] = 0
+    value = _thomas_fermi_terms(jac, (0, 1, 2, 3, 4), coordinates, (center_x, center_y),
+                                (radius_x, radius_y), amplitude, 1.5)
+    jac[5] = 1.
+    return value + offset
+
+
+def _evaluate_bimodal_2d(jac, coordinates, params):
+    (thermal_amplitude, center_x, center_y, sigma_x, sigma_y, condensate_amplitude, radius_x,
+     radius_y, offset) = params
+    jac[1:3] = 0
+    value = _gaussian_terms(jac, (0, 1, 2, 3, 4), coordinates, (center_x, center_y),
+                            (sigma_x, sigma_y), thermal_amplitude)
+    value = value + _thomas_fermi_terms(jac, (5, 1, 2, 6, 7), coordinates, (center_x, center_y),
+                                        (radius_x, radius_y), condensate_amplitude, 1.5)
+    jac[8] = 1.
+    return value + offset
+
+
+def _evaluate_gaussian_1d(jac, coordinates, params):
+    amplitude, center, sigma, offset = params
+    jac[1] = 0
+    value = _gaussian_terms(jac, (0, 1, 2), coordinates, (center,), (sigma,), amplitude)
+    jac[3] = 1.
+    return value + offset
+
+
+def _evaluate_lorentzian_1d(jac, coordinates, params):
+    amplitude, center, gamma, offset = params
+    u = (coordinates[0] - center) / gamma
+    shape = 1 / (1 + u * u)
+    value = amplitude * shape
+    jac[0] = shape
+    jac[1] = 2 * value * shape * u / gamma
+    jac[2] = jac[1] * u
+    jac[3] = 1.
+    return value + offset
+
+
+def _evaluate_thomas_fermi_1d(jac, coordinates, params):
+    amplitude, center, radius, offset = params
+    jac[1] = 0
+    value = _thomas_fermi_terms(jac, (0, 1, 2), coordinates, (center,), (radius,), amplitude, 2)
+    jac[3] = 1.
+    return value + offset
+
+
+def _evaluate_bimodal_1d(jac, coordinates, params):
+    thermal_amplitude, center, sigma, condensate_amplitude, radius, offset = params
+    jac[1] = 0
+    value = _gaussian_terms(jac, (0, 1, 2), coordinates, (center,), (sigma,), thermal_amplitude)
+    value = value + _thomas_fermi_terms(jac, (3, 1, 4), coordinates, (center,), (radius,),
+                                        condensate_amplitude, 2)
+    jac[5] = 1.
+    return value + offset
+
+
+_MODELS = {
+    ('gaussian', 2): _CloudModel(GAUSSIAN_2D_PARAMETERS, 2, problem=_Gaussian2DProblem),
+    ('thomas_fermi', 2): _CloudModel(THOMAS_FERMI_2D_PARAMETERS, 2, _evaluate_thomas_fermi_2d),
+    ('bimodal', 2): _CloudModel(BIMODAL_2D_PARAMETERS, 2, _evaluate_bimodal_2d),
+    ('gaussian', 1): _CloudModel(GAUSSIAN_1D_PARAMETERS, 1, _evaluate_gaussian_1d),
+    ('lorentzian', 1): _CloudModel(LORENTZIAN_1D_PARAMETERS, 1, _evaluate_lorentzian_1d),
+    ('thomas_fermi', 1): _CloudModel(THOMAS_FERMI_1D_PARAMETERS, 1, _evaluate_thomas_fermi_1d),
+    ('bimodal', 1): _CloudModel(BIMODAL_1D_PARAMETERS, 1, _evaluate_bimodal_1d),
+}
+
+
+_FUNCTIONS = {
+    ('gaussian', 2): gaussian_2d,
+    ('thomas_fermi', 2): thomas_fermi_2d,
+    ('bimodal', 2): bimodal_2d,
+    ('gaussian', 1): gaussian_1d,
+    ('lorentzian', 1): lorentzian_1d,
+    ('thomas_fermi', 1): thomas_fermi_1d,
+    ('bimodal', 1): bimodal_1d,
+}
+
+
+def _get_model(model, dimensions):
+    try:
+        return _MODELS[(model, dimensions)]
+    except KeyError:
+        models = CLOUD_MODELS if dimensions == 2 else PROFILE_MODELS
+        raise ValueError(f'Unknown {dimensions}D cloud model "{model}". '
+                         f'Choose one of {models}.') from None
+
+
+def _levenberg_marquardt(problem, p0, max_nfev=100, xtol=1e-6, ftol=1e-7):
+    """ Levenberg-Marquardt least squares on the normal equations.
+
+    The problems have few parameters and many pixels: J^T J and J^T r are small matrix products done
+    by BLAS, which is much cheaper than the QR factorization of the full Jacobian of MINPACK.
+
+    @param problem: object with residuals(params) and jacobian(params) of shape (parameters, pixels)
+    @param numpy.ndarray p0: initial parameters
+
+    @return tuple: (parameters, success, cost, number of residual evaluations)
+    """
+    params = np.array(p0, dtype=np.float64)
+    residuals = problem.residuals(params)
+    cost = 0.5 * residuals @ residuals
+    nfev = 1
+    damping = 1e-3
+    while nfev < max_nfev:
+        jac = problem.jacobian(params)
+        hessian = jac @ jac.T
+        gradient = jac @ residuals
+        scale = np.maximum(np.diag(hessian), 1e-30)
+        while nfev < max_nfev:
+            try:
+                step = np.linalg.solve(hessian + np.diag(damping * scale), -gradient)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            trial = params + step
+            trial_residuals = problem.residuals(trial)
+            nfev += 1
+            trial_cost = 0.5 * trial_residuals @ trial_residuals
+            if np.isfinite(trial_cost) and trial_cost <= cost:
+                break
+            damping *= 10
+            if damping > 1e12:
+                return params, False, cost, nfev
+        else:
+            return params, False, cost, nfev
+        decrease = cost - trial_cost
+        params, residuals, cost = trial, trial_residuals, trial_cost
+        damping = max(damping * 0.1, 1e-12)
+        if np.all(np.abs(step) <= xtol * (np.abs(params) + xtol)) or decrease <= ftol * cost:
+            return params, True, cost, nfev
+    return params, False, cost, nfev
+
+
+def bin_image(image, binning):
+    """ Average blocks of binning x binning pixels, ignoring NaN pixels. The last rows and columns
+    that do not fill a block are dropped.
+
+    @return numpy.ndarray: binned image
+    """
+    rows, columns = image.shape[0] // binning, image.shape[1] // binning
+    blocks = image[:rows * binning, :columns * binning].reshape(rows, binning, columns, binning)
+    valid = np.isfinite(blocks)
+    if valid.all():
+        return blocks.mean(axis=(1, 3), dtype=np.float64)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _border_offset(image):
+    border = np.concatenate((image[0], image[-1], image[1:-1, 0], image[1:-1, -1]))
+    return np.nanmedian(border) if np.isfinite(border).any() else 0.
+
+
+def estimate_gaussian_2d(image, x=None, y=None):
+    """ Initial guess of the rotated 2D Gaussian parameters from the image moments.
+
+    The offset is the median of the image border, the center and the covariance of the cloud are
+    the first and second moments of the image above the offset.
+
+    @param numpy.ndarray image: 2D image, may hold NaN pixels
+    @param numpy.ndarray x: coordinates of the image rows, None for the row indices
+    @param numpy.ndarray y: coordinates of the image columns, None for the column indices
+
+    @return numpy.ndarray: parameters in the order of GAUSSIAN_2D_PARAMETERS
+    """
+    rows, columns = image.shape
+    x = np.arange(rows, dtype=np.float64) if x is None else x
+    y = np.arange(columns, dtype=np.float64) if y is None else y
+    offset = _border_offset(image)
+    weights = np.nan_to_num(image - offset, nan=0.)
+    np.clip(weights, 0, None, out=weights)
+    total = weights.sum(dtype=np.float64)
+    if total <= 0:
+        return np.array([np.nanmax(image) - offset, x.mean(), y.mean(), np.ptp(x) / 4,
+                         np.ptp(y) / 4, 0., offset])
+    profile_x = weights.sum(axis=1, dtype=np.float64)
+    profile_y = weights.sum(axis=0, dtype=np.float64)
+    center_x = profile_x @ x / total
+    center_y = profile_y @ y / total
+    dx, dy = x - center_x, y - center_y
+    var_x = max(profile_x @ dx ** 2 / total, 1.)
+    var_y = max(profile_y @ dy ** 2 / total, 1.)
+    cov_xy = dx @ weights @ dy / total
+    # Principal axes of the covariance matrix
+    theta = 0.5 * np.arctan2(2 * cov_xy, var_x - var_y)
+    cos, sin = np.cos(theta), np.sin(theta)
+    sigma_x2 = var_x * cos ** 2 + 2 * cov_xy * cos * sin + var_y * sin ** 2
+    sigma_y2 = var_x * sin ** 2 - 2 * cov_xy * cos * sin + var_y * cos ** 2
+    sigma_x = np.sqrt(max(sigma_x2, 1.))
+    sigma_y = np.sqrt(max(sigma_y2, 1.))
+    amplitude = total * _pixel_area(x, y) / (2 * np.pi * sigma_x * sigma_y)
+    return np.array([amplitude, center_x, center_y, sigma_x, sigma_y, theta, offset])
+
+
+def _pixel_area(x, y):
+    """ Area of a pixel in coordinate units, e.g. binning^2 for binned images """
+    step_x = x[1] - x[0] if len(x) > 1 else 1.
+    step_y = y[1] - y[0] if len(y) > 1 else 1.
+    return abs(step_x * step_y)
+
+
+def _profile_moments(profile, x):
+    """ Offset, area, center and rms width of a 1D profile. The offset is the median of the outer
+    tenth of the profile on each side. """
+    edge = max(len(profile) // 10, 1)
+    ends = np.concatenate((profile[:edge], profile[-edge:]))
+    offset = np.nanmedian(ends) if np.isfinite(ends).any() else 0.
+    weights = np.nan_to_num(profile - offset, nan=0.)
+    np.clip(weights, 0, None, out=weights)
+    total = weights.sum(dtype=np.float64)
+    step = abs(x[1] - x[0]) if len(x) > 1 else 1.
+    if total <= 0:
+        return offset, 0., x.mean(), max(np.ptp(x) / 4, 1.)
+    center = weights @ x / total
+    sigma = np.sqrt(max(weights @ (x - center) ** 2 / total, step ** 2))
+    return offset, total * step, center, sigma
+
+
+def estimate_profile(profile, x, model='gaussian'):
+    """ Initial guess of the parameters of an integrated profile.
+
+    The Gaussian and Thomas-Fermi guesses come from the profile moments, knowing that a
+    Thomas-Fermi integrated profile of radius R has an rms width R / sqrt(7). For the bimodal
+    model, a Gaussian fitted to the wings of the profile gives the thermal part and the moments of
+    what is left at the center give the condensate.
+
+    @param numpy.ndarray profile: integrated profile, may hold NaN points
+    @param numpy.ndarray x: coordinates of the profile points
+    @param str model: 'gaussian', 'thomas_fermi' or 'bimodal'
+
+    @return numpy.ndarray: parameters in the order of model_parameters(model, 1)
+    """
+    offset, area, center, sigma = _profile_moments(profile, x)
+    if model == 'gaussian':
+        return np.array([area / (np.sqrt(2 * np.pi) * sigma), center, sigma, offset])
+    if model == 'lorentzian':
+        # The rms width of the Lorentzian wings is meaningless: use the peak and its half width
+        signal = np.nan_to_num(profile - offset, nan=0.)
+        amplitude = signal.max()
+        step = abs(x[1] - x[0]) if len(x) > 1 else 1.
+        gamma = max(np.count_nonzero(signal > amplitude / 2) * step / 2, step)
+        return np.array([amplitude, x[np.argmax(signal)], gamma, offset])
+    if model == 'thomas_fermi':
+        radius = np.sqrt(7) * sigma
+        return np.array([area * 15 / (16 * radius), center, radius, offset])
+    if model == 'bimodal':
+        return _estimate_bimodal_profile(profile, x)
+    raise ValueError(f'Unknown cloud model "{model}". Choose one of {PROFILE_MODELS}.')
+
+
+def _estimate_bimodal_profile(profile, x):
+    gaussian = fit_profile(profile, x, 'gaussian', max_nfev=30).parameters
+    amplitude, center, sigma, offset = gaussian
+    wings = profile.copy()
+    wings[np.abs(x - center) < sigma] = np.nan
+    thermal = fit_profile(wings, x, 'gaussian', p0=gaussian, max_nfev=30)
+    if thermal.success and thermal.parameters[0] > 0 and thermal.parameters[2] > sigma:
+        thermal_amplitude, center, thermal_sigma, offset = thermal.parameters
+    else:
+        thermal_amplitude, thermal_sigma = 0.3 * amplitude, 1.5 * sigma
+    condensate = profile - gaussian_1d(x, thermal_amplitude, center, thermal_sigma, offset)
+    core = np.abs(x - center) < sigma
+    condensate_amplitude = max(np.nanmax(condensate[core]), 0.) if core.any() else 0.
+    _, _, _, condensate_sigma = _profile_moments(condensate, x)
+    radius = min(np.sqrt(7) * condensate_sigma, thermal_sigma)
+    return np.array([thermal_amplitude, center, thermal_sigma, condensate_amplitude, radius,
+                     offset])
+
+
+def _estimate_image(image, x, y, model):
+    """ Initial guess of the 2D parameters, from the image moments for the Gaussian and from fits of
+    the profiles integrated along x and y for the condensate models. """
+    if model == 'gaussian':
+        return estimate_gaussian_2d(image, x, y)
+    if model not in CLOUD_MODELS:
+        raise ValueError(f'Unknown cloud model "{model}". Choose one of {CLOUD_MODELS}.')
+    offset = _border_offset(image)
+    step_x = abs(x[1] - x[0]) if len(x) > 1 else 1.
+    step_y = abs(y[1] - y[0]) if len(y) > 1 else 1.
+    # Profiles integrated over the pixels of the other axis
+    profile_x = np.nansum(image, axis=1, dtype=np.float64) * step_y
+    profile_y = np.nansum(image, axis=0, dtype=np.float64) * step_x
+    px = fit_profile(profile_x, x, model, max_nfev=50).parameters
+    py = fit_profile(profile_y, y, model, max_nfev=50).parameters
+    # Integrating (1 - r^2)^(3/2) over y gives radius_y * 3 pi / 8 * (1 - x^2)^2
+    tf_integral = 3 * np.pi / 8
+    if model == 'thomas_fermi':
+        return np.array([px[0] / (py[2] * tf_integral), px[1], py[1], abs(px[2]), abs(py[2]),
+                         offset])
+    return np.array([px[0] / (np.sqrt(2 * np.pi) * abs(py[2])), px[1], py[1], abs(px[2]),
+                     abs(py[2]), px[3] / (abs(py[4]) * tf_integral), abs(px[4]), abs(py[4]),
+                     offset])
+
+
+def _canonical_parameters(model, params):
+    """ Positive widths and, for the rotated Gaussian, theta in [-pi/4, pi/4[ so that sigma_x is
+    the width of the axis closest to x """
+    names = _MODELS[model].parameters
+    for i, name in enumerate(names):
+        if name.startswith(('sigma', 'radius', 'gamma')):
+            params[i] = abs(params[i])
+    if 'theta' in names:
+        turns = np.round(params[5] / (np.pi / 2))
+        params[5] -= turns * np.pi / 2
+        if turns % 2:
+            params[3], params[4] = params[4], params[3]
+    return params
+
+
+def fit_profile(profile, x, model='gaussian', p0=None, max_nfev=100):
+    """ Fit an integrated 1D profile of the cloud.
+
+    @param numpy.ndarray profile: integrated profile, NaN points are ignored
+    @param numpy.ndarray x: coordinates of the profile points
+    @param str model: 'gaussian', 'lorentzian', 'thomas_fermi' or 'bimodal'
+    @param numpy.ndarray p0: initial parameters, None to estimate them from the profile moments
+    @param int max_nfev: maximum number of model evaluations
+
+    @return FitResult: parameters in the order of model_parameters(model, 1)
+    """
+    cloud_model = _get_model(model, 1)
+    profile = np.asarray(profile, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    p0 = estimate_profile(profile, x, model) if p0 is None else np.array(p0, dtype=np.float64)
+    valid = np.isfinite(profile)
+    if not valid.all():
+        profile, x = profile[valid], x[valid]
+    problem = cloud_model.make_problem((x,), profile)
+    params, success, cost, nfev = _levenberg_marquardt(problem, p0, max_nfev)
+    return FitResult(_canonical_parameters((model, 1), params), bool(success), float(cost), nfev)
+
+
+def fit_image(image, model='gaussian', origin=(0, 0), p0=None, binning='auto', max_nfev=100):
+    """ Fit a 2D cloud model to an image, e.g. the optical density in a ROI.
+
+    The fit is seeded from the image moments (or p0). With binning, the fit first converges on the
+    binned image, which is binning^2 times cheaper, and is then refined at full resolution from the
+    binned result, which only takes a few iterations.
+
+    @param numpy.ndarray image: 2D image, NaN pixels are ignored
+    @param str model: 'gaussian' (rotated), 'thomas_fermi' or 'bimodal'
+    @param tuple origin: (x, y) coordinates of image[0, 0], e.g. the ROI corner
+    @param numpy.ndarray p0: initial parameters in the coordinates of the full image, None to use
+                             the image moments
+    @param binning: binning of the prefit, 'auto' to bin down to about 64 pixels per side, 1 or
+                    None to fit at full resolution only
+    @param int max_nfev: maximum number of model evaluations of each fit stage
+
+    @return FitResult: parameters in the order of model_parameters(model, 2)
+    """
+    cloud_model = _get_model(model, 2)
+    image = np.asarray(image, dtype=np.float64)
+    if binning == 'auto':
+        binning = max(1, min(image.shape) // 64)
+    binning = int(binning) if binning else 1
+
+    nfev = 0
+    if binning > 1 or p0 is None:
+        binned = bin_image(image, binning) if binning > 1 else image
+        # Binned pixel i is centred on full resolution pixel binning * i + (binning - 1) / 2
+        bx = origin[0] + np.arange(binned.shape[0]) * binning + (binning - 1) / 2
+        by = origin[1] + np.arange(binned.shape[1]) * binning + (binning - 1) / 2
+        if p0 is None:
+            p0 = _estimate_image(binned, bx, by, model)
+        if binning > 1:
+            bx, by = np.meshgrid(bx, by, indexing='ij')
+            valid = np.isfinite(binned)
+            problem = cloud_model.make_problem((bx[valid], by[valid]), binned[valid])
+            p0, _, _, nfev = _levenberg_marquardt(problem, p0, max_nfev)
+
+    x, y = np.indices(image.shape, dtype=np.float64)
+    x += origin[0]
+    y += origin[1]
+    valid = np.isfinite(image)
+    if valid.all():
+        problem = cloud_model.make_problem((x.ravel(), y.ravel()), image.ravel())
+    else:
+        problem = cloud_model.make_problem((x[valid], y[valid]), image[valid])
+    params, success, cost, full_nfev = _levenberg_marquardt(problem, p0, max_nfev)
+    return FitResult(_canonical_parameters((model, 2), params), bool(success), float(cost),
+                     nfev + full_nfev)
+
+
+def fit_gaussian_2d(image, origin=(0, 0), p0=None, binning='auto', max_nfev=100):
+    """ Fit a rotated 2D Gaussian with offset to an image, see fit_image.
+
+    @return FitResult: parameters in the order of GAUSSIAN_2D_PARAMETERS
+    """
+    return fit_image(image, 'gaussian', origin, p0, binning, max_nfev)
+
+
+def _profile_integrals(model, parameters):
+    """ Integrals of the thermal (or single) and condensed parts of a fitted profile, offset
+    excluded """
+    if model == 'gaussian':
+        return np.sqrt(2 * np.pi) * parameters[0] * abs(parameters[2]), 0.
+    if model == 'lorentzian':
+        return np.pi * parameters[0] * abs(parameters[2]), 0.
+    if model == 'thomas_fermi':
+        return 0., 16 / 15 * parameters[0] * abs(parameters[2])
+    _get_model(model, 1)
+    return (np.sqrt(2 * np.pi) * parameters[0] * abs(parameters[2]),
+            16 / 15 * parameters[3] * abs(parameters[4]))
+
+
+def profile_integral(model, parameters):
+    """ Integral of a fitted profile above its offset, e.g. the atom number of a profile of the
+    atom density.
+
+    @param str model: 'gaussian', 'lorentzian', 'thomas_fermi' or 'bimodal'
+    @param numpy.ndarray parameters: fitted parameters of the profile
+
+    @return float: integral of the profile, in profile units times coordinate units
+    """
+    return float(sum(_profile_integrals(model, parameters)))
+
+
+def condensate_fraction(model, parameters, dimensions=2):
+    """ Fraction of the signal in the condensate part of a fitted cloud.
+
+    @param str model: 'gaussian', 'thomas_fermi' or 'bimodal'
+    @param numpy.ndarray parameters: fitted parameters
+    @param int dimensions: 1 for integrated profiles, 2 for images
+
+    @return float: condensate fraction, 0 for a thermal cloud and 1 for a pure condensate
+    """
+    if model in ('gaussian', 'lorentzian'):
+        return 0.
+    if model == 'thomas_fermi':
+        return 1.
+    if dimensions == 2:
+        thermal = 2 * np.pi * parameters[0] * parameters[3] * parameters[4]
+        condensate = 2 * np.pi / 5 * parameters[5] * parameters[6] * parameters[7]
+    else:
+        thermal, condensate = _profile_integrals(model, parameters)
+    total = thermal + condensate
+    return float(condensate / total) if total != 0 else np.nan
+
+
+class CloudFitter:
+    """ Fits the clouds of successive shots with one model and one of the fit types of the
+    absorption GUI: '1Dx' and '1Dy' fit the profile integrated along the other axis, '1Dxy' fits
+    both profiles and '2D' fits the image.
+
+    With warm start, every fit starts from the converged parameters of the previous shot of the
+    same fit type, which only needs a few iterations in a scan where the cloud changes slowly. The
+    moments are used again after a failed fit or a model change.
+    """
+
+    def __init__(self, model='gaussian', warm_start=True, binning='auto', max_nfev=100):
+        """
+        @param str model: 'gaussian', 'thomas_fermi' or 'bimodal'
+        @param bool warm_start: start from the parameters of the previous shot
+        @param binning: binning of the 2D prefit, see fit_image
+        @param int max_nfev: maximum number of model evaluations of each fit stage
+        """
+        _get_model(model, 2)
+        self._model = model
+        self.warm_start = warm_start
+        self.binning = binning
+        self.max_nfev = max_nfev
+        self._previous = dict()
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        _get_model(model, 2)
+        if model != self._model:
+            self._model = model
+            self.reset()
+
+    def reset(self):
+        """ Forget the parameters of the previous shots """
+        self._previous = dict()
+
+    def fit(self, image, fit_type='2D', origin=(0, 0)):
+        """ Fit the cloud of an image.
+
+        @param numpy.ndarray image: 2D image, e.g. the optical density in the ROI
+        @param str fit_type: '1Dx', '1Dy', '1Dxy' or '2D'
+        @param tuple origin: (x, y) coordinates of image[0, 0], e.g. the ROI corner
+
+        @return dict: FitResult of every fitted axis: 'x' and/or 'y' for the 1D fit types, '2D'
+                      for the 2D fit type
+        """
+        if fit_type not in FIT_TYPES:
+            raise ValueError(f'Unknown fit type "{fit_type}". Choose one of {FIT_TYPES}.')
+        if fit_type == '2D':
+            return {'2D': self._fit('2D', fit_image, image, self._model, origin,
+                                    binning=self.binning, max_nfev=self.max_nfev)}
+        results = dict()
+        if fit_type in ('1Dx', '1Dxy'):
+            profile = np.nansum(image, axis=1, dtype=np.float64)
+            x = origin[0] + np.arange(len(profile), dtype=np.float64)
+            results['x'] = self._fit('x', fit_profile, profile, x, self._model,
+                                     max_nfev=self.max_nfev)
+        if fit_type in ('1Dy', '1Dxy'):
+            profile = np.nansum(image, axis=0, dtype=np.float64)
+            y = origin[1] + np.arange(len(profile), dtype=np.float64)
+            results['y'] = self._fit('y', fit_profile, profile, y, self._model,
+                                     max_nfev=self.max_nfev)
+        return results
+
+    def _fit(self, key, fit_function, *args, **kwargs):
+        previous = self._previous.get(key) if self.warm_start else None
+        result = fit_function(*args, p0=previous, **kwargs)
+        if previous is not None and not result.success:
+            # The cloud changed too much for the warm start: start again from the moments
+            result = fit_function(*args, **kwargs)
+        if result.success:
+            self._previous[key] = result.parameters.copy()
+        else:
+            self._previous.pop(key, None)
+        return result
+
+    def condensate_fraction(self, result, dimensions=2):
+        """ Condensate fraction of a fit result of this fitter, see condensate_fraction """
+        return condensate_fraction(self._model, result.parameters, dimensions)
+
+
+def benchmark_gaussian_2d_fit(size=200, shots=50, binning='auto', noise=0.05):
+    """ Measure the time needed to fit a rotated Gaussian cloud in a square ROI.
+
+    @param int size: side of the ROI in pixels
+    @param int shots: number of fitted shots
+    @param binning: binning of the prefit, see fit_gaussian_2d
+    @param float noise: standard deviation of the OD noise
+
+    @return float: mean fit time per shot in s
+    """
+    rng = np.random.default_rng(0)
+    x, y = np.indices((size, size), dtype=np.float64)
+    cloud = gaussian_2d(x, y, 1.5, size * 0.45, size * 0.55, size * 0.12, size * 0.08, 0.3, 0.02)
+    images = cloud + rng.normal(0, noise, size=(shots, size, size))
+    start = time.perf_counter()
+    for image in images:
+        fit_gaussian_2d(image, binning=binning)
+    return (time.perf_counter() - start) / shots
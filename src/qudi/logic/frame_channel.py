@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a shared-memory channel passing camera frames to other processes of the same
+host by handle instead of by value.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['FrameChannel', 'FrameChannelReader', 'FrameHandle']
+
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+# What is sent to the consumers instead of the frame: a few bytes, whatever the frame size
+FrameHandle = namedtuple('FrameHandle', ['segment', 'frame_number', 'timestamp'])
+
+_MAGIC = b'QFRM'
+_VERSION = 1
+_MAX_DIMENSIONS = 4
+_ALIGNMENT = 64
+
+_HEADER_DTYPE = np.dtype([('magic', 'S4'),
+                          ('version', '<u4'),
+                          ('slots', '<u4'),
+                          ('slot_bytes', '<u8'),
+                          ('published', '<u8')])  # number of frames published so far
+
+_SLOT_DTYPE = np.dtype([('sequence', '<u8'),  # seqlock: odd while the slot is written
+                        ('frame_number', '<u8'),
+                        ('timestamp', '<f8'),
+                        ('dtype', 'S8'),
+                        ('ndim', '<u4'),
+                        ('shape', '<u8', (_MAX_DIMENSIONS,))])
+
+
+def _aligned(size):
+    return -(-size // _ALIGNMENT) * _ALIGNMENT
+
+
+def _layout(slots, slot_bytes):
+    """ Offsets of the slot headers and of the slot data, and total size of a segment """
+    slot_headers = _aligned(_HEADER_DTYPE.itemsize)
+    data = slot_headers + _aligned(slots * _SLOT_DTYPE.itemsize)
+    return slot_headers, data, data + slots * _aligned(slot_bytes)
+
+
+def _attach_untracked(name):
+    """ Attach to an existing segment without registering it with the resource tracker, which
+    would remove the segment of the publisher when this process ends """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13, attaching always registers the segment
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class FrameChannel:
+    """ Publishes frames into a ring of slots in a shared memory segment.
+
+    Every frame is copied once into the next slot of the ring, the consumers only receive a
+    FrameHandle (segment name, frame number, timestamp) and read the frame directly from the shared
+    memory with FrameChannelReader, without serialization.
+
+    Each slot is guarded by a sequence number (seqlock): it is odd while the frame is written and
+    2 * (frame number + 1) once it is complete. A reader copies the slot and checks the sequence
+    number before and after the copy, so that a frame overwritten meanwhile (the reader fell more
+    than a ring behind) is detected and reported instead of returned torn. The publisher never
+    waits for the readers.
+
+    When a frame does not fit the slots anymore (e.g. after a change of the camera ROI), the
+    channel moves to a new, larger segment. The handles name their segment, so that readers follow.
+    """
+
+    def __init__(self, slots=8, slot_bytes=0, name=None):
+        """
+        @param int slots: number of frames in the ring
+        @param int slot_bytes: size of a slot, the segment is created with the first frame if 0
+        @param str name: base name of the shared memory segments, random by default
+        """
+        if slots < 1:
+            raise ValueError('A frame channel needs at least one slot')
+        self.slots = int(slots)
+        self._base_name = name
+        self._generation = 0
+        self._segment = None
+        self._header = None
+        self._slot_headers = None
+        self._data_offset = 0
+        self._slot_bytes = 0
+        self._published = 0
+        if slot_bytes > 0:
+            self._create_segment(slot_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def segment_name(self):
+        """ Name of the current shared memory segment, None before the first frame """
+        return None if self._segment is None else self._segment.name
+
+    @property
+    def published(self):
+        """ Number of frames published """
+        return self._published
+
+    def _create_segment(self, slot_bytes):
+        self._release_segment()
+        slot_headers, data, size = _layout(self.slots, slot_bytes)
+        name = None
+        if self._base_name is not None:
+            name = f'{self._base_name}_{self._generation}'
+        self._generation += 1
+        self._segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=self._segment.buf)
+        self._slot_headers = np.ndarray((self.slots,), dtype=_SLOT_DTYPE,
+                                        buffer=self._segment.buf, offset=slot_headers)
+        self._slot_headers[...] = np.zeros((), dtype=_SLOT_DTYPE)
+        self._data_offset = data
+        self._slot_bytes = _aligned(slot_bytes)
+        self._header['slots'] = self.slots
+        self._header['slot_bytes'] = self._slot_bytes
+        self._header['published'] = self._published
+        self._header['version'] = _VERSION
+        # Written last: readers only attach to complete segments
+        self._header['magic'] = _MAGIC
+
+    def _release_segment(self):
+        if self._segment is None:
+            return
+        # Views of the buffer must be dropped before it can be closed
+        self._header = None
+        self._slot_headers = None
+        self._segment.close()
+        self._segment.unlink()
+        self._segment = None
+
+    def publish(self, frame, timestamp=None):
+        """ Copy a frame into the next slot of the ring.
+
+        @param numpy.ndarray frame: frame (or stack of frames) of at most 4 dimensions
+        @param float timestamp: time.time() of the frame, now by default
+
+        @return FrameHandle: handle of the frame for the consumers
+        """
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim > _MAX_DIMENSIONS:
+            raise ValueError(f'Frames of more than {_MAX_DIMENSIONS} dimensions are not supported')
+        if self._segment is None or frame.nbytes > self._slot_bytes:
+            self._create_segment(frame.nbytes)
+        timestamp = time.time() if timestamp is None else timestamp
+        number = self._published
+        slot = number % self.slots
+        header = self._slot_headers[slot]
+        header['sequence'] = 2 * number + 1
+        start = self._data_offset + slot * self._slot_bytes
+        destination = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self._segment.buf,
+                                 offset=start)
+        destination[...] = frame
+        del destination
+        header['frame_number'] = number
+        header['timestamp'] = timestamp
+        header['dtype'] = frame.dtype.str.encode()
+        header['ndim'] = frame.ndim
+        header['shape'] = frame.shape + (0,) * (_MAX_DIMENSIONS - frame.ndim)
+        header['sequence'] = 2 * number + 2
+        self._published = number + 1
+        self._header['published'] = self._published
+        return FrameHandle(self._segment.name, number, timestamp)
+
+    def close(self):
+        """ Remove the shared memory segment. Attached readers keep their mapping until they close
+        """
+        self._release_segment()
+
+
+class FrameChannelReader:
+    """ Reads the frames of a FrameChannel of another process of the same host. """
+
+    def __init__(self, segment=None):
+        """
+        @param str segment: name of the segment to attach to, or None to attach with the first
+                            handle
+        """
+        self._segment = None
+        self._header = None
+        self._slot_headers = None
+        self._data_offset = 0
+        self._slot_bytes = 0
+        self.slots = 0
+        if segment is not None:
+            self._attach(segment)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def published(self):
+        """ Number of frames published in the attached segment """
+        return 0 if self._header is None else int(self._header['published'])
+
+    def _attach(self, name):
+        self.close()
+        segment = _attach_untracked(name)
+        header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=segment.buf)
+        if header['magic'] != _MAGIC or header['version'] != _VERSION:
+            del header
+            segment.close()
+            raise ValueError(f'Shared memory segment "{name}" is not a frame channel')
+        self._segment = segment
+        self._header = header
+        self.slots = int(header['slots'])
+        self._slot_bytes = int(header['slot_bytes'])
+        slot_headers, self._data_offset, _ = _layout(self.slots, self._slot_bytes)
+        self._slot_headers = np.ndarray((self.slots,), dtype=_SLOT_DTYPE, buffer=segment.buf,
+                                        offset=slot_headers)
+
+    def read(self, handle):
+        """ Copy of the frame of a handle.
+
+        @param FrameHandle handle: handle received from the publisher
+
+        @return numpy.ndarray: the frame, None if it was overwritten (the reader is more than a
+                               ring behind the publisher)
+        """
+        if self._segment is None or self._segment.name != handle.segment:
+            self._attach(handle.segment)
+        return self._read(int(handle.frame_number))
+
+    def latest(self, retries=3):
+        """ Copy of the last published frame.
+
+        @param int retries: attempts when the frame is overwritten during the copy
+
+        @return tuple: (frame number, frame), (None, None) if there is none
+        """
+        if self._segment is None:
+            return None, None
+        for _ in range(retries):
+            number = self.published - 1
+            if number < 0:
+                return None, None
+            frame = self._read(number)
+            if frame is not None:
+                return number, frame
+        return None, None
+
+    def _read(self, number):
+        header = self._slot_headers[number % self.slots]
+        sequence = int(header['sequence'])
+        if sequence != 2 * number + 2:
+            return None
+        shape = tuple(int(n) for n in header['shape'][:int(header['ndim'])])
+        dtype = np.dtype(header['dtype'].decode())
+        start = self._data_offset + (number % self.slots) * self._slot_bytes
+        frame = np.ndarray(shape, dtype=dtype, buffer=self._segment.buf, offset=start).copy()
+        if int(header['sequence']) != sequence:
+            return None
+        return frame
+
+    def close(self):
+        """ Detach from the segment """
+        if self._segment is None:
+            return
+        self._header = None
+        self._slot_headers = None
+        self._segment.close()
+        self._segment = None
@@ -20,15 +20,64 @@ You should have received a copy of the GNU Lesser General Public License along w
 If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
 import datetime
+import queue
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 from PySide2 import QtCore
 from qudi.core.connector import Connector
 from qudi.core.configoption import ConfigOption
 from qudi.util.mutex import RecursiveMutex
 from qudi.core.module import LogicBase
+from qudi.storage.frame_storage import FrameStorage, default_storage_format
+from qudi.logic.thumbnails import ThumbnailWriter
+from qudi.logic.frame_channel import FrameChannel
+
+
+class AcquisitionWorker(QtCore.QObject):
+    """ Drives the camera hardware on a dedicated thread, so that the logic and GUI threads never
+    block on camera I/O. Requests are taken from a bounded queue filled by GuppyLogic and results
+    are posted back through queued signals, tagged with the generation of the request so that the
+    results of cancelled requests can be ignored. Every request taken from the queue is reported
+    through sigRequestFinished, cancelled ones included, so that the logic knows when the camera is
+    free again.
+    """
+
+    sigFrameAcquired = QtCore.Signal(object, int)  # frame, generation
+    sigShotAcquired = QtCore.Signal(object, object, int)  # frame stack, timestamps, generation
+    sigRequestFinished = QtCore.Signal(str, bool, int)  # request, success, generation
+
+    def __init__(self, camera, requests, shot_frame_count):
+        super().__init__()
+        self._camera = camera
+        self._requests = requests
+        self._shot_frame_count = shot_frame_count
+        self.generation = 0
+
+    @QtCore.Slot()
+    def process_requests(self):
+        """ Execute all the pending requests in order """
+        while True:
+            try:
+                request, generation = self._requests.get_nowait()
+            except queue.Empty:
+                return
+            if generation != self.generation:
+                # Cancelled before it was started
+                self.sigRequestFinished.emit(request, False, generation)
+                continue
+            camera = self._camera
+            success = False
+            if request == 'frame':
+                success = camera.start_single_acquisition()
+                if success:
+                    self.sigFrameAcquired.emit(camera.get_acquired_data(), generation)
+            elif request == 'shot':
+                success = camera.start_burst_acquisition(self._shot_frame_count)
+                if success:
+                    frames, timestamps = camera.get_acquired_burst()
+                    self.sigShotAcquired.emit(frames, timestamps, generation)
+            self.sigRequestFinished.emit(request, success, generation)
 
 
 class GuppyLogic(LogicBase):
@@ -43,6 +92,11 @@ class GuppyLogic(LogicBase):
             camera: camera_dummy
         options:
             minimum_exposure_time: 0.05
+            frame_storage_format: 'hdf5'  # or 'npz', default: 'hdf5' if h5py is installed
+            frame_compression: null  # 'gzip' or 'lzf'
+            thumbnail_size: 256  # maximum number of rows and columns
+            thumbnail_colormap: 'inferno'  # 'inferno', 'viridis' or 'gray'
+            frame_channel_slots: 0  # > 0 to share the frames with local processes by handle
     """
 
     # declare connectors
@@ -51,18 +105,44 @@ class GuppyLogic(LogicBase):
     _minimum_exposure_time = ConfigOption(name='minimum_exposure_time',
                                           default=76e-3,
                                           missing='warn')
+    # number of frames of one imaging cycle: atoms, bright and dark
+    _shot_frame_count = ConfigOption(name='shot_frame_count', default=3)
+    # maximum number of acquisition requests waiting for the acquisition worker
+    _max_pending_requests = ConfigOption(name='max_pending_requests', default=4)
+    # binary storage of the saved frames and shots, one file per run
+    _frame_storage_format = ConfigOption(name='frame_storage_format', default=None)
+    _frame_compression = ConfigOption(name='frame_compression', default=None)
+    # thumbnails of the saved frames, drawn in the background
+    _thumbnail_size = ConfigOption(name='thumbnail_size', default=256)
+    _thumbnail_colormap = ConfigOption(name='thumbnail_colormap', default='inferno')
+    # frames shared in a shared memory ring with the processes of the same host, 0 to disable
+    _frame_channel_slots = ConfigOption(name='frame_channel_slots', default=0)
 
     # signals
     sigFrameChanged = QtCore.Signal(object)
+    sigShotChanged = QtCore.Signal(object, object)  # frame stack, hardware timestamps
+    sigFrameShared = QtCore.Signal(object)  # FrameHandle of the frame in the frame channel
+    sigShotShared = QtCore.Signal(object)  # FrameHandle of the frame stack in the shot channel
     sigAcquisitionFinished = QtCore.Signal()
+    _sigProcessRequests = QtCore.Signal()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__timer = None
         self._thread_lock = RecursiveMutex()
         self._exposure = -1
         self._gain = -1
         self._last_frame = None
+        self._last_shot = None
+        self._streaming = False
+        self._requests = None
+        self._pending_requests = 0
+        self._worker = None
+        self._worker_thread = None
+        self._run_storages = dict()
+        self._run_timestamp = None
+        self._thumbnail_writer = None
+        self._frame_channel = None
+        self._shot_channel = None
 
     def on_activate(self):
         """ Initialisation performed during activation of the module.
@@ -71,20 +151,68 @@ class GuppyLogic(LogicBase):
         self._exposure = camera.get_exposure()
         self._gain = camera.get_gain()
 
-        self.__timer = QtCore.QTimer()
-        self.__timer.setSingleShot(True)
-        self.__timer.timeout.connect(self.__acquire_video_frame)
+        # The acquisition worker owns all the blocking camera calls
+        self._requests = queue.Queue(maxsize=self._max_pending_requests)
+        self._pending_requests = 0
+        self._worker = AcquisitionWorker(camera, self._requests, self._shot_frame_count)
+        self._worker_thread = QtCore.QThread()
+        self._worker_thread.setObjectName(f'{self.module_name}-acquisition')
+        self._worker.moveToThread(self._worker_thread)
+        self._sigProcessRequests.connect(self._worker.process_requests, QtCore.Qt.QueuedConnection)
+        self._worker.sigFrameAcquired.connect(self.__frame_acquired, QtCore.Qt.QueuedConnection)
+        self._worker.sigShotAcquired.connect(self.__shot_acquired, QtCore.Qt.QueuedConnection)
+        self._worker.sigRequestFinished.connect(self.__request_finished,
+                                                QtCore.Qt.QueuedConnection)
+        self._worker_thread.start()
+
+        self._thumbnail_writer = ThumbnailWriter(self._thumbnail_size, self._thumbnail_colormap)
+        if self._frame_channel_slots > 0:
+            self._frame_channel = FrameChannel(self._frame_channel_slots)
+            self._shot_channel = FrameChannel(self._frame_channel_slots)
 
     def on_deactivate(self):
         """ Perform required deactivation. """
-        self.__timer.stop()
-        self.__timer.timeout.disconnect()
-        self.__timer = None
+        self._stop_video()
+        self.cancel_acquisition()
+        self._sigProcessRequests.disconnect()
+        self._worker.sigFrameAcquired.disconnect()
+        self._worker.sigShotAcquired.disconnect()
+        self._worker.sigRequestFinished.disconnect()
+        self._worker_thread.quit()
+        self._worker_thread.wait()
+        if self._pending_requests > 0:
+            # The finished signals of the aborted requests are not delivered anymore
+            self._finish_requests(self._pending_requests)
+        self._worker_thread = None
+        self._worker = None
+        self.new_run()
+        self._thumbnail_writer.close()
+        self._thumbnail_writer = None
+        for channel in (self._frame_channel, self._shot_channel):
+            if channel is not None:
+                channel.close()
+        self._frame_channel = None
+        self._shot_channel = None
 
     @property
     def last_frame(self):
         return self._last_frame
 
+    @property
+    def frame_channel(self):
+        """ Name of the shared memory segment of the frames, None if not shared (yet) """
+        return None if self._frame_channel is None else self._frame_channel.segment_name
+
+    @property
+    def shot_channel(self):
+        """ Name of the shared memory segment of the shots, None if not shared (yet) """
+        return None if self._shot_channel is None else self._shot_channel.segment_name
+
+    @property
+    def last_shot(self):
+        """ Tuple (frame stack, hardware timestamps) of the last captured shot """
+        return self._last_shot
+
     def set_exposure(self, time):
         """ Set exposure time of camera """
         with self._thread_lock:
@@ -116,35 +244,89 @@ class GuppyLogic(LogicBase):
             return self._gain
 
     def capture_frame(self):
+        """ Request a single frame from the acquisition worker. Returns immediately, the frame is
+        emitted through sigFrameChanged.
         """
+        self._post_request('frame')
+
+    def capture_shot(self):
+        """ Request one imaging cycle (atoms, bright and dark frames) captured as a single triggered
+        burst, so that the cycle costs one arm/disarm of the camera. Returns immediately, the shot
+        is emitted through sigShotChanged.
+        """
+        self._post_request('shot')
+
+    def cancel_acquisition(self):
+        """ Drop all the pending frame and shot requests and abort the running one. The module
+        stays locked until the worker reports the aborted request as finished.
         """
         with self._thread_lock:
-            if self.module_state() == 'idle':
-                def on_acquisition_end():
-                    if self.module_state() == 'locked':
-                        self.module_state.unlock()
-                        self.timer.stop()
-                        camera.sigNewFrame.disconnect()
-                        self.log.info("Handling new frame")
-                        self._last_frame = camera.get_acquired_data()
-                        self.sigFrameChanged.emit(self._last_frame)
-                        self.log.info(f"{self._last_frame}")
-                        self.sigAcquisitionFinished.emit()
-                def on_timeout():
-                    camera.sigNewFrame.disconnect()
-                    self.log.error("Acquisition timed out!")
-                    self.module_state.unlock()
-                    self.sigAcquisitionFinished.emit()
+            if self._pending_requests == 0:
+                return
+            self._worker.generation += 1
+            dropped = 0
+            while True:
+                try:
+                    self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                dropped += 1
+            # Interrupts the burst or frame wait of the running request
+            self._camera().stop_acquisition()
+            self._finish_requests(dropped)
+
+    def _finish_requests(self, count):
+        """ Account for finished requests, unlock the module when none is left """
+        self._pending_requests -= count
+        if self._pending_requests <= 0 and self.module_state() == 'locked':
+            self._pending_requests = 0
+            self.module_state.unlock()
+            self.sigAcquisitionFinished.emit()
+
+    def _post_request(self, request):
+        with self._thread_lock:
+            if self._streaming:
+                self.log.error(f'Unable to capture {request}. Video acquisition in progress.')
+                return
+            try:
+                self._requests.put_nowait((request, self._worker.generation))
+            except queue.Full:
+                self.log.error(f'Unable to capture {request}. Too many pending acquisition '
+                               f'requests.')
+                return
+            if self._pending_requests == 0:
                 self.module_state.lock()
-                camera = self._camera()
-                camera.sigNewFrame.connect(on_acquisition_end)
-                self.timer = QtCore.QTimer()
-                self.timer.timeout.connect(on_timeout)
-                self.timer.setSingleShot(True)
-                self.timer.start(10000)
-                camera.start_single_acquisition()
-            else:
-                self.log.error('Unable to capture single frame. Acquisition still in progress.')
+            self._pending_requests += 1
+            self._sigProcessRequests.emit()
+
+    def __frame_acquired(self, frame, generation):
+        with self._thread_lock:
+            if generation != self._worker.generation:
+                return
+            self._last_frame = frame
+            self.sigFrameChanged.emit(self._last_frame)
+            self._share_frame(self._last_frame)
+
+    def __shot_acquired(self, frames, timestamps, generation):
+        with self._thread_lock:
+            if generation != self._worker.generation:
+                return
+            self._last_shot = (frames, timestamps)
+            self._last_frame = frames[0]
+            self.sigShotChanged.emit(frames, timestamps)
+            if self._shot_channel is not None:
+                self.sigShotShared.emit(self._shot_channel.publish(frames))
+            self.sigFrameChanged.emit(self._last_frame)
+            self._share_frame(self._last_frame)
+
+    def __request_finished(self, request, success, generation):
+        with self._thread_lock:
+            if self._pending_requests == 0:
+                return
+            if not success and generation == self._worker.generation:
+                self.log.error(f'Acquisition of {request} failed.')
+            # Cancelled requests count too: the camera is only free once they are done
+            self._finish_requests(1)
 
     def toggle_video(self, start):
         if start:
@@ -158,13 +340,15 @@ class GuppyLogic(LogicBase):
         with self._thread_lock:
             if self.module_state() == 'idle':
                 self.module_state.lock()
-                exposure = max(self._exposure, self._minimum_exposure_time)
                 camera = self._camera()
-                # if camera.support_live_acquisition():
-                #     camera.start_live_acquisition()
-                # else:
-                camera.start_trigged_acquisition()
-                # self.__timer.start(1000 * exposure)
+                # The camera streams on its own thread and signals every new frame
+                camera.sigNewFrame.connect(self.__handle_streamed_frames,
+                                           QtCore.Qt.QueuedConnection)
+                self._streaming = camera.start_trigged_acquisition()
+                if not self._streaming:
+                    camera.sigNewFrame.disconnect(self.__handle_streamed_frames)
+                    self.module_state.unlock()
+                    self.sigAcquisitionFinished.emit()
             else:
                 self.log.error('Unable to start video acquisition. Acquisition still in progress.')
 
@@ -172,38 +356,111 @@ class GuppyLogic(LogicBase):
         """ Stop the data recording loop.
         """
         with self._thread_lock:
-            if self.module_state() == 'locked':
-                self.__timer.stop()
-                self._camera().stop_acquisition()
+            if self.module_state() == 'locked' and self._streaming:
+                camera = self._camera()
+                camera.stop_acquisition()
+                self._streaming = False
+                camera.sigNewFrame.disconnect(self.__handle_streamed_frames)
+                self.__handle_streamed_frames()
                 self.module_state.unlock()
                 self.sigAcquisitionFinished.emit()
 
-    def __acquire_video_frame(self):
-        """ Execute step in the data recording loop: save one of each control and process values
+    def __handle_streamed_frames(self):
+        """ Forward every unread frame of the camera frame buffer while streaming
         """
         with self._thread_lock:
             camera = self._camera()
-            self._last_frame = camera.get_acquired_data()
-            self.sigFrameChanged.emit(self._last_frame)
-            if self.module_state() == 'locked':
-                exposure = max(self._exposure, self._minimum_exposure_time)
-                self.__timer.start(1000 * exposure)
-                if not camera.support_live_acquisition():
-                    camera.start_single_acquisition()  # the hardware has to check it's not busy
+            buffered = camera.get_buffered_frame()
+            while buffered is not None:
+                self._last_frame = buffered[0]
+                self.sigFrameChanged.emit(self._last_frame)
+                self._share_frame(self._last_frame)
+                buffered = camera.get_buffered_frame()
+            if self._streaming and camera.get_ready_state():
+                # The camera ended the stream on its own, e.g. at the end of a replayed recording
+                self._stop_video()
+
+    def save_frame(self, frame=None, roi=None):
+        """ Append a frame to the frame file of the current run.
+
+        @param numpy.ndarray frame: frame to save, the last frame by default
+        @param list roi: [x1, x2, y1, y2] region of interest saved with the frame
+
+        @return tuple: (path of the run file, index of the frame in the file), (None, None) if
+                       there is no frame to save
+        """
+        with self._thread_lock:
+            frame = self._last_frame if frame is None else frame
+            if frame is None:
+                self.log.error('No Data acquired. Nothing to save.')
+                return None, None
+            return self._save_entry('frames', frame, roi)
+
+    def save_shot(self, roi=None):
+        """ Append the frames of the last shot (atoms, bright and dark) to the shot file of the
+        current run.
+
+        @param list roi: [x1, x2, y1, y2] region of interest saved with the shot
+
+        @return tuple: (path of the run file, index of the shot in the file), (None, None) if
+                       there is no shot to save
+        """
+        with self._thread_lock:
+            if self._last_shot is None:
+                self.log.error('No shot acquired. Nothing to save.')
+                return None, None
+            return self._save_entry('shots', self._last_shot[0], roi)
+
+    def new_run(self):
+        """ Close the files of the current run: the next saved frame or shot starts a new run """
+        with self._thread_lock:
+            for storage in self._run_storages.values():
+                storage.close()
+            self._run_storages = dict()
+            self._run_timestamp = None
+
+    def _save_entry(self, kind, entry, roi):
+        entry = np.asarray(entry)
+        storage = self._run_storages.get(kind)
+        if storage is not None and (storage.entry_shape != entry.shape or
+                                    storage.dtype != entry.dtype):
+            # The camera settings changed the frames: continue the run in a new file
+            storage.close()
+            storage = None
+        if storage is None:
+            if self._run_timestamp is None:
+                self._run_timestamp = datetime.datetime.now()
+            file_format = self._frame_storage_format or default_storage_format()
+            name = f'{self._run_timestamp:%Y%m%d-%H%M-%S}_{kind}'
+            if kind in self._run_storages:
+                name += f'_{entry.shape[-2]}x{entry.shape[-1]}'
+            file_path = os.path.join(self.module_default_data_dir, name)
+            os.makedirs(self.module_default_data_dir, exist_ok=True)
+            storage = FrameStorage(file_path, entry.shape, entry.dtype, self._frame_compression,
+                                   attributes={'camera': self._camera().module_name,
+                                               'created': str(self._run_timestamp)},
+                                   file_format=file_format)
+            self._run_storages[kind] = storage
+        index = storage.append(entry, exposure=self._exposure, gain=self._gain, roi=roi)
+        storage.flush()
+        return storage.file_path, index
 
     def create_tag(self, time_stamp):
         return f"{time_stamp}_captured_frame"
 
-    def draw_2d_image(self, data, cbar_range=None):
-        # Create image plot
-        fig, ax = plt.subplots()
-        cfimage = ax.imshow(data,
-                            cmap='inferno',  # FIXME: reference the right place in qudi
-                            origin='lower',
-                            interpolation='none')
-
-        if cbar_range is None:
-            cbar_range = (np.nanmin(data), np.nanmax(data))
-        cbar = plt.colorbar(cfimage, shrink=0.8)
-        cbar.ax.tick_params(which=u'both', length=0)
-        return fig
+    def _share_frame(self, frame):
+        """ Publish a frame in the frame channel, if frames are shared """
+        if self._frame_channel is not None and frame is not None:
+            self.sigFrameShared.emit(self._frame_channel.publish(frame))
+
+    def save_thumbnail(self, frame, file_path, levels=None):
+        """ Write the PNG thumbnail of a frame in the background.
+
+        @param numpy.ndarray frame: frame to draw
+        @param str file_path: path of the thumbnail, the .png extension is added if missing
+        @param tuple levels: (low, high) values mapped to the ends of the colormap, the range of
+                             the frame by default
+
+        @return concurrent.futures.Future: resolves to the path of the thumbnail
+        """
+        return self._thumbnail_writer.submit(frame, file_path, levels)
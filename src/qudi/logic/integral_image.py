@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a summed-area table giving rectangular region sums of an image in constant time.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['IntegralImage', 'clip_region']
+
+import numpy as np
+
+
+def clip_region(region, shape):
+    """ Clip a [x1, x2, y1, y2] region to an image.
+
+    @param list region: [x1, x2, y1, y2], selecting image[x1:x2, y1:y2]
+    @param tuple shape: (rows, columns) of the image
+
+    @return tuple: integer (x1, x2, y1, y2) inside the image, with x1 <= x2 and y1 <= y2
+    """
+    rows, columns = shape
+    x1, x2, y1, y2 = region
+    x1 = min(max(int(x1), 0), rows)
+    x2 = min(max(int(x2), x1), rows)
+    y1 = min(max(int(y1), 0), columns)
+    y2 = min(max(int(y2), y1), columns)
+    return x1, x2, y1, y2
+
+
+class IntegralImage:
+    """ Summed-area table of an image, e.g. of the atom density.
+
+    The table is built once per image in O(pixels); afterwards the sum, the number of valid pixels
+    and the mean of any rectangular region are read from four table entries, independently of the
+    region size. This keeps the ROI atom number live while the ROI is dragged over full frames.
+
+    NaN pixels (masked by the optical density engine) are ignored: they count as 0 in the sums and
+    are excluded from the pixel count used by the mean. The tables are accumulated in float64 to
+    avoid the loss of precision of large float32 running sums, and are reused as long as the image
+    shape does not change.
+
+    Regions are given as [x1, x2, y1, y2] and select image[x1:x2, y1:y2], following the convention
+    of the display. They are clipped to the image.
+    """
+
+    def __init__(self, image=None):
+        """
+        @param numpy.ndarray image: 2D image to index, can be set later with update
+        """
+        self._table = np.zeros((1, 1), dtype=np.float64)
+        self._count = np.zeros((1, 1), dtype=np.int64)
+        self._valid = None
+        self._has_nan = False
+        if image is not None:
+            self.update(image)
+
+    @property
+    def shape(self):
+        """ Shape of the indexed image """
+        return self._table.shape[0] - 1, self._table.shape[1] - 1
+
+    def update(self, image):
+        """ Rebuild the tables for a new image.
+
+        @param numpy.ndarray image: 2D image to index
+        """
+        image = np.asarray(image)
+        rows, columns = image.shape
+        if self._table.shape != (rows + 1, columns + 1):
+            self._table = np.zeros((rows + 1, columns + 1), dtype=np.float64)
+            self._count = np.zeros((rows + 1, columns + 1), dtype=np.int64)
+            self._valid = np.empty((rows, columns), dtype=bool)
+        table = self._table[1:, 1:]
+        if image.dtype.kind == 'f':
+            np.isfinite(image, out=self._valid)
+            self._has_nan = not self._valid.all()
+        else:
+            self._has_nan = False
+        if self._has_nan:
+            np.copyto(table, 0)
+            np.copyto(table, image, where=self._valid)
+            count = self._count[1:, 1:]
+            np.cumsum(self._valid, axis=0, out=count)
+            np.cumsum(count, axis=1, out=count)
+        else:
+            np.copyto(table, image)
+        np.cumsum(table, axis=0, out=table)
+        np.cumsum(table, axis=1, out=table)
+
+    def _clip(self, region):
+        return clip_region(region, self.shape)
+
+    @staticmethod
+    def _corners(table, x1, x2, y1, y2):
+        return table[x2, y2] - table[x1, y2] - table[x2, y1] + table[x1, y1]
+
+    def sum(self, region=None):
+        """ Sum of the valid pixels of a region.
+
+        @param list region: [x1, x2, y1, y2], None for the whole image
+
+        @return float: sum of the pixel values
+        """
+        if region is None:
+            return float(self._table[-1, -1])
+        return float(self._corners(self._table, *self._clip(region)))
+
+    def count(self, region=None):
+        """ Number of valid (not NaN) pixels of a region.
+
+        @param list region: [x1, x2, y1, y2], None for the whole image
+
+        @return int: number of pixels
+        """
+        if region is None:
+            region = (0, self.shape[0], 0, self.shape[1])
+        x1, x2, y1, y2 = self._clip(region)
+        if self._has_nan:
+            return int(self._corners(self._count, x1, x2, y1, y2))
+        return (x2 - x1) * (y2 - y1)
+
+    def mean(self, region=None):
+        """ Mean of the valid pixels of a region.
+
+        @param list region: [x1, x2, y1, y2], None for the whole image
+
+        @return float: mean pixel value, NaN if the region has no valid pixel
+        """
+        count = self.count(region)
+        if count == 0:
+            return np.nan
+        return self.sum(region) / count
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+A module acquiring several cameras concurrently and grouping their frames by trigger.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['MultiCameraLogic']
+
+from collections import deque
+from functools import partial
+from PySide2 import QtCore
+
+from qudi.core.module import LogicBase
+from qudi.core.connector import Connector
+from qudi.core.configoption import ConfigOption
+from qudi.util.mutex import RecursiveMutex
+
+
+class MultiCameraLogic(LogicBase):
+    """ Streams up to three GuppyPro cameras (detection1..3) at the same time and emits the frames of
+    one trigger together.
+
+    All GuppyPro modules share the same Vimba session (the Vimba instance is a reference counted
+    singleton) and every camera streams on its own Vimba thread. Frames are grouped by the host
+    time at which they were received: frames of all cameras received within group_tolerance belong
+    to the same trigger. Frames without partner in the other cameras are discarded and counted.
+
+    Example config for copy-paste:
+
+    multicameralogic:
+        module.Class: 'multi_camera_logic.MultiCameraLogic'
+        connect:
+            camera1: 'detection1'
+            camera2: 'detection2'
+            camera3: 'detection3'
+        options:
+            group_tolerance: 0.005
+    """
+
+    # declare connectors
+    _camera1 = Connector(name='camera1', interface='CameraInterface', optional=True)
+    _camera2 = Connector(name='camera2', interface='CameraInterface', optional=True)
+    _camera3 = Connector(name='camera3', interface='CameraInterface', optional=True)
+    # declare config options
+    _group_tolerance = ConfigOption(name='group_tolerance', default=5e-3)  # in s
+
+    # signals
+    sigFramesGrouped = QtCore.Signal(object)  # dict {camera name: (frame, hardware timestamp)}
+    sigAcquisitionFinished = QtCore.Signal()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._thread_lock = RecursiveMutex()
+        self._cameras = dict()
+        self._pending = dict()
+        self._slots = dict()
+        self._last_group = None
+        self._group_count = 0
+        self._orphan_count = 0
+
+    def on_activate(self):
+        """ Initialisation performed during activation of the module.
+        """
+        self._cameras = dict()
+        for connector in (self._camera1, self._camera2, self._camera3):
+            camera = connector()
+            if camera is not None:
+                self._cameras[connector.name] = camera
+        if not self._cameras:
+            self.log.warning('No camera connected to the multi camera logic.')
+
+    def on_deactivate(self):
+        """ Perform required deactivation. """
+        self.stop_acquisition()
+
+    @property
+    def camera_names(self):
+        return tuple(self._cameras)
+
+    @property
+    def last_group(self):
+        return self._last_group
+
+    @property
+    def group_count(self):
+        """ Number of complete frame groups since the acquisition start """
+        return self._group_count
+
+    @property
+    def orphan_count(self):
+        """ Number of frames discarded because the other cameras did not see the same trigger """
+        return self._orphan_count
+
+    def start_acquisition(self):
+        """ Start streaming all the connected cameras on the hardware trigger """
+        with self._thread_lock:
+            if self.module_state() != 'idle':
+                self.log.error('Unable to start acquisition. Acquisition still in progress.')
+                return
+            self.module_state.lock()
+            self._pending = {name: deque() for name in self._cameras}
+            self._group_count = 0
+            self._orphan_count = 0
+            for name, camera in self._cameras.items():
+                self._slots[name] = partial(self.__handle_new_frames, name)
+                camera.sigNewFrame.connect(self._slots[name], QtCore.Qt.QueuedConnection)
+            for name, camera in self._cameras.items():
+                if not camera.start_trigged_acquisition():
+                    self.log.error(f'Unable to start streaming of {name}.')
+                    self.stop_acquisition()
+                    return
+
+    def stop_acquisition(self):
+        """ Stop streaming on all the cameras """
+        with self._thread_lock:
+            if self.module_state() != 'locked':
+                return
+            for name, camera in self._cameras.items():
+                camera.stop_acquisition()
+                slot = self._slots.pop(name, None)
+                if slot is not None:
+                    camera.sigNewFrame.disconnect(slot)
+            self.module_state.unlock()
+            self.sigAcquisitionFinished.emit()
+
+    def __handle_new_frames(self, name):
+        """ Collect the unread frames of one camera and emit every completed group """
+        with self._thread_lock:
+            camera = self._cameras[name]
+            buffered = camera.get_buffered_frame()
+            while buffered is not None:
+                self._pending[name].append(buffered)
+                buffered = camera.get_buffered_frame()
+            self.__emit_complete_groups()
+
+    def __emit_complete_groups(self):
+        pending = self._pending
+        while all(pending.values()):
+            # head entries: (frame, sequence number, hardware timestamp, receive time)
+            receive_times = {name: queue[0][3] for name, queue in pending.items()}
+            earliest = min(receive_times, key=receive_times.get)
+            if max(receive_times.values()) - receive_times[earliest] > self._group_tolerance:
+                # The earliest frame has no partner in at least one other camera
+                pending[earliest].popleft()
+                self._orphan_count += 1
+                continue
+            group = dict()
+            for name, queue in pending.items():
+                frame, _, timestamp, _ = queue.popleft()
+                group[name] = (frame, timestamp)
+            self._last_group = group
+            self._group_count += 1
+            self.sigFramesGrouped.emit(group)
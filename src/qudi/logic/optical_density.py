@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the optical density engine of the absorption imaging analysis.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['OpticalDensityEngine', 'RB87_D2_CROSS_SECTION', 'benchmark_optical_density',
+           'compute_od_stack']
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Resonant cross-section 3 * lambda^2 / (2 * pi) of the Rb87 D2 line, in m^2
+RB87_D2_CROSS_SECTION = 3 * 780.241e-9 ** 2 / (2 * np.pi)
+
+
+class OpticalDensityEngine:
+    """ Computes OD = -ln((atoms - dark) / (bright - dark)) and the atom number per pixel.
+
+    All the intermediate results live in float32 buffers allocated once for a given frame shape,
+    so that processing a shot does not allocate any array. The returned arrays are these buffers
+    and are overwritten by the next call: copy them to keep them.
+
+    Pixels where the atoms or bright frame is saturated, or where the numerator or denominator is
+    not positive, carry no information. They are set to NaN in 'mask' mode. In 'clip' mode they
+    are set to od_max when the probe was fully absorbed and to 0 otherwise, and all the values are
+    clipped to [-od_max, od_max].
+
+    Regions of interest are given as [x1, x2, y1, y2] and select image[x1:x2, y1:y2], following the
+    convention of the display. The engine also works on stacks of shots of shape (N, rows, columns),
+    in which case the normalization is done shot by shot.
+    """
+
+    def __init__(self, shape, saturation_level=None, invalid_mode='mask', od_max=6.):
+        """
+        @param tuple shape: shape of the frames, or of the (N, rows, columns) stacks of frames
+        @param float saturation_level: pixel value from which the camera is saturated, None to
+                                       disable the saturation check
+        @param str invalid_mode: 'mask' (NaN) or 'clip' for the pixels without information
+        @param float od_max: largest optical density in 'clip' mode
+        """
+        if invalid_mode not in ('mask', 'clip'):
+            raise ValueError(f'Unknown invalid pixel mode "{invalid_mode}"')
+        self.shape = tuple(shape)
+        self.saturation_level = saturation_level
+        self.invalid_mode = invalid_mode
+        self.od_max = od_max
+        self.normalization_factor = 1.
+        self._numerator = np.empty(self.shape, dtype=np.float32)
+        self._denominator = np.empty(self.shape, dtype=np.float32)
+        self._od = np.empty(self.shape, dtype=np.float32)
+        self._density = np.empty(self.shape, dtype=np.float32)
+        self._valid = np.empty(self.shape, dtype=bool)
+        self._mask = np.empty(self.shape, dtype=bool)
+        self._absorbed = np.empty(self.shape, dtype=bool)
+
+    @property
+    def od(self):
+        """ Last computed optical density """
+        return self._od
+
+    @property
+    def density(self):
+        """ Last computed atom number per pixel """
+        return self._density
+
+    @property
+    def valid_pixels(self):
+        """ Boolean map of the pixels of the last shot that carry information """
+        return self._valid
+
+    def compute_od(self, atoms, bright, dark, normalization_roi=None):
+        """ Compute the optical density of a shot.
+
+        @param numpy.ndarray atoms: frame with atoms
+        @param numpy.ndarray bright: frame without atoms
+        @param numpy.ndarray dark: frame without probe light
+        @param list normalization_roi: [x1, x2, y1, y2] region without atoms used to rescale the
+                                       atoms frame to the probe intensity of the bright frame, None
+                                       to disable the normalization
+
+        @return numpy.ndarray: optical density (float32 buffer of the engine)
+        """
+        numerator, denominator, od = self._numerator, self._denominator, self._od
+        valid, mask = self._valid, self._mask
+        np.subtract(atoms, dark, out=numerator, dtype=np.float32)
+        np.subtract(bright, dark, out=denominator, dtype=np.float32)
+
+        self.normalization_factor = 1.
+        if normalization_roi is not None:
+            x1, x2, y1, y2 = normalization_roi
+            atoms_sum = numerator[..., x1:x2, y1:y2].sum(axis=(-2, -1), dtype=np.float64,
+                                                         keepdims=True)
+            bright_sum = denominator[..., x1:x2, y1:y2].sum(axis=(-2, -1), dtype=np.float64,
+                                                            keepdims=True)
+            usable = (atoms_sum > 0) & (bright_sum > 0)
+            factor = np.divide(bright_sum, atoms_sum, out=np.ones_like(atoms_sum), where=usable)
+            np.multiply(numerator, factor.astype(np.float32), out=numerator)
+            self.normalization_factor = factor.item() if factor.size == 1 else factor.ravel()
+
+        np.greater(numerator, 0, out=valid)
+        np.greater(denominator, 0, out=mask)
+        np.logical_and(valid, mask, out=valid)
+        if self.saturation_level is not None:
+            np.less(atoms, self.saturation_level, out=mask)
+            np.logical_and(valid, mask, out=valid)
+            np.less(bright, self.saturation_level, out=mask)
+            np.logical_and(valid, mask, out=valid)
+
+        # Invalid pixels are computed on harmless values and overwritten afterwards
+        tiny = np.float32(1e-30)
+        np.maximum(numerator, tiny, out=numerator)
+        np.maximum(denominator, tiny, out=denominator)
+        np.divide(denominator, numerator, out=od)
+        np.log(od, out=od)
+
+        np.logical_not(valid, out=mask)
+        if self.invalid_mode == 'mask':
+            np.copyto(od, np.nan, where=mask)
+        else:
+            np.clip(od, -self.od_max, self.od_max, out=od)
+            np.copyto(od, 0, where=mask)
+            # Fully absorbed probe: no atoms signal left but some probe light
+            absorbed = self._absorbed
+            np.less_equal(numerator, tiny, out=mask)
+            np.greater(denominator, tiny, out=absorbed)
+            np.logical_and(absorbed, mask, out=absorbed)
+            np.copyto(od, self.od_max, where=absorbed)
+        return od
+
+    def compute_density(self, pixel_size, cross_section=RB87_D2_CROSS_SECTION):
+        """ Convert the last optical density into a number of atoms per pixel,
+        N = OD * pixel area / cross-section.
+
+        @param float pixel_size: pixel size in the object plane, in µm
+        @param float cross_section: absorption cross-section in m^2
+
+        @return numpy.ndarray: atoms per pixel (float32 buffer of the engine)
+        """
+        factor = np.float32((pixel_size * 1e-6) ** 2 / cross_section)
+        return np.multiply(self._od, factor, out=self._density)
+
+    def process(self, atoms, bright, dark, pixel_size, normalization_roi=None,
+                cross_section=RB87_D2_CROSS_SECTION):
+        """ Compute the optical density and the atom number per pixel of a shot.
+
+        @return tuple: (optical density, atoms per pixel), buffers of the engine
+        """
+        self.compute_od(atoms, bright, dark, normalization_roi)
+        return self._od, self.compute_density(pixel_size, cross_section)
+
+
+def benchmark_optical_density(shape=(494, 656), shots=200, dtype=np.uint16):
+    """ Measure the time needed to compute the optical density and the atom density of a shot.
+
+    @param tuple shape: frame shape
+    @param int shots: number of shots to process
+    @param dtype: pixel type of the raw frames
+
+    @return float: mean processing time per shot in s
+    """
+    rng = np.random.default_rng(0)
+    bright = rng.integers(100, 200, size=shape).astype(dtype)
+    dark = rng.integers(0, 10, size=shape).astype(dtype)
+    atoms = (bright * 0.5).astype(dtype)
+    engine = OpticalDensityEngine(shape, saturation_level=np.iinfo(dtype).max)
+    roi = [0, shape[0] // 4, 0, shape[1] // 4]
+    engine.process(atoms, bright, dark, 8.53, roi)
+    start = time.perf_counter()
+    for _ in range(shots):
+        engine.process(atoms, bright, dark, 8.53, roi)
+    return (time.perf_counter() - start) / shots
+
+
+def compute_od_stack(atoms, bright, dark, pixel_size, normalization_roi=None, roi=None,
+                     cross_section=RB87_D2_CROSS_SECTION, saturation_level=None,
+                     invalid_mode='mask', chunk_size=8, max_workers=None):
+    """ Compute the optical density and the atom number of a whole stack of shots, e.g. to
+    reprocess a recorded scan with a new normalization region or pixel size.
+
+    The stack is split into chunks of chunk_size shots to cap the memory of the intermediate
+    buffers, and the chunks are processed in parallel on a thread pool (numpy releases the GIL in
+    the vectorized operations). Inputs can be memory-mapped arrays.
+
+    @param numpy.ndarray atoms: (N, rows, columns) frames with atoms
+    @param numpy.ndarray bright: (N, rows, columns) frames without atoms
+    @param numpy.ndarray dark: (N, rows, columns) or (rows, columns) frames without probe light
+    @param float pixel_size: pixel size in the object plane, in µm
+    @param list normalization_roi: [x1, x2, y1, y2] normalization region, None to disable
+    @param list roi: [x1, x2, y1, y2] region where atoms are counted, None for the whole frame
+    @param float cross_section: absorption cross-section in m^2
+    @param float saturation_level: pixel value from which the camera is saturated
+    @param str invalid_mode: 'mask' or 'clip', see OpticalDensityEngine
+    @param int chunk_size: number of shots processed at once by a worker
+    @param int max_workers: number of threads, defaults to the number of CPUs
+
+    @return tuple: (optical density stack (N, rows, columns) float32,
+                    atom number in the roi of every shot (N,) float64)
+    """
+    count = atoms.shape[0]
+    od_stack = np.empty(atoms.shape, dtype=np.float32)
+    atom_number = np.empty(count, dtype=np.float64)
+    x1, x2, y1, y2 = roi if roi is not None else (0, atoms.shape[1], 0, atoms.shape[2])
+    factor = (pixel_size * 1e-6) ** 2 / cross_section
+    engines = threading.local()
+
+    def process_chunk(start):
+        stop = min(start + chunk_size, count)
+        shape = (stop - start, *atoms.shape[1:])
+        engine = getattr(engines, 'engine', None)
+        if engine is None or engine.shape != shape:
+            engine = OpticalDensityEngine(shape, saturation_level, invalid_mode)
+            engines.engine = engine
+        chunk_dark = dark[start:stop] if dark.ndim == 3 else dark
+        od = engine.compute_od(atoms[start:stop], bright[start:stop], chunk_dark,
+                               normalization_roi)
+        np.copyto(od_stack[start:stop], od)
+        np.nansum(od[:, x1:x2, y1:y2], axis=(1, 2), dtype=np.float64,
+                  out=atom_number[start:stop])
+        atom_number[start:stop] *= factor
+
+    workers = max_workers if max_workers is not None else os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() propagates the exceptions of the workers
+        list(executor.map(process_chunk, range(0, count, chunk_size)))
+    return od_stack, atom_number
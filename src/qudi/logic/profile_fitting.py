@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the fast fitting of the integrated profiles of the cloud in a region of interest.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['ProfileFit', 'ProfileFitter', 'ProfileSums', 'benchmark_profile_fit']
+
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from qudi.logic.integral_image import clip_region
+from qudi.logic.cloud_fitting import FitResult, PROFILE_MODELS, fit_profile, gaussian_2d, \
+    model_parameters, profile_integral
+
+ProfileFit = namedtuple('ProfileFit', ['parameters', 'success', 'center', 'width',
+                                       'atom_number'])
+ProfileFit.__doc__ = """ Fit of an integrated profile: parameters in the order of
+model_parameters(model, 1), convergence flag, fitted center and width (sigma, gamma or radius; the
+thermal sigma for the bimodal model) in pixels and atom number under the fitted profile """
+
+
+class ProfileSums:
+    """ Running sums along the rows and along the columns of an image, giving the profiles of any
+    region integrated along x and along y.
+
+    The sums are built once per image in O(pixels); afterwards the two profiles of a region are the
+    differences of two columns of the sums, in O(region side) instead of O(region area). This
+    keeps the 1D fits live while the ROI is dragged over full frames.
+
+    NaN pixels count as 0, as in IntegralImage. Regions are given as [x1, x2, y1, y2] and select
+    image[x1:x2, y1:y2]; they are clipped to the image.
+    """
+
+    def __init__(self, image=None):
+        """
+        @param numpy.ndarray image: 2D image, can be set later with update
+        """
+        self._along_y = np.zeros((0, 1), dtype=np.float64)  # sums over y, shape (rows, columns + 1)
+        self._along_x = np.zeros((1, 0), dtype=np.float64)  # sums over x, shape (rows + 1, columns)
+        if image is not None:
+            self.update(image)
+
+    @property
+    def shape(self):
+        """ Shape of the summed image """
+        return self._along_y.shape[0], self._along_x.shape[1]
+
+    def update(self, image):
+        """ Rebuild the sums for a new image.
+
+        @param numpy.ndarray image: 2D image
+        """
+        image = np.asarray(image)
+        rows, columns = image.shape
+        if self.shape != (rows, columns):
+            self._along_y = np.zeros((rows, columns + 1), dtype=np.float64)
+            self._along_x = np.zeros((rows + 1, columns), dtype=np.float64)
+        along_y, along_x = self._along_y[:, 1:], self._along_x[1:]
+        np.copyto(along_y, image)
+        if image.dtype.kind == 'f':
+            np.nan_to_num(along_y, copy=False, nan=0., posinf=0., neginf=0.)
+        np.copyto(along_x, along_y)
+        np.cumsum(along_y, axis=1, out=along_y)
+        np.cumsum(along_x, axis=0, out=along_x)
+
+    def profile_x(self, region=None):
+        """ Profile of a region along x, integrated along y.
+
+        @param list region: [x1, x2, y1, y2], None for the whole image
+
+        @return numpy.ndarray: sum of image[x, y1:y2] for x in x1:x2
+        """
+        x1, x2, y1, y2 = self.clip(region)
+        return self._along_y[x1:x2, y2] - self._along_y[x1:x2, y1]
+
+    def profile_y(self, region=None):
+        """ Profile of a region along y, integrated along x.
+
+        @param list region: [x1, x2, y1, y2], None for the whole image
+
+        @return numpy.ndarray: sum of image[x1:x2, y] for y in y1:y2
+        """
+        x1, x2, y1, y2 = self.clip(region)
+        return self._along_x[x2, y1:y2] - self._along_x[x1, y1:y2]
+
+    def clip(self, region):
+        """ Region clipped to the image, the whole image for None """
+        if region is None:
+            return (0, self.shape[0], 0, self.shape[1])
+        return clip_region(region, self.shape)
+
+
+class ProfileFitter:
+    """ Fits the profiles of the cloud integrated along x and along y, for the '1Dx', '1Dy' and
+    '1Dxy' fit types of the absorption GUI.
+
+    The x and y profiles are fitted at the same time on two threads. Every fit starts from the
+    converged parameters of the previous frame on the same axis (warm start), so that following a
+    cloud from frame to frame only takes a few iterations of the Levenberg-Marquardt solver on a
+    few hundred points. The moments of the profile are used again after a failed fit or a model
+    change.
+
+    Profiles of the atom density (atoms per pixel) give the atom number of each axis directly;
+    profiles of the optical density are converted with the atoms_per_od factor.
+    """
+
+    _axes = {'1Dx': ('x',), '1Dy': ('y',), '1Dxy': ('x', 'y')}
+
+    def __init__(self, model='gaussian', warm_start=True, parallel=True, max_nfev=50):
+        """
+        @param str model: 'gaussian', 'lorentzian', 'thomas_fermi' or 'bimodal'
+        @param bool warm_start: start from the parameters of the previous frame
+        @param bool parallel: fit the x and y profiles on two threads
+        @param int max_nfev: maximum number of model evaluations of a fit
+        """
+        self._check_model(model)
+        self._model = model
+        self.warm_start = warm_start
+        self.parallel = parallel
+        self.max_nfev = max_nfev
+        self._previous = dict()
+        self._executor = None
+
+    @staticmethod
+    def _check_model(model):
+        if model not in PROFILE_MODELS:
+            raise ValueError(f'Unknown profile model "{model}". Choose one of {PROFILE_MODELS}.')
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._check_model(model)
+        if model != self._model:
+            self._model = model
+            self.reset()
+
+    def reset(self):
+        """ Forget the parameters of the previous frames """
+        self._previous = dict()
+
+    def close(self):
+        """ Stop the fitting threads """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def fit(self, sums, region=None, fit_type='1Dxy', atoms_per_od=1.):
+        """ Fit the profiles of a region.
+
+        @param ProfileSums sums: running sums of the image
+        @param list region: [x1, x2, y1, y2], None for the whole image
+        @param str fit_type: '1Dx', '1Dy' or '1Dxy'
+        @param float atoms_per_od: atom number of a unit of the summed image
+
+        @return dict: ProfileFit of every fitted axis, 'x' and/or 'y'
+        """
+        if fit_type not in self._axes:
+            raise ValueError(f'Unknown 1D fit type "{fit_type}". Choose one of '
+                             f'{tuple(self._axes)}.')
+        x1, x2, y1, y2 = sums.clip(region)
+        profiles = dict()
+        if 'x' in self._axes[fit_type]:
+            profiles['x'] = (sums.profile_x(region), np.arange(x1, x2, dtype=np.float64))
+        if 'y' in self._axes[fit_type]:
+            profiles['y'] = (sums.profile_y(region), np.arange(y1, y2, dtype=np.float64))
+        return self.fit_profiles(profiles, atoms_per_od)
+
+    def fit_profiles(self, profiles, atoms_per_od=1.):
+        """ Fit integrated profiles, e.g. computed outside of ProfileSums.
+
+        @param dict profiles: (profile, coordinates) of every axis, 'x' and/or 'y'
+        @param float atoms_per_od: atom number of a unit of the profiles times a unit of the
+                                   coordinates
+
+        @return dict: ProfileFit of every axis
+        """
+        if self.parallel and len(profiles) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2,
+                                                    thread_name_prefix='profile_fit')
+            futures = {axis: self._executor.submit(self._fit, axis, *profile)
+                       for axis, profile in profiles.items()}
+            results = {axis: future.result() for axis, future in futures.items()}
+        else:
+            results = {axis: self._fit(axis, *profile) for axis, profile in profiles.items()}
+        return {axis: ProfileFit(result.parameters, result.success, result.parameters[1],
+                                 result.parameters[2],
+                                 profile_integral(self._model, result.parameters) * atoms_per_od)
+                for axis, result in results.items()}
+
+    def _fit(self, axis, profile, coordinates):
+        model = self._model
+        previous = self._previous.get(axis) if self.warm_start else None
+        size = len(model_parameters(model, 1))
+        if np.count_nonzero(np.isfinite(profile)) <= size:
+            # Not enough points left in the ROI to constrain the model
+            return FitResult(np.full(size, np.nan), False, np.nan, 0)
+        result = fit_profile(profile, coordinates, model, p0=previous, max_nfev=self.max_nfev)
+        if previous is not None and not result.success:
+            # The cloud changed too much for the warm start: start again from the moments
+            result = fit_profile(profile, coordinates, model, max_nfev=self.max_nfev)
+        if result.success:
+            self._previous[axis] = result.parameters.copy()
+        else:
+            self._previous.pop(axis, None)
+        return result
+
+
+def benchmark_profile_fit(size=200, frames=200, model='gaussian', noise=0.05):
+    """ Measure the time needed to get the x and y profiles of a ROI and fit them, frame after
+    frame of a slowly moving cloud.
+
+    @param int size: side of the square ROI in pixels
+    @param int frames: number of fitted frames
+    @param str model: fitted profile model
+    @param float noise: standard deviation of the pixel noise
+
+    @return float: mean time per frame in s
+    """
+    rng = np.random.default_rng(0)
+    x, y = np.indices((2 * size, 2 * size), dtype=np.float64)
+    region = [size // 2, size // 2 + size, size // 2, size // 2 + size]
+    sums = ProfileSums()
+    fitter = ProfileFitter(model)
+    images = [gaussian_2d(x, y, 1., size + 0.1 * i, size - 0.05 * i, size * 0.1, size * 0.08)
+              + rng.normal(0, noise, size=x.shape) for i in range(min(frames, 20))]
+    elapsed = 0.
+    for i in range(frames):
+        sums.update(images[i % len(images)])
+        start = time.perf_counter()
+        fitter.fit(sums, region, '1Dxy')
+        elapsed += time.perf_counter() - start
+    fitter.close()
+    return elapsed / frames
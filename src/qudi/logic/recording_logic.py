@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+A module recording every frame or shot of a camera logic to disk on a background writer thread.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['RecordingLogic']
+
+import os
+import time
+import queue
+import datetime
+import threading
+import numpy as np
+from PySide2 import QtCore
+
+from qudi.core.module import LogicBase
+from qudi.core.connector import Connector
+from qudi.core.configoption import ConfigOption
+from qudi.util.mutex import Mutex
+from qudi.storage.frame_storage import FrameStorage, default_storage_format
+
+
+class RecordingLogic(LogicBase):
+    """ Records every frame (or every shot) emitted by a camera logic, without the acquisition ever
+    waiting on the disk.
+
+    Frames are copied into a bounded queue by the slot of sigFrameChanged and written by a
+    dedicated writer thread to one binary file per recording (see FrameStorage). When the disk
+    stalls and the queue is full, the new frame is dropped ('drop_newest') or replaces the oldest
+    queued one ('drop_oldest'), and the drops are counted. Stopping the recording, or deactivating
+    the module, writes all the queued frames before closing the file.
+
+    The status (queue depth, write throughput, lag between acquisition and write, written and
+    dropped frames) is emitted periodically through sigStatusChanged.
+
+    Example config for copy-paste:
+
+    recordinglogic:
+        module.Class: 'recording_logic.RecordingLogic'
+        connect:
+            camera_logic: camera_logic
+        options:
+            source: 'frames'  # or 'shots' to record the atoms, bright and dark frames of each shot
+            queue_size: 64
+            overflow_policy: 'drop_newest'  # or 'drop_oldest'
+            storage_format: null  # 'hdf5' or 'npz', default: 'hdf5' if h5py is installed
+            compression: null
+            status_interval: 0.5  # in s
+    """
+
+    # declare connectors
+    _camera_logic = Connector(name='camera_logic', interface='GuppyLogic')
+    # declare config options
+    _source = ConfigOption(name='source', default='frames')
+    _queue_size = ConfigOption(name='queue_size', default=64)
+    _overflow_policy = ConfigOption(name='overflow_policy', default='drop_newest')
+    _storage_format = ConfigOption(name='storage_format', default=None)
+    _compression = ConfigOption(name='compression', default=None)
+    _status_interval = ConfigOption(name='status_interval', default=0.5)
+
+    # signals
+    sigRecordingChanged = QtCore.Signal(bool, str)  # recording, path of the recording file
+    sigStatusChanged = QtCore.Signal(dict)
+
+    # Marks the end of the recording in the queue
+    _STOP = object()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._thread_lock = Mutex()
+        self._stats_lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._storage = None
+        self._file_path = ''
+        self._metadata = dict()
+        self._attributes = dict()
+        self._status_timer = None
+        self._reset_statistics()
+
+    def on_activate(self):
+        """ Initialisation performed during activation of the module.
+        """
+        if self._source not in ('frames', 'shots'):
+            raise ValueError(f'Unknown recording source "{self._source}". Choose "frames" or '
+                             f'"shots".')
+        if self._overflow_policy not in ('drop_newest', 'drop_oldest'):
+            raise ValueError(f'Unknown overflow policy "{self._overflow_policy}". Choose '
+                             f'"drop_newest" or "drop_oldest".')
+        self._status_timer = QtCore.QTimer()
+        self._status_timer.setInterval(int(1000 * self._status_interval))
+        self._status_timer.timeout.connect(self._emit_status)
+
+    def on_deactivate(self):
+        """ Perform required deactivation. """
+        self.stop_recording()
+        self._status_timer.timeout.disconnect()
+        self._status_timer = None
+
+    @property
+    def recording(self):
+        return self.module_state() == 'locked'
+
+    @property
+    def file_path(self):
+        """ Path of the current or last recording file """
+        return self._file_path
+
+    def _reset_statistics(self):
+        self._written = 0
+        self._dropped = 0
+        self._bytes_written = 0
+        self._lag = 0.
+        self._max_lag = 0.
+        self._last_bytes = 0
+        self._last_status_time = time.perf_counter()
+        self._throughput = 0.
+
+    def start_recording(self, name=None):
+        """ Record the frames or shots of the camera logic until stop_recording.
+
+        @param str name: name of the recording file, a timestamp by default
+
+        @return bool: Success ?
+        """
+        with self._thread_lock:
+            if self.module_state() != 'idle':
+                self.log.error('Unable to start recording. Recording already in progress.')
+                return False
+            camera_logic = self._camera_logic()
+            timestamp = datetime.datetime.now()
+            name = f'{timestamp:%Y%m%d-%H%M-%S}_recording' if name is None else name
+            os.makedirs(self.module_default_data_dir, exist_ok=True)
+            self._file_path = os.path.join(self.module_default_data_dir, name)
+            # The settings are fixed during a recording: read them once from the camera
+            self._metadata = {'exposure': camera_logic.get_exposure(),
+                              'gain': camera_logic.get_gain()}
+            self._attributes = {'camera': camera_logic.module_name, 'source': self._source,
+                                'created': str(timestamp)}
+            self._storage = None
+            self._queue = queue.Queue(maxsize=self._queue_size)
+            with self._stats_lock:
+                self._reset_statistics()
+            self.module_state.lock()
+            self._writer = threading.Thread(target=self._write_loop, args=(self._queue,),
+                                            name=f'{self.module_name}-writer', daemon=True)
+            self._writer.start()
+            if self._source == 'shots':
+                camera_logic.sigShotChanged.connect(self._enqueue_shot, QtCore.Qt.QueuedConnection)
+            else:
+                camera_logic.sigFrameChanged.connect(self._enqueue_frame,
+                                                     QtCore.Qt.QueuedConnection)
+            self._status_timer.start()
+        self.sigRecordingChanged.emit(True, self._file_path)
+        return True
+
+    def stop_recording(self):
+        """ Stop recording, write the queued frames and close the file """
+        with self._thread_lock:
+            if self.module_state() != 'locked':
+                return
+            camera_logic = self._camera_logic()
+            if self._source == 'shots':
+                camera_logic.sigShotChanged.disconnect(self._enqueue_shot)
+            else:
+                camera_logic.sigFrameChanged.disconnect(self._enqueue_frame)
+            self._status_timer.stop()
+            # Blocks until the writer is done with the frames before the stop mark
+            self._queue.put(self._STOP)
+            self._writer.join()
+            self._writer = None
+            self._queue = None
+            self.module_state.unlock()
+        self._emit_status()
+        self.sigRecordingChanged.emit(False, self._file_path)
+
+    def _enqueue_frame(self, frame):
+        self._enqueue(frame)
+
+    def _enqueue_shot(self, frames, timestamps):
+        self._enqueue(frames)
+
+    def _enqueue(self, entry):
+        """ Queue a copy of an entry for the writer. Never waits: when the queue is full, the
+        overflow policy decides which entry is dropped. """
+        with self._thread_lock:
+            if self._queue is None or entry is None:
+                return
+            # The camera may hand out views of its frame buffer: keep our own copy
+            item = (np.array(entry, copy=True), time.time(), time.perf_counter())
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            if self._overflow_policy == 'drop_oldest':
+                try:
+                    self._queue.get_nowait()
+                    self._queue.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    pass
+            with self._stats_lock:
+                self._dropped += 1
+
+    def _write_loop(self, entries):
+        while True:
+            item = entries.get()
+            if item is self._STOP:
+                break
+            entry, timestamp, queued_time = item
+            try:
+                if self._storage is None:
+                    self._storage = FrameStorage(
+                        self._file_path, entry.shape, entry.dtype, self._compression,
+                        attributes=self._attributes,
+                        file_format=self._storage_format or default_storage_format()
+                    )
+                    self._file_path = self._storage.file_path
+                self._storage.append(entry, timestamp=timestamp, **self._metadata)
+            except Exception:
+                self.log.exception('Unable to record entry. Entry dropped.')
+                with self._stats_lock:
+                    self._dropped += 1
+                continue
+            lag = time.perf_counter() - queued_time
+            with self._stats_lock:
+                self._written += 1
+                self._bytes_written += entry.nbytes
+                self._lag = lag
+                self._max_lag = max(self._max_lag, lag)
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+
+    @property
+    def status(self):
+        """ Status of the recording.
+
+        @return dict: 'recording', 'file_path', 'queue_depth', 'queue_size', 'written', 'dropped',
+                      'throughput' (MB/s written between the last two periodic status updates),
+                      'lag' and 'max_lag' (s from the acquisition to the end of the write of a
+                      frame)
+        """
+        entries = self._queue
+        with self._stats_lock:
+            return {'recording': entries is not None,
+                    'file_path': self._file_path,
+                    'queue_depth': entries.qsize() if entries is not None else 0,
+                    'queue_size': self._queue_size,
+                    'written': self._written,
+                    'dropped': self._dropped,
+                    'throughput': self._throughput,
+                    'lag': self._lag,
+                    'max_lag': self._max_lag}
+
+    def _emit_status(self):
+        # The throughput is measured over the status period only, whoever else reads the status
+        now = time.perf_counter()
+        with self._stats_lock:
+            elapsed = now - self._last_status_time
+            if elapsed > 0:
+                self._throughput = (self._bytes_written - self._last_bytes) / elapsed / 1e6
+            self._last_bytes = self._bytes_written
+            self._last_status_time = now
+        self.sigStatusChanged.emit(self.status)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the streaming averaging of absorption imaging shots.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['AVERAGING_MODES', 'RunningAverage', 'ShotAverager']
+
+import numpy as np
+
+AVERAGING_MODES = ('cumulative', 'window', 'exponential')
+
+
+class RunningAverage:
+    """ Per-pixel running mean and variance of a stream of images.
+
+    Modes:
+        'cumulative': Welford mean and variance of all the images since the last reset
+        'window': Welford mean and variance of the last window images. The images of the window are
+                  kept (in float32) to remove them from the accumulators when they leave it.
+        'exponential': exponentially weighted mean and variance with weight alpha for the newest
+                       image
+
+    The accumulators are preallocated float64 arrays and every update is O(pixels) without
+    allocating memory. NaN pixels (e.g. masked pixels of an optical density) are skipped: each pixel
+    keeps its own count of valid images.
+    """
+
+    def __init__(self, shape, mode='cumulative', window=10, alpha=0.1):
+        """
+        @param tuple shape: shape of the images
+        @param str mode: 'cumulative', 'window' or 'exponential'
+        @param int window: number of images of the sliding window
+        @param float alpha: weight of the newest image in exponential mode, in ]0, 1]
+        """
+        if mode not in AVERAGING_MODES:
+            raise ValueError(f'Unknown averaging mode "{mode}"')
+        if mode == 'window' and window < 1:
+            raise ValueError('The averaging window must hold at least 1 image')
+        if mode == 'exponential' and not 0 < alpha <= 1:
+            raise ValueError('The exponential averaging weight must be in ]0, 1]')
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.window = int(window)
+        self.alpha = float(alpha)
+        self._mean = np.zeros(self.shape, dtype=np.float64)
+        self._m2 = np.zeros(self.shape, dtype=np.float64)  # sum of squared deviations, or variance
+        self._count = np.zeros(self.shape, dtype=np.float64)
+        self._delta = np.empty(self.shape, dtype=np.float64)
+        self._delta2 = np.empty(self.shape, dtype=np.float64)
+        self._valid = np.empty(self.shape, dtype=bool)
+        self._invalid = np.empty(self.shape, dtype=bool)
+        self._history = np.empty((self.window, *self.shape), dtype=np.float32) \
+            if mode == 'window' else None
+        self._shot_count = 0
+
+    @property
+    def shot_count(self):
+        """ Number of images in the average (bounded by the window in window mode) """
+        if self.mode == 'window':
+            return min(self._shot_count, self.window)
+        return self._shot_count
+
+    @property
+    def count(self):
+        """ Number of valid images averaged in every pixel """
+        return self._count.copy()
+
+    @property
+    def mean(self):
+        """ Mean image, NaN where no valid image was averaged """
+        mean = self._mean.copy()
+        mean[self._count == 0] = np.nan
+        return mean
+
+    @property
+    def variance(self):
+        """ Unbiased variance image (weighted variance in exponential mode), NaN where it is
+        undefined """
+        if self.mode == 'exponential':
+            variance = self._m2.copy()
+            variance[self._count == 0] = np.nan
+            return variance
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self._m2 / (self._count - 1)
+        variance[self._count < 2] = np.nan
+        return variance
+
+    @property
+    def noise_map(self):
+        """ Standard deviation of every pixel """
+        return np.sqrt(self.variance)
+
+    def reset(self):
+        """ Forget all the averaged images """
+        self._mean[:] = 0
+        self._m2[:] = 0
+        self._count[:] = 0
+        self._shot_count = 0
+
+    def update(self, image):
+        """ Add an image to the average.
+
+        @param numpy.ndarray image: new image, of the shape of the average
+        """
+        if image.shape != self.shape:
+            raise ValueError(f'Image of shape {image.shape} does not match the averaging shape '
+                             f'{self.shape}')
+        if self.mode == 'exponential':
+            self._add_exponential(image)
+        elif self.mode == 'cumulative':
+            self._add(image)
+        else:
+            slot = self._shot_count % self.window
+            if self._shot_count >= self.window:
+                self._remove(self._history[slot])
+            self._history[slot] = image
+            self._add(image)
+        self._shot_count += 1
+
+    def _find_valid(self, image):
+        """ Flag the finite pixels of image, return False if they all are """
+        if image.dtype.kind != 'f':
+            return False
+        np.isfinite(image, out=self._valid)
+        np.logical_not(self._valid, out=self._invalid)
+        return self._invalid.any()
+
+    def _add(self, image):
+        # Welford: n += 1, delta = x - mean, mean += delta / n, m2 += delta * (x - mean)
+        delta, delta2 = self._delta, self._delta2
+        has_invalid = self._find_valid(image)
+        np.subtract(image, self._mean, out=delta)
+        if has_invalid:
+            np.copyto(delta, 0, where=self._invalid)
+            np.add(self._count, self._valid, out=self._count)
+        else:
+            self._count += 1
+        np.maximum(self._count, 1, out=delta2)
+        np.divide(delta, delta2, out=delta2)
+        self._mean += delta2
+        np.subtract(image, self._mean, out=delta2)
+        if has_invalid:
+            np.copyto(delta2, 0, where=self._invalid)
+        np.multiply(delta, delta2, out=delta)
+        self._m2 += delta
+
+    def _remove(self, image):
+        # Inverse Welford: n -= 1, delta = x - mean, mean -= delta / n, m2 -= delta * (x - mean)
+        delta, delta2 = self._delta, self._delta2
+        has_invalid = self._find_valid(image)
+        np.subtract(image, self._mean, out=delta)
+        if has_invalid:
+            np.copyto(delta, 0, where=self._invalid)
+            np.subtract(self._count, self._valid, out=self._count)
+        else:
+            self._count -= 1
+        np.maximum(self._count, 1, out=delta2)
+        np.divide(delta, delta2, out=delta2)
+        self._mean -= delta2
+        np.subtract(image, self._mean, out=delta2)
+        if has_invalid:
+            np.copyto(delta2, 0, where=self._invalid)
+        np.multiply(delta, delta2, out=delta)
+        self._m2 -= delta
+        # Pixels without image left, and rounding errors of the downdates
+        np.equal(self._count, 0, out=self._invalid)
+        np.copyto(self._mean, 0, where=self._invalid)
+        np.maximum(self._m2, 0, out=self._m2)
+        np.copyto(self._m2, 0, where=self._invalid)
+
+    def _add_exponential(self, image):
+        # delta = x - mean, mean += alpha * delta, var = (1 - alpha) * (var + alpha * delta^2)
+        delta, delta2 = self._delta, self._delta2
+        alpha = self.alpha
+        has_invalid = self._find_valid(image)
+        if not has_invalid:
+            self._valid[:] = True
+        # The first valid image of a pixel initializes its mean
+        np.equal(self._count, 0, out=self._invalid)
+        np.logical_and(self._invalid, self._valid, out=self._invalid)
+        np.copyto(self._mean, image, where=self._invalid)
+        np.subtract(image, self._mean, out=delta)
+        np.logical_not(self._valid, out=self._invalid)
+        np.copyto(delta, 0, where=self._invalid)
+        np.multiply(delta, alpha, out=delta2)
+        self._mean += delta2
+        np.multiply(delta, delta2, out=delta)
+        self._m2 += delta
+        self._m2 *= 1 - alpha
+        np.add(self._count, self._valid, out=self._count)
+
+
+class ShotAverager:
+    """ Running averages of the images of absorption shots, e.g. the 'bright', 'dark' and 'OD'
+    images, all in the same averaging mode.
+    """
+
+    def __init__(self, shape, keys=('bright', 'dark', 'OD'), mode='cumulative', window=10,
+                 alpha=0.1):
+        """
+        @param tuple shape: shape of the images
+        @param tuple keys: names of the averaged images
+        @param str mode: 'cumulative', 'window' or 'exponential', see RunningAverage
+        @param int window: number of shots of the sliding window
+        @param float alpha: weight of the newest shot in exponential mode
+        """
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.window = window
+        self.alpha = alpha
+        self._averages = {key: RunningAverage(shape, mode, window, alpha) for key in keys}
+
+    @property
+    def keys(self):
+        return tuple(self._averages)
+
+    @property
+    def shot_count(self):
+        """ Number of shots in the averages """
+        return max((average.shot_count for average in self._averages.values()), default=0)
+
+    def __getitem__(self, key):
+        return self._averages[key]
+
+    def reset(self):
+        """ Forget all the averaged shots """
+        for average in self._averages.values():
+            average.reset()
+
+    def add_shot(self, images):
+        """ Add the images of a shot to the averages.
+
+        @param dict images: image of each averaged key, other keys are ignored
+        """
+        for key, average in self._averages.items():
+            image = images.get(key)
+            if image is not None:
+                average.update(image)
+
+    def get_means(self):
+        """ Averaged images
+
+        @return dict: mean image of every key
+        """
+        return {key: average.mean for key, average in self._averages.items()}
+
+    def get_noise_maps(self):
+        """ Pixel noise of the averaged images
+
+        @return dict: standard deviation image of every key
+        """
+        return {key: average.noise_map for key, average in self._averages.items()}
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a fast thumbnail generator for camera frames: numpy downsampling, a cached
+color lookup table and a zlib PNG encoder, run on a background thread pool.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['COLORMAPS', 'ThumbnailWriter', 'colormap_lut', 'downsample', 'encode_png',
+           'render_thumbnail', 'write_thumbnail']
+
+import os
+import zlib
+import struct
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Colors of the colormaps at evenly spaced positions, interpolated linearly into the LUTs
+COLORMAPS = {
+    'inferno': ('#000004', '#1f0c48', '#550f6d', '#88226a', '#ba3655', '#e35933', '#f98e09',
+                '#fac228', '#fcffa4'),
+    'viridis': ('#440154', '#472d7b', '#3b528b', '#2c728e', '#21918c', '#28ae80', '#5ec962',
+                '#addc30', '#fde725'),
+    'gray': ('#000000', '#ffffff'),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(name='inferno', size=256):
+    """ Color lookup table of a colormap, computed once per colormap and size.
+
+    @param str name: name of the colormap, one of COLORMAPS
+    @param int size: number of colors
+
+    @return numpy.ndarray: read-only array of shape (size, 3) and type uint8
+    """
+    try:
+        colors = COLORMAPS[name]
+    except KeyError:
+        raise ValueError(f'Unknown colormap "{name}". Choose one of {tuple(COLORMAPS)}.') from None
+    anchors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in colors],
+                       dtype=np.float64)
+    positions = np.linspace(0, 1, len(colors))
+    samples = np.linspace(0, 1, size)
+    lut = np.stack([np.interp(samples, positions, anchors[:, i]) for i in range(3)], axis=1)
+    lut = np.round(lut).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def downsample(image, max_size=256):
+    """ Average blocks of pixels so that the image fits in max_size x max_size.
+
+    The block size is the smallest integer that fits, the edge pixels that do not fill a block are
+    dropped.
+
+    @param numpy.ndarray image: 2D image
+    @param int max_size: maximum number of rows and columns of the result
+
+    @return numpy.ndarray: float32 image
+    """
+    image = np.asarray(image)
+    factor = max(1, -(-max(image.shape) // max_size))
+    if factor == 1:
+        return image.astype(np.float32)
+    rows, columns = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:rows * factor, :columns * factor].reshape(rows, factor, columns, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def render_thumbnail(image, max_size=256, colormap='inferno', levels=None, origin='lower'):
+    """ Color thumbnail of an image.
+
+    @param numpy.ndarray image: 2D image
+    @param int max_size: maximum number of rows and columns of the thumbnail
+    @param str colormap: name of the colormap, one of COLORMAPS
+    @param tuple levels: (low, high) values mapped to the ends of the colormap, the finite range
+                         of the thumbnail by default
+    @param str origin: 'lower' to put the first row at the bottom like the image plots, 'upper'
+
+    @return numpy.ndarray: RGB image of shape (rows, columns, 3) and type uint8
+    """
+    small = downsample(image, max_size)
+    if levels is None:
+        finite = small[np.isfinite(small)]
+        levels = (finite.min(), finite.max()) if finite.size else (0., 1.)
+    low, high = float(levels[0]), float(levels[1])
+    lut = colormap_lut(colormap)
+    scale = (len(lut) - 1) / (high - low) if high > low else 0.
+    indices = np.nan_to_num((small - low) * scale, nan=0.)
+    indices = np.clip(indices, 0, len(lut) - 1).astype(np.intp)
+    if origin == 'lower':
+        indices = indices[::-1]
+    return lut[indices]
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+
+def encode_png(rgb, compress_level=6):
+    """ Encode an RGB image to PNG.
+
+    @param numpy.ndarray rgb: uint8 image of shape (rows, columns, 3)
+    @param int compress_level: zlib compression level
+
+    @return bytes: PNG file content
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    rows, columns = rgb.shape[:2]
+    # Every row starts with its filter type, 0 (none)
+    scanlines = np.zeros((rows, 1 + 3 * columns), dtype=np.uint8)
+    scanlines[:, 1:] = rgb.reshape(rows, 3 * columns)
+    header = struct.pack('>IIBBBBB', columns, rows, 8, 2, 0, 0, 0)  # 8 bit RGB
+    return b''.join((b'\x89PNG\r\n\x1a\n',
+                     _png_chunk(b'IHDR', header),
+                     _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compress_level)),
+                     _png_chunk(b'IEND', b'')))
+
+
+def write_thumbnail(image, file_path, max_size=256, colormap='inferno', levels=None):
+    """ Render the thumbnail of an image and write it as PNG.
+
+    @param numpy.ndarray image: 2D image
+    @param str file_path: path of the PNG file, the .png extension is added if missing
+    @param int max_size: maximum number of rows and columns of the thumbnail
+    @param str colormap: name of the colormap, one of COLORMAPS
+    @param tuple levels: (low, high) values mapped to the ends of the colormap
+
+    @return str: path of the PNG file
+    """
+    if not file_path.endswith('.png'):
+        file_path += '.png'
+    data = encode_png(render_thumbnail(image, max_size, colormap, levels))
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(data)
+    return file_path
+
+
+class ThumbnailWriter:
+    """ Writes thumbnails on a background thread pool, so that saving a frame does not wait for its
+    rendering. Rendering and encoding run in numpy and zlib, which release the GIL for the bulk of
+    the work.
+    """
+
+    def __init__(self, max_size=256, colormap='inferno', max_workers=1):
+        """
+        @param int max_size: maximum number of rows and columns of the thumbnails
+        @param str colormap: name of the colormap, one of COLORMAPS
+        @param int max_workers: number of rendering threads
+        """
+        colormap_lut(colormap)  # fails early on unknown colormaps
+        self.max_size = max_size
+        self.colormap = colormap
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix='thumbnail-writer')
+
+    def submit(self, image, file_path, levels=None):
+        """ Queue the thumbnail of an image for writing.
+
+        @param numpy.ndarray image: 2D image, copied so that the caller can reuse its buffer
+        @param str file_path: path of the PNG file, the .png extension is added if missing
+        @param tuple levels: (low, high) values mapped to the ends of the colormap
+
+        @return concurrent.futures.Future: resolves to the path of the PNG file
+        """
+        image = np.array(image, copy=True)
+        return self._pool.submit(write_thumbnail, image, file_path, self.max_size, self.colormap,
+                                 levels)
+
+    def close(self, wait=True):
+        """ Stop the pool, after writing the queued thumbnails if wait """
+        self._pool.shutdown(wait=wait)
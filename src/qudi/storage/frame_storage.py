@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the binary storage of camera frames and absorption imaging shots.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['FRAME_METADATA', 'FRAME_STORAGE_FORMATS', 'FrameStorage', 'benchmark_frame_storage',
+           'default_storage_format', 'frame_count', 'load_entry', 'load_frames']
+
+import os
+import io
+import json
+import time
+import tempfile
+import zipfile
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+FRAME_STORAGE_FORMATS = ('hdf5', 'npz')
+
+# Metadata stored with every entry: name -> (shape, dtype, fill value)
+FRAME_METADATA = {
+    'timestamp': ((), np.float64, np.nan),  # time.time() of the entry
+    'exposure': ((), np.float64, np.nan),  # in s
+    'gain': ((), np.float64, np.nan),
+    'roi': ((4,), np.int64, -1),  # [x1, x2, y1, y2]
+}
+
+
+def default_storage_format():
+    """ 'hdf5' if h5py is installed, 'npz' otherwise """
+    return 'hdf5' if h5py is not None else 'npz'
+
+
+def _file_format(file_path):
+    return 'hdf5' if file_path.endswith(('.h5', '.hdf5')) else 'npz'
+
+
+class FrameStorage:
+    """ Appends the frames (or the shots of several frames, e.g. atoms, bright and dark) of a run to
+    a single binary file.
+
+    HDF5 (requires h5py): the entries go to one chunked dataset of shape (N, *entry_shape), one
+    chunk per entry, optionally compressed ('gzip' or 'lzf'). The dataset and the per-entry
+    metadata datasets grow by doubling and are trimmed to the number of entries on close. The
+    attributes of the run (camera, ...) are attributes of the file.
+
+    NPZ: every entry is appended as a .npy member of a zip archive (deflated when compressed), with
+    its metadata as a .json member, so that the file stays readable with numpy.load and an entry
+    costs one write at the end of the file.
+
+    Use it as a context manager, or call close at the end of the run.
+    """
+
+    def __init__(self, file_path, entry_shape, dtype, compression=None, attributes=None,
+                 file_format=None):
+        """
+        @param str file_path: path of the run file, created if needed. The extension is set from
+                              the format (.h5 or .npz) if it has none of them
+        @param tuple entry_shape: shape of an entry, (rows, columns) for frames or
+                                  (frames, rows, columns) for shots
+        @param dtype: pixel type
+        @param str compression: None, 'gzip' or 'lzf' (HDF5); any of them deflates the NPZ entries.
+                                Fast deflate levels are used to keep up with the shot rate
+        @param dict attributes: metadata of the whole run, e.g. {'camera': 'detection1'}
+        @param str file_format: 'hdf5' or 'npz', None for the extension or the default format
+        """
+        if file_format is None:
+            file_format = _file_format(file_path) if file_path.endswith(
+                ('.h5', '.hdf5', '.npz')) else default_storage_format()
+        if file_format not in FRAME_STORAGE_FORMATS:
+            raise ValueError(f'Unknown frame storage format "{file_format}". Choose one of '
+                             f'{FRAME_STORAGE_FORMATS}.')
+        if file_format == 'hdf5' and h5py is None:
+            raise ImportError('HDF5 frame storage requires h5py. Install it or use the npz format.')
+        if not file_path.endswith(('.h5', '.hdf5', '.npz')):
+            file_path += '.h5' if file_format == 'hdf5' else '.npz'
+        elif _file_format(file_path) != file_format:
+            raise ValueError(f'"{file_path}" is not a {file_format} file')
+        self.file_format = file_format
+        self.file_path = file_path
+        self.entry_shape = tuple(entry_shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self._length = 0
+        self._file = None
+        if file_format == 'hdf5':
+            self._open_hdf5(attributes or dict())
+        else:
+            self._open_npz(attributes or dict())
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def _open_hdf5(self, attributes):
+        self._file = h5py.File(self.file_path, 'a')
+        if 'frames' in self._file:
+            dataset = self._file['frames']
+            if dataset.shape[1:] != self.entry_shape or dataset.dtype != self.dtype:
+                self._file.close()
+                self._file = None
+                raise ValueError(f'"{self.file_path}" holds entries of shape {dataset.shape[1:]} '
+                                 f'and type {dataset.dtype}')
+            self._length = int(dataset.attrs.get('length', dataset.shape[0]))
+        else:
+            compression = 'lzf' if self.compression == 'lzf' else \
+                ('gzip' if self.compression else None)
+            self._file.create_dataset('frames', shape=(0, *self.entry_shape),
+                                      maxshape=(None, *self.entry_shape), dtype=self.dtype,
+                                      chunks=(1, *self.entry_shape), compression=compression,
+                                      compression_opts=1 if compression == 'gzip' else None,
+                                      shuffle=compression is not None)
+            for name, (shape, dtype, _) in FRAME_METADATA.items():
+                self._file.create_dataset(name, shape=(0, *shape), maxshape=(None, *shape),
+                                          dtype=dtype, chunks=(256, *shape))
+        for key, value in attributes.items():
+            self._file.attrs[key] = value
+
+    def _open_npz(self, attributes):
+        mode = 'a' if os.path.exists(self.file_path) else 'w'
+        compression = zipfile.ZIP_DEFLATED if self.compression else zipfile.ZIP_STORED
+        self._file = zipfile.ZipFile(self.file_path, mode, compression=compression,
+                                     allowZip64=True, compresslevel=1 if self.compression else None)
+        self._length = sum(1 for name in self._file.namelist()
+                           if name.startswith('frame_') and name.endswith('.npy'))
+        if 'attributes.json' in self._file.namelist():
+            stored = json.loads(self._file.read('attributes.json'))
+            entry_shape, dtype = _stored_layout(stored)
+            if entry_shape is not None and (entry_shape != self.entry_shape or dtype != self.dtype):
+                self._file.close()
+                self._file = None
+                raise ValueError(f'"{self.file_path}" holds entries of shape {entry_shape} and '
+                                 f'type {dtype}')
+        else:
+            # The entry layout is stored with the run attributes, for the runs without entries
+            self._file.writestr('attributes.json',
+                                json.dumps({**attributes, 'entry_shape': list(self.entry_shape),
+                                            'dtype': self.dtype.str}, default=str))
+
+    def append(self, entry, timestamp=None, exposure=None, gain=None, roi=None):
+        """ Append an entry to the run file.
+
+        @param numpy.ndarray entry: frame or shot of shape entry_shape
+        @param float timestamp: time.time() of the entry, now by default
+        @param float exposure: exposure time in s
+        @param float gain: camera gain
+        @param list roi: [x1, x2, y1, y2] of the entry
+
+        @return int: index of the entry in the run
+        """
+        if self._file is None:
+            raise RuntimeError(f'Frame storage "{self.file_path}" is closed')
+        entry = np.asarray(entry)
+        if entry.shape != self.entry_shape:
+            raise ValueError(f'Entry of shape {entry.shape} does not match the run entry shape '
+                             f'{self.entry_shape}')
+        metadata = {'timestamp': time.time() if timestamp is None else timestamp,
+                    'exposure': exposure, 'gain': gain, 'roi': roi}
+        index = self._length
+        if self.file_format == 'hdf5':
+            self._append_hdf5(index, entry, metadata)
+        else:
+            self._append_npz(index, entry, metadata)
+        self._length += 1
+        return index
+
+    def _append_hdf5(self, index, entry, metadata):
+        frames = self._file['frames']
+        if index >= frames.shape[0]:
+            capacity = max(2 * frames.shape[0], 16)
+            frames.resize(capacity, axis=0)
+            for name in FRAME_METADATA:
+                self._file[name].resize(capacity, axis=0)
+        frames.write_direct(np.ascontiguousarray(entry, dtype=self.dtype), dest_sel=np.s_[index])
+        for name, (_, _, fill) in FRAME_METADATA.items():
+            value = metadata[name]
+            self._file[name][index] = fill if value is None else value
+        frames.attrs['length'] = index + 1
+
+    def _append_npz(self, index, entry, metadata):
+        with self._file.open(f'frame_{index:06d}.npy', 'w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.ascontiguousarray(entry, dtype=self.dtype),
+                                      allow_pickle=False)
+        metadata = {key: (value.tolist() if isinstance(value, np.ndarray) else value)
+                    for key, value in metadata.items()}
+        self._file.writestr(f'frame_{index:06d}.json', json.dumps(metadata, default=float))
+
+    def flush(self):
+        """ Write the buffered entries to the disk (HDF5 only, NPZ entries are written at once) """
+        if self._file is not None and self.file_format == 'hdf5':
+            self._file.flush()
+
+    def close(self):
+        """ Trim the datasets to the number of entries and close the file """
+        if self._file is None:
+            return
+        if self.file_format == 'hdf5':
+            for name in ('frames', *FRAME_METADATA):
+                self._file[name].resize(self._length, axis=0)
+        self._file.close()
+        self._file = None
+
+
+def _stored_layout(attributes):
+    """ Entry shape and pixel type stored in the attributes of an NPZ run, (None, None) for the
+    runs written before they were stored """
+    if 'entry_shape' not in attributes or 'dtype' not in attributes:
+        return None, None
+    return tuple(int(n) for n in attributes['entry_shape']), np.dtype(attributes['dtype'])
+
+
+def load_frames(file_path):
+    """ Read a run file written by FrameStorage.
+
+    @param str file_path: path of the .h5 or .npz run file
+
+    @return tuple: (entries array of shape (N, *entry_shape), dict of the per-entry metadata
+                    arrays, dict of the run attributes)
+    """
+    if _file_format(file_path) == 'hdf5':
+        if h5py is None:
+            raise ImportError('Reading HDF5 frame storage requires h5py.')
+        with h5py.File(file_path, 'r') as file:
+            length = int(file['frames'].attrs.get('length', file['frames'].shape[0]))
+            frames = file['frames'][:length]
+            metadata = {name: file[name][:length] for name in FRAME_METADATA}
+            attributes = dict(file.attrs)
+        return frames, metadata, attributes
+    with zipfile.ZipFile(file_path, 'r') as file:
+        names = sorted(name for name in file.namelist()
+                       if name.startswith('frame_') and name.endswith('.npy'))
+        attributes = json.loads(file.read('attributes.json')) \
+            if 'attributes.json' in file.namelist() else dict()
+        entry_shape, dtype = _stored_layout(attributes)
+        attributes.pop('entry_shape', None)
+        attributes.pop('dtype', None)
+        metadata = {name: np.full((len(names), *shape), fill, dtype=dtype)
+                    for name, (shape, dtype, fill) in FRAME_METADATA.items()}
+        entries = []
+        for i, name in enumerate(names):
+            with file.open(name) as member:
+                entries.append(np.lib.format.read_array(io.BytesIO(member.read())))
+            values = json.loads(file.read(name[:-4] + '.json'))
+            for key, value in values.items():
+                if key in metadata and value is not None:
+                    metadata[key][i] = value
+    if entries:
+        frames = np.stack(entries)
+    elif entry_shape is not None:
+        frames = np.empty((0, *entry_shape), dtype=dtype)
+    else:
+        frames = np.empty((0,), dtype=np.uint16)
+    return frames, metadata, attributes
+
+
+def frame_count(file_path):
+    """ Number of entries of a run file written by FrameStorage, without reading them.
+
+    @param str file_path: path of the .h5 or .npz run file
+
+    @return int: number of entries
+    """
+    if _file_format(file_path) == 'hdf5':
+        if h5py is None:
+            raise ImportError('Reading HDF5 frame storage requires h5py.')
+        with h5py.File(file_path, 'r') as file:
+            return int(file['frames'].attrs.get('length', file['frames'].shape[0]))
+    with zipfile.ZipFile(file_path, 'r') as file:
+        return sum(1 for name in file.namelist()
+                   if name.startswith('frame_') and name.endswith('.npy'))
+
+
+def load_entry(file_path, index):
+    """ Read a single entry of a run file written by FrameStorage.
+
+    @param str file_path: path of the .h5 or .npz run file
+    @param int index: index of the entry in the run
+
+    @return numpy.ndarray: the entry
+    """
+    if _file_format(file_path) == 'hdf5':
+        if h5py is None:
+            raise ImportError('Reading HDF5 frame storage requires h5py.')
+        with h5py.File(file_path, 'r') as file:
+            return file['frames'][index]
+    with zipfile.ZipFile(file_path, 'r') as file:
+        with file.open(f'frame_{index:06d}.npy') as member:
+            return np.lib.format.read_array(io.BytesIO(member.read()))
+
+
+def benchmark_frame_storage(directory=None, shape=(494, 656), frames=20, dtype=np.uint16,
+                            compression=None):
+    """ Measure the write throughput of the binary frame storage against the text path, which
+    writes every pixel in ASCII like TextDataStorage.
+
+    @param str directory: directory of the test files, a temporary directory by default
+    @param tuple shape: frame shape
+    @param int frames: number of written frames
+    @param dtype: pixel type
+    @param str compression: compression of the binary storage, see FrameStorage
+
+    @return dict: {format: (frames per s, MB written per frame)} for 'text' and the available
+                  binary formats
+    """
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 200, size=(frames, *shape)).astype(dtype)
+    formats = ['npz'] + (['hdf5'] if h5py is not None else [])
+    results = dict()
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        start = time.perf_counter()
+        size = 0
+        for i, image in enumerate(images):
+            path = os.path.join(tmp, f'frame_{i}.dat')
+            np.savetxt(path, image, delimiter='\t', fmt='%.15e')
+            size += os.path.getsize(path)
+        results['text'] = (frames / (time.perf_counter() - start), size / frames / 1e6)
+        for file_format in formats:
+            path = os.path.join(tmp, f'run_{file_format}')
+            start = time.perf_counter()
+            with FrameStorage(path, shape, dtype, compression, file_format=file_format) as storage:
+                for image in images:
+                    storage.append(image, exposure=0.01, gain=0., roi=(0, shape[0], 0, shape[1]))
+            elapsed = time.perf_counter() - start
+            results[file_format] = (frames / elapsed,
+                                    os.path.getsize(storage.file_path) / frames / 1e6)
+    return results
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a memory-mapped archive of the shots of a run, indexed for random access.
+
+Qudi is free software: you can redistribute it and/or modify it under the terms of
+the GNU Lesser General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Qudi is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with qudi.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ['INDEX_DTYPE', 'RunArchive']
+
+import os
+import json
+import time
+import numpy as np
+
+# One record per shot of the index file
+INDEX_DTYPE = np.dtype([('shot', '<i8'),  # shot number in the run
+                        ('timestamp', '<f8'),  # time.time() of the shot
+                        ('parameter', '<f8'),  # value of the scanned parameter, NaN if none
+                        ('camera', '<i4'),  # position of the camera name in the archive header
+                        ('offset', '<i8')])  # byte offset of the shot in the frame store
+
+_HEADER = 'archive.json'
+_FRAMES = 'frames.dat'
+_INDEX = 'index.dat'
+_VERSION = 1
+
+
+class RunArchive:
+    """ Archive of the shots of a run in a directory:
+
+        archive.json  shot shape, pixel type, scanned parameter name and camera names
+        frames.dat    raw shots one after the other, all of the same size (fixed stride)
+        index.dat     one INDEX_DTYPE record per shot: shot number, timestamp, parameter value,
+                      camera and byte offset in frames.dat
+
+    Both data files are read through memory maps: any shot is a view at offset position * stride
+    and only the pages that are actually read are loaded from the disk. Shots are located by
+    position, by shot number or by a range of the scanned parameter in O(1) or O(log N), without
+    reading the rest of the run. This makes scrubbing through runs of 10^4 shots instantaneous.
+
+    Appending writes the shot at the end of frames.dat and its record at the end of index.dat, so
+    that a reader sees a consistent archive of the shots written so far after refresh.
+    """
+
+    def __init__(self, path, mode='r', shot_shape=None, dtype=None, parameter_name='',
+                 cameras=None):
+        """
+        @param str path: directory of the archive
+        @param str mode: 'r' to read, 'w' to create (an existing archive is overwritten), 'a' to
+                         append to an existing archive or create it
+        @param tuple shot_shape: shape of a shot, e.g. (3, rows, columns); required to create
+        @param dtype: pixel type; required to create
+        @param str parameter_name: name of the scanned parameter, e.g. 'detuning (kHz)'
+        @param list cameras: names of the cameras of the run, more can be added when appending
+        """
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError(f'Unknown archive mode "{mode}". Choose "r", "w" or "a".')
+        self.path = path
+        self.mode = mode
+        header_path = os.path.join(path, _HEADER)
+        if mode == 'w' or (mode == 'a' and not os.path.exists(header_path)):
+            if shot_shape is None or dtype is None:
+                raise ValueError('The shot shape and pixel type are required to create an archive')
+            os.makedirs(path, exist_ok=True)
+            self._header = {'version': _VERSION,
+                            'shot_shape': [int(n) for n in shot_shape],
+                            'dtype': np.dtype(dtype).str,
+                            'parameter_name': parameter_name,
+                            'cameras': list(cameras or []),
+                            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self._write_header()
+            for name in (_FRAMES, _INDEX):
+                open(os.path.join(path, name), 'wb').close()
+        else:
+            with open(header_path, 'r') as file:
+                self._header = json.load(file)
+        self.shot_shape = tuple(self._header['shot_shape'])
+        self.dtype = np.dtype(self._header['dtype'])
+        self.stride = int(np.prod(self.shot_shape)) * self.dtype.itemsize
+        self._frames_file = None
+        self._index_file = None
+        if mode != 'r':
+            self._frames_file = open(os.path.join(path, _FRAMES), 'ab')
+            self._index_file = open(os.path.join(path, _INDEX), 'ab')
+        self._frames = None
+        self._index = None
+        self._length = 0
+        self._mapped_length = -1
+        self._by_shot = None
+        self._by_parameter = None
+        self.refresh()
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_header(self):
+        with open(os.path.join(self.path, _HEADER), 'w') as file:
+            json.dump(self._header, file, indent=1)
+
+    @property
+    def parameter_name(self):
+        return self._header['parameter_name']
+
+    @property
+    def cameras(self):
+        return tuple(self._header['cameras'])
+
+    @property
+    def index(self):
+        """ Index records of all the shots (read-only memory map) """
+        self._map()
+        return self._index
+
+    def refresh(self):
+        """ Take the shots appended since the last refresh by another process into account """
+        index_size = os.path.getsize(os.path.join(self.path, _INDEX))
+        frames_size = os.path.getsize(os.path.join(self.path, _FRAMES))
+        # A shot counts once both its frames and its record are on the disk
+        self._length = min(index_size // INDEX_DTYPE.itemsize, frames_size // max(self.stride, 1))
+
+    def _map(self):
+        """ Map the data files again when shots were appended since they were last mapped. A
+        writer appends without remapping, the maps are only rebuilt on the next read. """
+        length = self._length
+        if length == self._mapped_length:
+            return
+        self._mapped_length = length
+        self._by_shot = None
+        self._by_parameter = None
+        if length == 0:
+            self._frames = np.empty((0, *self.shot_shape), dtype=self.dtype)
+            self._index = np.empty(0, dtype=INDEX_DTYPE)
+            return
+        self._frames = np.memmap(os.path.join(self.path, _FRAMES), dtype=self.dtype, mode='r',
+                                 shape=(length, *self.shot_shape))
+        self._index = np.memmap(os.path.join(self.path, _INDEX), dtype=INDEX_DTYPE, mode='r',
+                                shape=(length,))
+
+    def append(self, shot, parameter=np.nan, timestamp=None, camera='', shot_number=None):
+        """ Append a shot to the archive.
+
+        @param numpy.ndarray shot: frames of the shot, of shape shot_shape
+        @param float parameter: value of the scanned parameter
+        @param float timestamp: time.time() of the shot, now by default
+        @param str camera: name of the camera of the shot
+        @param int shot_number: number of the shot in the run, its position by default
+
+        @return int: position of the shot in the archive
+        """
+        if self._frames_file is None:
+            raise RuntimeError('Archive not open for writing')
+        shot = np.ascontiguousarray(shot, dtype=self.dtype)
+        if shot.shape != self.shot_shape:
+            raise ValueError(f'Shot of shape {shot.shape} does not match the archive shot shape '
+                             f'{self.shot_shape}')
+        cameras = self._header['cameras']
+        if camera not in cameras:
+            cameras.append(camera)
+            self._write_header()
+        position = self._length
+        record = np.array([(position if shot_number is None else shot_number,
+                            time.time() if timestamp is None else timestamp,
+                            parameter, cameras.index(camera), position * self.stride)],
+                          dtype=INDEX_DTYPE)
+        # Frames first: a record on the disk always points to a complete shot
+        self._frames_file.write(shot.tobytes())
+        self._frames_file.flush()
+        self._index_file.write(record.tobytes())
+        self._index_file.flush()
+        self._length += 1
+        return position
+
+    def __getitem__(self, position):
+        """ Shot(s) at a position, slice or array of positions; views of the memory map for
+        positions and slices """
+        self._map()
+        return self._frames[position]
+
+    def shot(self, shot_number):
+        """ Frames of a shot by shot number.
+
+        @param int shot_number: number of the shot in the run
+
+        @return numpy.ndarray: view of the shot frames
+        """
+        position = self.position(shot_number)
+        return self._frames[position]
+
+    def position(self, shot_number):
+        """ Position in the archive of a shot number """
+        self._map()
+        if self._by_shot is None:
+            numbers = np.asarray(self._index['shot'])
+            self._by_shot = {int(number): i for i, number in enumerate(numbers)}
+        try:
+            return self._by_shot[int(shot_number)]
+        except KeyError:
+            raise KeyError(f'No shot number {shot_number} in the archive') from None
+
+    def parameter_positions(self, low, high=None):
+        """ Positions of the shots whose parameter is in [low, high], or equal to low.
+
+        @param float low: lowest parameter value
+        @param float high: highest parameter value, None for low only
+
+        @return numpy.ndarray: positions sorted by parameter value, then by position
+        """
+        self._map()
+        if self._by_parameter is None:
+            parameters = np.asarray(self._index['parameter'])
+            order = np.argsort(parameters, kind='stable')
+            self._by_parameter = (parameters[order], order)
+        values, order = self._by_parameter
+        high = low if high is None else high
+        start = np.searchsorted(values, low, side='left')
+        stop = np.searchsorted(values, high, side='right')
+        return order[start:stop]
+
+    def parameter_slice(self, low, high=None):
+        """ Shots whose parameter is in [low, high], see parameter_positions.
+
+        @return tuple: (shots array (M, *shot_shape), index records (M,))
+        """
+        positions = self.parameter_positions(low, high)
+        return self._frames[positions], np.asarray(self._index[positions])
+
+    def camera_name(self, position):
+        """ Name of the camera of the shot at a position """
+        self._map()
+        return self._header['cameras'][int(self._index['camera'][position])]
+
+    def close(self):
+        """ Close the data files; the maps of a reader stay valid until released """
+        if self._frames_file is not None:
+            self._frames_file.close()
+            self._index_file.close()
+            self._frames_file = None
+            self._index_file = None